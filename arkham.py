@@ -2,28 +2,174 @@
 
 """Modules required"""
 
-from datetime import datetime
+import argparse
+import asyncio
+import atexit
+import bisect
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from array import array
+from datetime import datetime, timedelta
+import functools
+import gzip
+import http.client
+import inspect
+import itertools
 import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
 import re
+import sqlite3
+import struct
 import threading
-from queue import Queue
 import hashlib
 import pickle
+import queue
+import random
+import sys
 import time
+import types
+import urllib.parse
 import urllib.request
 import urllib.error
+import zlib
+import numpy as np
+from string import Template
 from unidecode import unidecode
 
 # Init vars
 # How many threads to run in parallel
 # (Increasing the value don't improve performance much on my system)
 NB_THREAD = 8
+# Worker processes (--processes) parse decks already in cache by shards of
+# SHARD_SIZE deck IDs (threads are limited by the GIL for parsing)
+SHARD_SIZE = 1000
+# Decks not parsed yet go through a pipeline (see pipeline_run): NB_THREAD
+# fetchers, PIPELINE_PARSERS parsers and a single aggregator thread. Queues
+# between the stages hold at most PIPELINE_QUEUE_SIZE decks. Fetchers read
+# the cached decks by windows of PIPELINE_PRELOAD deck IDs (see pipeline_preload).
+PIPELINE_PARSERS = 2
+PIPELINE_QUEUE_SIZE = 256
+PIPELINE_PRELOAD = 1000
 ARKHAM_DB_API = "https://arkhamdb.com/api/public/"
 FIRST_DECK = 1
 # LAST_DECK = 100  # Used for debugging/development
-LAST_DECK = 55000  # Maximum deck ID to try to fetch from ArkhamDB
+# Maximum deck ID to try to fetch from ArkhamDB (None: no maximum, the scan
+# stops by itself once the last deck of ArkhamDB is reached)
+LAST_DECK = None
+# The last deck of ArkhamDB is reached after that many missing decks in a row
+MAX_CONSECUTIVE_MISSES = 200
+# Decks fetched by publication day (--sync-by-date, one request per day)
+# instead of probing every deck ID. Set once every day was fetched: the
+# decks that aren't in cache aren't published, they're not fetched by ID.
+SYNC_BY_DATE = False
+SYNC_FIRST_DATE = "2016-09-01"  # First day of the decks of ArkhamDB
+SYNC_SETTLE_DAYS = 2  # The last days are fetched again on the next sync
 # Location of the root directory of ArkhamDB API cache
 DB_PATH = "./db/"
+# Cache backend used by arkhamdb_cache():
+#   "sqlite" packs every cached card/deck in a single file (compressed JSON)
+#   "files" keeps the historical layout (one JSON file per card/deck)
+CACHE_BACKEND = "sqlite"
+CACHE_DB = DB_PATH + "cache.sqlite"
+# Read-only archive of the cache (--cache-archive, see archive_export), read
+# when a card/deck isn't in the cache. Payloads are deduplicated and packed in
+# compressed frames of about ARCHIVE_FRAME_SIZE bytes.
+CACHE_ARCHIVE = None
+ARCHIVE_MAGIC = b"ARKHAMDB-CACHE-1"
+ARCHIVE_FOOTER = struct.Struct("<QQ16s16s")  # Index offset, length, digest, magic
+ARCHIVE_FRAME_SIZE = 1 << 20
+ARCHIVE_FRAMES_KEPT = 8  # Decompressed frames kept in memory
+# Reprinted cards and their original card (see --build-duplicates)
+DUPLICATES_PATH = DB_PATH + "other/duplicates.json"
+# Cards/decks missing from ArkhamDB aren't fetched again before their TTL expires
+MISSING_PATH = DB_PATH + "other/missing.json"
+SYNC_STATE_PATH = DB_PATH + "other/sync.json"  # Last day synced by date
+MISSING_TTL_NOT_FOUND = 30 * 24 * 3600  # HTTP 404: the deck was deleted
+MISSING_TTL_TRANSIENT = 24 * 3600  # Other HTTP errors, timeouts...
+# Asynchronous fetch (--async-fetch) of the decks/cards missing from the cache
+FETCH_CONCURRENCY = 8  # Requests in flight (one keep-alive connection each)
+FETCH_RATE = 10  # Maximum requests per second sent to ArkhamDB
+FETCH_BURST = 10  # Requests that can be sent at once after being idle
+FETCH_MAX_RETRIES = 3
+FETCH_BACKOFF = 0.5  # Delay before the first retry, doubled for each retry
+FETCH_TIMEOUT = 5
+# Aggregates of the previous run, only new decks are parsed (see --full)
+CHECKPOINT_PATH = DB_PATH + "checkpoint.pickle.gz"
+# gzip level of the checkpoint and partials, written on every run (speed over size)
+CHECKPOINT_COMPRESSLEVEL = 1
+# Partial aggregates of the shards of deck IDs (--shard), merged with --merge
+PARTIALS_PATH = DB_PATH + "partials/"
+# Every card of ArkhamDB (bulk card list), downloaded again after its TTL
+CARD_CATALOG_PATH = DB_PATH + "cards.json.gz"
+CARD_CATALOG_TTL = 24 * 3600
+# Release dates of the packs (ArkhamDB pack list), downloaded like the cards
+PACKS_PATH = DB_PATH + "packs.json.gz"
+# Month of the decks without a date (never in a rolling window)
+MONTH_UNKNOWN = "0000-00"
+CHECKPOINT_VERSION = 10  # Increase when the content of the checkpoint changes
+# Columnar deck store (--columnar): one NumPy array (.npy) per column
+DECK_STORE_PATH = DB_PATH + "decks/"
+DECK_STORE_COLUMNS = {
+    "deck_id": np.int32,
+    "investigator": np.int32,
+    "date": "datetime64[s]",
+    "xp": np.int16,
+    "deck_offsets": np.int64,
+    "card_idx": np.int32,
+    "qty": np.int16,
+    "ignored": np.int16,  # Quantity of the slot in ignoreDeckLimitSlots
+    "meta": np.int32,  # Deckbuilding choices of the deck (see deck_meta)
+}
+# Deck legality (see rules_compile): what the option table of an investigator
+# contains for a card no option allows, for a card that doesn't count
+# (weaknesses, its own signature/required cards), for a signature card of
+# another investigator and for a card of a "not" option (not even allowed by
+# the allowance cards)
+CARD_NOT_ALLOWED = -1
+CARD_FREE = -2
+CARD_RESTRICTED = -3
+CARD_EXCLUDED = -4
+# Keys of the deckbuilding options that are checked. Decks of an investigator
+# with other options (atleast...) are counted without being checked.
+RULES_OPTION_KEYS = {
+    "id",
+    "name",
+    "error",
+    "faction",
+    "faction_select",
+    "option_select",
+    "deck_size_select",
+    "level",
+    "limit",
+    "not",
+    "trait",
+    "type",
+    "slot",
+    "tag",
+    "uses",
+    "text",
+    "permanent",
+}
+# Keys of the meta of a deck used by the deckbuilding rules: back of a
+# parallel investigator and choices of the faction_select/option_select
+# options (the "id" of the option)
+RULES_META_KEYS = (
+    "alternate_back",
+    "faction_selected",
+    "faction_1",
+    "faction_2",
+    "option_selected",
+)
+# Cards allowing other cards in a deck: deckbuilding option added after the
+# options of the investigator (Versatile: 5 level 0 cards of any class)
+ALLOWANCE_OPTIONS = {"06167": {"level": {"min": 0, "max": 0}, "limit": 5}}
+# Permanent cards can change the deck size (Versatile +5, Underworld Support
+# -5...), only decks with less than (deck size - DECK_SIZE_MARGIN) cards are
+# rejected
+DECK_SIZE_MARGIN = 5
 # Location of the root where to store html/text files
 OUTPUT_PATH = "./output/"
 HTML_PATH = OUTPUT_PATH + "html/"
@@ -33,18 +179,127 @@ JSON_PATH = OUTPUT_PATH + "json/"
 # This can skew data for newer cards/expansions.
 # If this value is set to 0, all cards will be shown.
 RELEVANCE = 0.10
-queue = Queue()  # Init the empty queue
-queue_inv_aff = Queue()  # Init an empty queue for affinities
-thread_list = []  # Empty thread list
-thread_aff_list = []  # Empty thread list
-thread_aff_list_xp = []  # Empty thread list
+# Per investigator reports (text and HTML)
+REPORT_TXT_HEADER = Template("\n==== Investigator ${name}${suffix} ====\n\n")
+REPORT_TXT_CARD = Template("${name} (${code}) [${value}, ${percent}%]\n")
+REPORT_HTML_HEADER = Template(
+    " <!doctype html>\n"
+    " <html>\n"
+    " <head>\n"
+    " <title>${name}</title>\n"
+    ' <meta name="description" content="Investigator ${name} ${kind}card affinity">\n'
+    ' <meta name="keywords" content="arkham horror card game">\n'
+    " </head>\n"
+    " <body>\n"
+    " ${back_flavor}<br />\n"
+    ' <img src="https://arkhamdb.com/bundles/cards/${code}.png" /><br />\n'
+)
+REPORT_HTML_STATS = Template("Stats based on ${decks} decks<br />\n")
+REPORT_HTML_CARD = Template(
+    '<img src="https://arkhamdb.com/bundles/cards/${code}.png" />\n'
+)
+# Text/HTML/file name differences between the reports of every card and XP cards
+REPORT_SUFFIX = {
+    False: {"txt": "", "html": "", "file": ""},
+    True: {"txt": " (XP cards)", "html": "XP ", "file": "_xp"},
+}
+# Run report: stages duration, cache hit rates, counters and histograms
+RUN_REPORT_PATH = JSON_PATH + "run_report.json"
+# Upper bounds of the histograms buckets (seconds, requests in flight)
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Log level (per deck/request messages are DEBUG) and progress log interval
+LOG_LEVEL = "INFO"
+PROGRESS_INTERVAL = 10  # Seconds
+# Pairs of cards accumulated before being added to the card affinity matrix
+CARD_MATRIX_BATCH = 1000000
+# Card similarity index (lift, PMI, Jaccard, cosine): the TOP_K most similar
+# cards of each card, pairs of cards in less than MIN_DECKS decks are ignored
+# (scores of rare pairs are mostly noise)
+SIMILARITY_PATH = JSON_PATH + "card_similarity.npz"
+SIMILARITY_METRICS = ("lift", "pmi", "jaccard", "cosine")
+SIMILARITY_TOP_K = 50
+SIMILARITY_MIN_DECKS = 5
 affinity_investigators = {}  # Inv. Base card affinity
 affinity_investigators_xp = {}  # Inv. XP card affinity
-affinity_cards = {}  # Card to card affinity
+# Same affinities by month of the deck ("YYYY-MM", see new_month_bucket),
+# rolling windows are sums of months (see window_aggregate)
+affinity_months = {}
+card_ids = {}  # Card code -> integer ID (see card_id)
+card_codes = []  # Integer ID -> card code
+card_ids_lock = threading.Lock()
+# Card to card affinity matrix (empty, same as new_card_matrix)
+affinity_cards = {
+    # Sparse matrix: key is (row card ID << 32 | column card ID), sorted
+    "keys": np.zeros(0, dtype=np.int64),
+    "counts": np.zeros(0, dtype=np.int64),
+    # Pairs not added to the matrix yet: [(keys, counts), ...]
+    "pending": [],
+    "pending_size": 0,
+}
 # Hashing is used to deduplicate decks
 decks_grouped_by_hash = {}
-card_cache = {}  # This adds card in memory to reduce file read
+# Deck counted in the affinities for each hash (lowest deck ID of the group):
+# {hash: Deck} (see deck_representative)
+deck_representatives = {}
+# Card attributes used by the script, indexed by card ID (see card_id)
+card_catalog = {
+    "known": bytearray(),  # 1 when the attributes of the card are known
+    "encounter": bytearray(),  # 1 for encounter cards
+    "xp": array("b"),  # -1 when the card has no XP
+    "name": [],
+    "faction": [],
+    "type": [],
+    "pack": [],
+    "back_flavor": {},  # Investigators only
+    "duplicate_of": {},  # Reprints only: original card code
+}
+catalog_lock = threading.RLock()
 valid_decks = []  # Contain decks (id) found in ArkhamDB
+invalid_decks = {}  # Illegal decks (not counted): {deck ID: [problems]}
+unchecked_decks = []  # Decks counted without a legality check (see rules_row)
+# Deckbuilding rules of the investigators compiled over card IDs (see
+# rules_compile), a row of the tables for each choice of faction/option
+deck_rules = {
+    "investigators": {},  # (Investigator code, choice...) -> row of the tables
+    "selections": {},  # Investigator code -> meta keys of its choices
+    "options": np.zeros((0, 0), np.int8),  # First option allowing each card
+    # Limit of each option (0: no limit), then of each allowance
+    "limits": np.zeros((0, 0), np.int64),
+    "nb_options": 0,  # Options of the investigators in the limit table
+    "allowances": [],  # {"card", "code", "allowed", "limit"} (ALLOWANCE_OPTIONS)
+    "size": np.zeros(0, np.int64),  # Deck size (0: not checked)
+    "required": np.zeros((0, 0), np.int16),  # Required card group of each card
+    "required_codes": [],  # First card code of each required card group
+    "rows": {},  # Rows of the option table as lists (built when first used)
+    "required_cards": [],  # Required card groups as dicts {card ID: group}
+    "counted": np.zeros(0, bool),  # The card counts in the deck size
+    "deck_limit": np.zeros(0, np.int64),
+    "digest": "",  # Digest of the rules of the card list (see rules_digest)
+}
+cache_connection = None  # SQLite connection of the packed cache
+cache_lock = threading.Lock()  # SQLite connection is shared by all threads
+cache_preloaded = {}  # Compressed payloads read in one pass from the packed cache
+cache_archive = None  # Opened archive of the cache (see archive_open)
+archive_lock = threading.Lock()
+missing = {}  # Known missing cards/decks: {oper: {uid: [HTTP status, timestamp]}}
+missing_lock = threading.Lock()
+# Position of the deck scan (next deck ID to parse, last deck ID found,
+# decks to try again because they failed on the previous run and first deck
+# ID not preloaded yet)
+deck_scan = {
+    "next": FIRST_DECK,
+    "stop": LAST_DECK,
+    "last_found": FIRST_DECK - 1,
+    "retry": [],
+    "preloaded": FIRST_DECK,
+}
+deck_scan_lock = threading.Lock()
+preload_lock = threading.Lock()
+logger = logging.getLogger("arkham")
+# Counters/histograms keyed by (name, labels), duration of the stages of the run
+metrics = {"counters": {}, "histograms": {}, "stages": {}}
+metrics_lock = threading.Lock()
 fname_txt_replacements = [(r" ", "_"), (r"\"", ""), (r"'", "_")]
 
 #
@@ -64,21 +319,51 @@ def is_json(myjson):
 
 
 def open_url(request, max_retries=3, retry_delay=1):
-    """Return URL content with retries"""
+    """Return URL content with retries (None if all attempts failed)"""
     for attempt in range(max_retries):
-        print("Trying (" + str(attempt + 1) + "/" + str(max_retries) + ") : " + request)
+        logger.debug("Trying (%d/%d) : %s", attempt + 1, max_retries, request)
+        if attempt:
+            metrics_count("http_retries_total", client="urllib")
+        start = time.perf_counter()
         try:
-            return urllib.request.urlopen(request, timeout=5)
-        # HTTP error, we retry...
-        except urllib.error.HTTPError:
+            response = urllib.request.urlopen(request, timeout=5)
+            metrics_observe(
+                "http_request_seconds", time.perf_counter() - start, client="urllib"
+            )
+            metrics_count(
+                "http_requests_total", client="urllib", status=response.status
+            )
+            return response
+        # Not found, there's no point retrying...
+        except urllib.error.HTTPError as error:
+            metrics_count("http_requests_total", client="urllib", status=error.code)
+            if error.code == 404:
+                raise
+            # HTTP error, we retry...
             if attempt < max_retries - 1:
-                print(f"HTTP error: Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                delay = backoff_delay(retry_delay, attempt)
+                logger.warning(
+                    "HTTP error %d: Retrying in %.1f seconds... (%s)",
+                    error.code,
+                    delay,
+                    request,
+                )
+                time.sleep(delay)
         # OS Error, we retry...
         except OSError:
+            metrics_count("http_requests_total", client="urllib", status=0)
             if attempt < max_retries - 1:
-                print(f"OS error: Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                delay = backoff_delay(retry_delay, attempt)
+                logger.warning(
+                    "OS error: Retrying in %.1f seconds... (%s)", delay, request
+                )
+                time.sleep(delay)
+
+
+def backoff_delay(retry_delay, attempt):
+    """Return the delay before a retry (exponential backoff with jitter)"""
+    # The jitter avoids all threads retrying at the exact same time
+    return retry_delay * (2**attempt) * random.uniform(0.5, 1.5)
 
 
 def file_to_json(file_name):
@@ -101,6 +386,113 @@ def json_to_file(json_content, filename):
     write_to_file(json.dumps(json_content, indent=4), filename)
 
 
+def json_open(filename, mode, compress=None):
+    """Open a JSON file (gzip compressed by default if its name ends with .gz)"""
+    if compress is None:
+        compress = filename.endswith(".gz")
+    if compress:
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+
+def json_stream_to_file(items, filename, compact=False):
+    """
+    Write a JSON object to a file one key at a time (atomically).
+
+    Args:
+      items: (key, value) pairs, in the order they must be written.
+      filename: Output file, gzip compressed if its name ends with .gz.
+      compact: No indentation/spaces (else same output as json_to_file).
+    """
+    if compact:
+        separator, item_format = ",", "{}:{}"
+        dumps = functools.partial(json.dumps, separators=(",", ":"))
+    else:
+        separator, item_format = ",\n", "    {}: {}"
+        dumps = functools.partial(json.dumps, indent=4)
+    with json_open(filename + ".tmp", "w", filename.endswith(".gz")) as file:
+        file.write("{")
+        empty = True
+        for key, value in items:
+            if empty:
+                file.write("" if compact else "\n")
+                empty = False
+            else:
+                file.write(separator)
+            value = dumps(value)
+            if not compact:
+                value = value.replace("\n", "\n    ")
+            file.write(item_format.format(json.dumps(key), value))
+        file.write("}" if compact or empty else "\n}")
+    os.replace(filename + ".tmp", filename)
+
+
+def json_stream_from_file(filename, chunk_size=65536):
+    """
+    Read a JSON object from a file one key at a time.
+
+    Args:
+      filename: JSON file, gzip compressed if its name ends with .gz.
+      chunk_size: Characters read from the file at once.
+
+    Returns:
+      A generator of (key, value) pairs.
+    """
+    decoder = json.JSONDecoder()
+    value_end = re.compile(r"\s*[,:}]")
+    with json_open(filename, "r") as file:
+        buffer, position = "", 0
+
+        def peek():
+            # Skip whitespaces, return the next character ("" at the end of file)
+            nonlocal buffer, position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer):
+                    return buffer[position]
+                buffer, position = file.read(chunk_size), 0
+                if not buffer:
+                    return ""
+
+        def expect(characters):
+            nonlocal position
+            character = peek()
+            if not character or character not in characters:
+                raise ValueError(f"{filename}: expecting one of {characters!r}")
+            position += 1
+            return character
+
+        def value():
+            nonlocal buffer, position
+            peek()
+            while True:
+                # The value (or a number) could be cut by the end of the buffer,
+                # it's complete once followed by the next ":", "," or "}"
+                try:
+                    result, end = decoder.raw_decode(buffer, position)
+                    if value_end.match(buffer, end):
+                        position = end
+                        return result
+                except json.JSONDecodeError:
+                    pass
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    result, position = decoder.raw_decode(buffer, position)
+                    return result
+                buffer, position = buffer[position:] + chunk, 0
+
+        expect("{")
+        if peek() == "}":
+            return
+        while True:
+            key = value()
+            expect(":")
+            yield key, value()
+            if expect(",}") == "}":
+                return
+
+
 def dict_order_by_keys(dict_to_order):
     """Reorder a dictionary by keys"""
     keys = list(dict_to_order.keys())
@@ -120,12 +512,6 @@ def value_getter(pass_item):
     return pass_item[1]
 
 
-def fill_queue(filler_list):
-    """Fill the queue with content"""
-    for temp_item in filler_list:
-        queue.put(temp_item)
-
-
 def check_var_in_dict(dict, key_to_check, text_to_return="N/A"):
     """Return a dictionary value if it exists, else return a default text (N/A)."""
     if key_to_check in dict:
@@ -137,531 +523,3739 @@ def check_var_in_dict(dict, key_to_check, text_to_return="N/A"):
 #
 # End of generic fonctions
 #
-# Start of ArkhamDB specific functions
+# Start of metrics functions
 #
 
 
-#
-# @ToDo: I should find a better way to handle "last existing deck has been
-# reached" on ArkhamDB.
-#
-def arkhamdb_cache(oper, uid):
-    """ "Call Arkham DB cache"""
-    # If it's already in cache...
-    if oper == "card":
-        if card_cache.get(str(uid)):
-            return card_cache.get(str(uid))
-    # We try to open the file...
-    try:
-        with open(DB_PATH + oper + "/" + str(uid) + ".json", encoding="utf-8") as file:
-            json_to_return = json.load(file)
-    # If it's not working...
-    except IOError:
-        # We try to get the info from ArkhamDB
-        with open_url(ARKHAM_DB_API + oper + "/" + str(uid) + ".json") as response:
-            extracted_response = response.read()
-            # We validate if the response is a valid JSON
-            if is_json(extracted_response):
-                json_content = json.loads(extracted_response)
-                # We save the file for future use
-                json_to_file(json_content, DB_PATH + oper + "/" + str(uid) + ".json")
-                json_to_return = json_content
-            else:
-                json_to_return = {}
-    # If the current card isn't in the memory cache, add it...
-    if oper == "card":
-        # Load card in cache...
-        card_cache.update({str(uid): json_to_return})
-    return json_to_return
+def metrics_count(name, value=1, **labels):
+    """Add a value to a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics["counters"][key] = metrics["counters"].get(key, 0) + value
 
 
-def deck_deduplicate(slots):
-    """Replace duplicate card ID with their original ID"""
-    # Not sure how to properly fix references to global variables
-    global duplicates
-    dedup_dict = {}
-    for slot in slots:
-        # Why Linting fails on the following line... I don't know!
-        if slot in duplicates:
-            dedup_dict.update({duplicates[slot]: slots[slot]})
-        else:
-            dedup_dict.update({slot: slots[slot]})
-    # Reorder the list of card from low to high card ID.
-    return dict_order_by_keys(dedup_dict)
+def metrics_observe(name, value, buckets=METRICS_BUCKETS, **labels):
+    """Add a value (a duration in seconds by default) to a histogram"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metrics["histograms"].get(key)
+        if histogram is None:
+            histogram = {"buckets": buckets, "counts": [0] * (len(buckets) + 1)}
+            histogram.update({"sum": 0, "count": 0})
+            metrics["histograms"][key] = histogram
+        # The last count is for values above the last bucket
+        histogram["counts"][bisect.bisect_left(buckets, value)] += 1
+        histogram["sum"] = histogram["sum"] + value
+        histogram["count"] = histogram["count"] + 1
 
 
-def filter_out_cards(slots):
-    # @todo: Add cleaning/filtering of decks before processing
-    #        - remove non player cards (Partial!)
-    #        - basic random weakness card (DONE!)
-    #        - basic weakness
-    #        - scenario cards (Partial!)
-    """Filter out useless cards..."""
-    output_slots = {}
-    for slot in slots:
-        reject = False
-        if slot == "01000":  # Random basic weakness
-            reject = True
-        # Reject Encounter cards
-        if arkhamdb_cache("card", slot).get("encounter_code"):
-            reject = True
-        # Card wasn't rejected...
-        if not reject:
-            output_slots.update({slot: slots[slot]})
-    return output_slots
+@contextlib.contextmanager
+def metrics_timer(name, **labels):
+    """Add the duration of a block of code to a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics_observe(name, time.perf_counter() - start, **labels)
 
 
-def deck_level(deck_data):
-    """Return the XP spent in this deck"""
-    total_xp = 0
-    for slot in deck_data["slots"]:
-        try:
-            total_xp = total_xp + (
-                int(arkhamdb_cache("card", slot).get("xp")) * deck_data["slots"][slot]
+@contextlib.contextmanager
+def metrics_stage(stage):
+    """Add the duration of a block of code to a stage of the run report"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with metrics_lock:
+            metrics["stages"][stage] = (
+                metrics["stages"].get(stage, 0) + time.perf_counter() - start
             )
-        except TypeError:
-            pass
-    return total_xp
 
 
-def worker():
-    """Main worker function"""
-    # Not sure how to properly fix references to global variables
-    global valid_decks
-    # We process a queue...
-    while not queue.empty():
-        deck_id = queue.get()
-        # Open/clost the deck file
-        content = arkhamdb_cache("decklist", deck_id)
-        if len(content):
-            print(
-                "Deck being parsed: "
-                + str(deck_id)
-                + " ("
-                + content["investigator_name"]
-                + ")"
-            )
-            valid_decks = valid_decks + [deck_id]
-            content["slots"] = filter_out_cards(content["slots"])
-            # Check if the deck contains duplicate
-            # Replace duplicated cards in deck
-            dedup_slots = deck_deduplicate(content["slots"])
-            # Make sure the OG deck is in asc order
-            deck_slots = dict_order_by_keys(content["slots"])
-            # Compute md5 hashes
-            dedup_hash = hashlib.md5(pickle.dumps(dedup_slots)).hexdigest()
-            deck_hash = hashlib.md5(pickle.dumps(deck_slots)).hexdigest()
-            # Compare original deck to deduplicated
-            if dedup_hash != deck_hash:
-                # Display a message when cards we replaced in a deck
-                # after depulication
-                print(
-                    "Cards in deck "
-                    + str(deck_id).zfill(5)
-                    + " were replaced by their original card ID."
-                )
-                deck_hash = dedup_hash
-                content["slots"] = dedup_slots
-            # Delete variables that won't be used anymore
-            del dedup_hash
-            del dedup_slots
-            # The same deck exists...
-            if deck_hash in decks_grouped_by_hash:
-                # Diplay a message with duplicated deck IDs
-                print(
-                    "Deck "
-                    + str(content["id"])
-                    + " is identical to: "
-                    + str(decks_grouped_by_hash[deck_hash])
+def metrics_merge(source):
+    """Add the counters/histograms of another process"""
+    for key, value in source["counters"].items():
+        metrics_count(key[0], value, **dict(key[1]))
+    with metrics_lock:
+        for key, source_histogram in source["histograms"].items():
+            histogram = metrics["histograms"].get(key)
+            if histogram is None:
+                metrics["histograms"][key] = dict(
+                    source_histogram, counts=list(source_histogram["counts"])
                 )
-                # Build data for duplicated decks...
-                # Simple list of deck duplicate of
-                # Group duplicated decks together
-                if decks_grouped_by_hash.get(deck_hash):
-                    decks_grouped_by_hash[deck_hash] = sorted(
-                        decks_grouped_by_hash[deck_hash] + [content["id"]]
-                    )
-                else:
-                    decks_grouped_by_hash[deck_hash] = [content["id"]]
-            else:
-                # @todo verify if the deck is legit
-                # !!! Example: 27554 is illegal!
-                decks_grouped_by_hash[deck_hash] = [content["id"]]
-                # Process starter decks...
-                if deck_level(content) == 0:
-                    process_base_deck(content)
-                # Non-starter decks...
-                else:
-                    process_xp_deck(content)
-
-
-def worker_inv_aff():
-    """Worker for affinities"""
-    while not queue_inv_aff.empty():
-        inv = queue_inv_aff.get()
-        # Make some variables more easily accessible...
-        current_aff = affinity_investigators[inv]
-        reorg = sorted(current_aff.items(), key=value_getter, reverse=True)
-        # Get current investigator information
-        arkhamdb_cache("card", inv)
-        # Create the header of the file
-        txt_output = "\n==== Investigator " + card_cache[inv]["name"] + " ====\n\n"
-        html_output = (
-            " \
-<!doctype html>\n \
-<html>\n \
-<head>\n \
-<title>"
-            + card_cache[inv]["name"]
-            + '</title>\n \
-<meta name="description" content="Investigator '
-            + card_cache[inv]["name"]
-            + ' card affinity">\n \
-<meta name="keywords" content="arkham horror card game">\n \
-</head>\n \
-<body>\n \
-'
-            + check_var_in_dict(card_cache[inv], "back_flavor")
-            + '<br />\n \
-<img src="https://arkhamdb.com/bundles/cards/'
-            + card_cache[inv]["code"]
-            + '.png" /><br />\n'
-        )
-        max_value = 0  # We set the max value to zero
-        for code, value in reorg:
-            # Increment max value if necessary...
-            if value > max_value:
-                max_value = value
-                html_output = (
-                    html_output + "Stats based on " + str(max_value) + " decks<br />\n"
-                )
-            # Only keep the cards that are used in more than 10% of the decks
-            if value > (max_value * RELEVANCE):
-                html_output = (
-                    html_output
-                    + "<img "
-                    + 'src="https://arkhamdb.com/bundles/cards/'
-                    + str(code)
-                    + '.png" />\n'
-                )
-                # Without card ID
-                # txt_output = txt_output + card_cache[code]['name'] + ' [' + \
-                #     str(value) + ', ' + str(round(value*100/max_value, 1)) \
-                #     + '%]\n'
-                # With card ID
-                txt_output = (
-                    txt_output
-                    + arkhamdb_cache("card", code).get("name")
-                    + " ("
-                    + str(code)
-                    + ") ["
-                    + str(value)
-                    + ", "
-                    + str(round(value * 100 / max_value, 1))
-                    + "%]\n"
+                continue
+            histogram["counts"] = [
+                count + other
+                for count, other in zip(histogram["counts"], source_histogram["counts"])
+            ]
+            histogram["sum"] = histogram["sum"] + source_histogram["sum"]
+            histogram["count"] = histogram["count"] + source_histogram["count"]
+
+
+def metrics_cache_hit_rates():
+    """Return the share of cards/decks found without calling ArkhamDB"""
+    lookups = {}
+    for (name, labels), value in metrics["counters"].items():
+        if name == "cache_lookups_total":
+            labels = dict(labels)
+            tiers = lookups.setdefault(labels["oper"], {})
+            tiers[labels["tier"]] = tiers.get(labels["tier"], 0) + value
+    return {
+        oper: round(1 - tiers.get("network", 0) / sum(tiers.values()), 4)
+        for oper, tiers in sorted(lookups.items())
+    }
+
+
+def metrics_report(summary):
+    """Return the run report: summary, stages, hit rates, counters and histograms"""
+    report = dict(summary)
+    report["stages"] = {
+        stage: round(seconds, 3) for stage, seconds in metrics["stages"].items()
+    }
+    report["cache_hit_rates"] = metrics_cache_hit_rates()
+    report["counters"] = [
+        {"name": name, "labels": dict(labels), "value": value}
+        for (name, labels), value in sorted(metrics["counters"].items())
+    ]
+    report["histograms"] = [
+        {
+            "name": name,
+            "labels": dict(labels),
+            "buckets": dict(
+                zip(
+                    [str(bucket) for bucket in histogram["buckets"]] + ["+Inf"],
+                    itertools.accumulate(histogram["counts"]),
                 )
-        print(txt_output)
-        write_to_file(
-            txt_output,
-            TEXT_PATH
-            + unidecode(
-                "inv_aff_"
-                + replace_text(card_cache[inv]["name"], fname_txt_replacements)
-                + ".txt"
             ),
+            "sum": round(histogram["sum"], 6),
+            "count": histogram["count"],
+        }
+        for (name, labels), histogram in sorted(metrics["histograms"].items())
+    ]
+    return report
+
+
+def metrics_prometheus():
+    """Return the counters, histograms and stages in Prometheus text format"""
+
+    def series(name, labels):
+        if not labels:
+            return "arkham_" + name
+        text = ",".join(
+            key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+            for key, value in labels
         )
-        write_to_file(
-            html_output,
-            HTML_PATH
-            + unidecode(
-                "inv_aff_"
-                + replace_text(card_cache[inv]["name"], fname_txt_replacements)
-                + ".html"
+        return "arkham_" + name + "{" + text + "}"
+
+    lines = []
+    types_written = set()
+    for (name, labels), value in sorted(metrics["counters"].items()):
+        if name not in types_written:
+            lines.append(f"# TYPE arkham_{name} counter")
+            types_written.add(name)
+        lines.append(f"{series(name, labels)} {value}")
+    for (name, labels), histogram in sorted(metrics["histograms"].items()):
+        if name not in types_written:
+            lines.append(f"# TYPE arkham_{name} histogram")
+            types_written.add(name)
+        cumulative = itertools.accumulate(histogram["counts"])
+        for bucket, count in zip(list(histogram["buckets"]) + ["+Inf"], cumulative):
+            lines.append(
+                f"{series(name + '_bucket', labels + (('le', bucket),))} {count}"
+            )
+        lines.append(f"{series(name + '_sum', labels)} {histogram['sum']}")
+        lines.append(f"{series(name + '_count', labels)} {histogram['count']}")
+    lines.append("# TYPE arkham_stage_seconds gauge")
+    for stage, seconds in metrics["stages"].items():
+        lines.append(f"{series('stage_seconds', (('stage', stage),))} {seconds}")
+    return "\n".join(lines) + "\n"
+
+
+#
+# End of metrics functions
+#
+# Start of logging functions
+#
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format log records as JSON lines (with the `fields` of the record)"""
+
+    def format(self, record):
+        line = {
+            "time": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
             ),
-        )
-        # write_to_file(txt_output, TEXT_PATH + unidecode('inv_aff_' +
-        #               card_cache[inv]['name'].replace(" ", "_") + '.txt'))
-        # write_to_file(html_output, HTML_PATH + unidecode('inv_aff_' +
-        #               card_cache[inv]['name'].replace(" ", "_") + '.html'))
+            "level": record.levelname,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage().strip(),
+        }
+        line.update(getattr(record, "fields", {}))
+        return json.dumps(line)
 
 
-def replace_text(text, replacements):
+def logging_setup(level, json_file=None):
     """
-    Replace text based on a list of replacement pairs.
+    Send the log records of the script to the console (and a JSON lines file).
 
-    Args:
-      text: Original text.
-      replacement: List of tuples, each tuple contains a regex pattern and its replacement.
+    Records are put in a queue and written by a listener thread, so workers
+    never wait for the console. The queue can be used by worker processes.
 
     Returns:
-      The modified text.
+      The queue of the log records.
     """
-    for pattern, replacement in replacements:
-        text = re.sub(pattern, replacement, text)
-    return text
+    log_queue = multiprocessing.Queue()
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    handlers = [console]
+    if json_file:
+        json_handler = logging.FileHandler(json_file, encoding="utf-8")
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    # Records still in the queue are written before exiting
+    atexit.register(listener.stop)
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+    return log_queue
+
+
+def progress_report(stop, interval=PROGRESS_INTERVAL):
+    """Log the progress of the parsing every `interval` seconds until `stop` is set"""
+    start, first_deck = time.monotonic(), deck_scan["next"]
+    last_cached = cache_last_id("decklist")
+    while not stop.wait(interval):
+        elapsed = time.monotonic() - start
+        decks = sum(
+            value
+            for (name, labels), value in list(metrics["counters"].items())
+            if name == "decks_total"
+        )
+        fields = {
+            "decks": decks,
+            "decks_per_second": round(decks / elapsed, 1),
+            "cache_hit_rate": metrics_cache_hit_rates().get("decklist"),
+        }
+        message = "Progress: %d decks parsed (%s decks/s"
+        arguments = [decks, fields["decks_per_second"]]
+        # Remaining time until the last deck in cache is parsed
+        scanned = deck_scan["next"] - first_deck
+        if scanned > 0 and deck_scan["next"] <= last_cached:
+            fields["eta_seconds"] = round(
+                (last_cached - deck_scan["next"]) * elapsed / scanned
+            )
+            message = message + ", ETA %s"
+            arguments.append(timedelta(seconds=fields["eta_seconds"]))
+        if fields["cache_hit_rate"] is not None:
+            message = message + ", cache hit rate %.1f%%"
+            arguments.append(fields["cache_hit_rate"] * 100)
+        logger.info(message + ")", *arguments, extra={"fields": fields})
+
+
+#
+# End of logging functions
+#
+# Start of cache backend functions
+#
+
+
+def cache_file_name(oper, uid):
+    """Return the file name of a card/deck in the per-file cache layout"""
+    return DB_PATH + oper + "/" + str(uid) + ".json"
+
+
+def cache_open():
+    """Return the connection to the packed cache (create it if needed)"""
+    global cache_connection
+    if cache_connection is None:
+        cache_connection = sqlite3.connect(CACHE_DB, check_same_thread=False)
+        cache_connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "oper TEXT NOT NULL, uid TEXT NOT NULL, payload BLOB NOT NULL, "
+            "PRIMARY KEY (oper, uid)) WITHOUT ROWID"
+        )
+    return cache_connection
+
+
+def cache_encode(json_content):
+    """Return the compact and compressed payload of a JSON data structure"""
+    return zlib.compress(
+        json.dumps(json_content, separators=(",", ":")).encode("utf-8")
+    )
 
 
-def worker_inv_aff_xp():
-    """Worker for affinities"""
-    while not queue_inv_aff.empty():
-        inv = queue_inv_aff.get()
-        # Make some variables more easily accessible...
-        current_aff = affinity_investigators_xp[inv]
-        reorg = sorted(current_aff.items(), key=value_getter, reverse=True)
-        # Get current investigator information
-        arkhamdb_cache("card", inv)
-        # Create the header of the file
-        txt_output = (
-            "\n==== Investigator " + card_cache[inv]["name"] + " (XP cards) ====\n\n"
-        )
-        html_output = (
-            " \
-<!doctype html>\n \
-<html>\n \
-<head>\n \
-<title>"
-            + card_cache[inv]["name"]
-            + '</title>\n \
-<meta name="description" content="Investigator '
-            + card_cache[inv]["name"]
-            + ' XP card affinity">\n \
-<meta name="keywords" content="arkham horror card game">\n \
-</head>\n \
-<body>\n \
-'
-            + check_var_in_dict(card_cache[inv], "back_flavor")
-            + '<br />\n \
-<img src="https://arkhamdb.com/bundles/cards/'
-            + card_cache[inv]["code"]
-            + '.png" /><br />\n'
-        )
-        max_value = 0  # We set the max value to zero
-        for code, value in reorg:
-            # Increment max value if necessary...
-            if value > max_value:
-                max_value = value
-                html_output = (
-                    html_output + "Stats based on " + str(max_value) + " decks<br />\n"
+def cache_decode(payload):
+    """Return the JSON data structure of a compressed payload"""
+    return json.loads(zlib.decompress(payload))
+
+
+def cache_preload(oper, after=None, before=None):
+    """Read every cached object of a kind (IDs between `after` and `before`) in
+    one pass, added to the ones already preloaded"""
+    if CACHE_BACKEND != "sqlite":
+        return
+    query = "SELECT uid, payload FROM cache WHERE oper = ?"
+    parameters = [oper]
+    if after is not None:
+        query = query + " AND CAST(uid AS INTEGER) > ?"
+        parameters.append(after)
+    if before is not None:
+        query = query + " AND CAST(uid AS INTEGER) < ?"
+        parameters.append(before)
+    with cache_lock:
+        rows = cache_open().execute(query, parameters)
+        # Payloads are kept compressed, they are only decoded when used
+        cache_preloaded.setdefault(oper, {}).update(rows)
+
+
+def cache_get(oper, uid):
+    """Return a card/deck from the cache, None if it's not cached"""
+    if CACHE_BACKEND == "files":
+        try:
+            with open(cache_file_name(oper, uid), encoding="utf-8") as file:
+                content = file.read()
+        except IOError:
+            return archive_get(oper, uid)
+        metrics_count("bytes_read_total", len(content), source="files")
+        return json.loads(content)
+    # A deck is only parsed once, so we free its memory right away
+    payload = cache_preloaded.get(oper, {}).pop(str(uid), None)
+    if payload is not None:
+        metrics_count("bytes_read_total", len(payload), source="preload")
+    else:
+        with cache_lock:
+            row = (
+                cache_open()
+                .execute(
+                    "SELECT payload FROM cache WHERE oper = ? AND uid = ?",
+                    (oper, str(uid)),
                 )
-            # Only keep the cards that are used in more than 10% of the decks
-            if "xp" in card_cache[code].keys():
-                if card_cache[code]["xp"] > 0:
-                    if value > (max_value * RELEVANCE / 2):
-                        html_output = (
-                            html_output
-                            + "<img "
-                            + 'src="https://arkhamdb.com/'
-                            + "bundles/cards/"
-                            + str(code)
-                            + '.png" />\n'
-                        )
-                        # Display With the ArkhamDB card ID
-                        txt_output = (
-                            txt_output
-                            + arkhamdb_cache("card", code).get("name")
-                            + " ("
-                            + str(code)
-                            + ") ["
-                            + str(value)
-                            + ", "
-                            + str(round(value * 100 / max_value, 1))
-                            + "%]\n"
-                        )
-        print(txt_output)
-        write_to_file(
-            txt_output,
-            TEXT_PATH
-            + unidecode(
-                "inv_aff_"
-                + replace_text(card_cache[inv]["name"], fname_txt_replacements)
-                + "_xp.txt"
-            ),
+                .fetchone()
+            )
+        if row is None:
+            return archive_get(oper, uid)
+        payload = row[0]
+        metrics_count("bytes_read_total", len(payload), source="sqlite")
+    return cache_decode(payload)
+
+
+def cache_put(oper, uid, json_content):
+    """Save a card/deck into the cache"""
+    if CACHE_BACKEND == "files":
+        json_to_file(json_content, cache_file_name(oper, uid))
+        return
+    with cache_lock:
+        connection = cache_open()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (oper, uid, payload) VALUES (?, ?, ?)",
+            (oper, str(uid), cache_encode(json_content)),
         )
-        write_to_file(
-            html_output,
-            HTML_PATH
-            + unidecode(
-                "inv_aff_"
-                + replace_text(card_cache[inv]["name"], fname_txt_replacements)
-                + "_xp.html"
-            ),
+        connection.commit()
+
+
+def cache_put_many(oper, items):
+    """Save (uid, card/deck) pairs into the cache (a single commit)"""
+    if CACHE_BACKEND == "files":
+        for uid, json_content in items:
+            cache_put(oper, uid, json_content)
+        return
+    with cache_lock:
+        connection = cache_open()
+        connection.executemany(
+            "INSERT OR REPLACE INTO cache (oper, uid, payload) VALUES (?, ?, ?)",
+            [
+                (oper, str(uid), cache_encode(json_content))
+                for uid, json_content in items
+            ],
+        )
+        connection.commit()
+
+
+def cache_migrate():
+    """One-shot copy of the per-file cache (db/card, db/decklist) in the packed cache"""
+    connection = cache_open()
+    for oper in ["card", "decklist"]:
+        migrated = 0
+        for file_name in sorted(os.listdir(DB_PATH + oper)):
+            if not file_name.endswith(".json"):
+                continue
+            json_content = file_to_json(DB_PATH + oper + "/" + file_name)
+            if json_content is False:
+                continue
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (oper, uid, payload) VALUES (?, ?, ?)",
+                (oper, file_name[: -len(".json")], cache_encode(json_content)),
+            )
+            migrated = migrated + 1
+        connection.commit()
+        logger.info("%d %s file(s) migrated to %s", migrated, oper, CACHE_DB)
+
+
+def missing_load():
+    """Load the list of cards/decks known to be missing from ArkhamDB"""
+    content = file_to_json(MISSING_PATH)
+    if content:
+        missing.update(content)
+
+
+def missing_save(last_deck_found):
+    """Save the list of cards/decks known to be missing from ArkhamDB"""
+    with missing_lock:
+        # Decks after the last one found aren't deleted, they don't exist
+        # yet. They must be fetched again on the next run.
+        missing["decklist"] = {
+            uid: value
+            for uid, value in missing.get("decklist", {}).items()
+            if int(uid) < last_deck_found
+        }
+        json_to_file(
+            {oper: dict_order_by_keys(missing[oper]) for oper in missing},
+            MISSING_PATH,
         )
-        # write_to_file(txt_output, TEXT_PATH + unidecode('inv_aff_' +
-        #               card_cache[inv]['name'].replace(" ", "_") + '_xp.txt'))
-        # write_to_file(html_output, HTML_PATH + unidecode('inv_aff_' +
-        #               card_cache[inv]['name'].replace(" ", "_") + '_xp.html'))
 
 
-def process_base_deck(deck_data):
-    """Process a deck"""
-    if deck_data["investigator_code"] not in affinity_investigators:
-        inv_affinity = {}
+def missing_check(oper, uid):
+    """Return True if a card/deck is known to be missing from ArkhamDB"""
+    with missing_lock:
+        value = missing.get(oper, {}).get(str(uid))
+    if value is None:
+        return False
+    status, timestamp = value
+    if status == 404:
+        ttl = MISSING_TTL_NOT_FOUND
     else:
-        inv_affinity = affinity_investigators[deck_data["investigator_code"]]
-    # Increase investigator affinity value...
-    for slot in deck_data["slots"]:
-        # Increase the value for the current investigator
-        if inv_affinity.get(slot):
-            new_inv_value = inv_affinity[slot] + 1
-        else:
-            new_inv_value = 1
-        inv_affinity.update({slot: new_inv_value})
-        # Process each slot indidually...
-        for other_slot in deck_data["slots"]:
-            # We exclude own...
-            if other_slot != slot:
-                # We check if affinities already exists for this card...
-                if affinity_cards.get(slot):
-                    # If an affinity is found...
-                    if affinity_cards[slot].get(other_slot):
-                        # We increment exising value
-                        new_slot_value = affinity_cards[slot][other_slot] + 1
-                    else:
-                        # Else, value is forced to 1
-                        new_slot_value = 1
-                else:
-                    affinity_cards[slot] = {}
-                    new_slot_value = 1
-                affinity_cards[slot].update({other_slot: new_slot_value})
-        affinity_cards[slot] = dict_order_by_keys(affinity_cards[slot])
-    # Processing _after_ all slots were parse
-    # Put the investigator value back in the dict...
-    affinity_investigators.update(
-        {deck_data["investigator_code"]: dict_order_by_keys(inv_affinity)}
-    )
-
-
-def process_xp_deck(deck_data):
-    """Process a deck"""
-    if deck_data["investigator_code"] not in affinity_investigators_xp:
-        inv_affinity = {}
+        ttl = MISSING_TTL_TRANSIENT
+    return time.time() - timestamp < ttl
+
+
+def missing_add(oper, uid, status):
+    """Remember a card/deck is missing from ArkhamDB (status 0: no HTTP status)"""
+    with missing_lock:
+        missing.setdefault(oper, {})[str(uid)] = [status, int(time.time())]
+
+
+def cache_last_id(oper):
+    """Return the highest (numerical) ID in the cache (or its archive)"""
+    archived = archive_last_id(oper)
+    if CACHE_BACKEND == "files":
+        uids = [
+            int(file_name[: -len(".json")])
+            for file_name in os.listdir(DB_PATH + oper)
+            if file_name[: -len(".json")].isdigit()
+        ]
+        return max(uids + [archived])
+    with cache_lock:
+        row = (
+            cache_open()
+            .execute(
+                "SELECT MAX(CAST(uid AS INTEGER)) FROM cache WHERE oper = ?", (oper,)
+            )
+            .fetchone()
+        )
+    return max(row[0] or 0, archived)
+
+
+def cache_ids(oper):
+    """Return the (numerical) IDs in the cache (or its archive), sorted"""
+    if CACHE_BACKEND == "files":
+        uids = [
+            file_name[: -len(".json")]
+            for file_name in os.listdir(DB_PATH + oper)
+            if file_name.endswith(".json")
+        ]
     else:
-        inv_affinity = affinity_investigators_xp[deck_data["investigator_code"]]
-    # Increase investigator affinity value...
-    for slot in deck_data["slots"]:
-        # Increase the value for the current investigator
-        if inv_affinity.get(slot):
-            new_inv_value = inv_affinity[slot] + 1
-        else:
-            new_inv_value = 1
-        inv_affinity.update({slot: new_inv_value})
-        # Process each slot indidually...
-        for other_slot in deck_data["slots"]:
-            # We exclude own...
-            if other_slot != slot:
-                # We check if affinities already exists for this card...
-                if affinity_cards.get(slot):
-                    # If an affinity is found...
-                    if affinity_cards[slot].get(other_slot):
-                        # We increment exising value
-                        new_slot_value = affinity_cards[slot][other_slot] + 1
-                    else:
-                        # Else, value is forced to 1
-                        new_slot_value = 1
-                else:
-                    affinity_cards[slot] = {}
-                    new_slot_value = 1
-                affinity_cards[slot].update({other_slot: new_slot_value})
-        affinity_cards[slot] = dict_order_by_keys(affinity_cards[slot])
-    # Processing _after_ all slots were parse
-    # Put the investigator value back in the dict...
-    affinity_investigators_xp.update(
-        {deck_data["investigator_code"]: dict_order_by_keys(inv_affinity)}
+        with cache_lock:
+            uids = [
+                row[0]
+                for row in cache_open().execute(
+                    "SELECT uid FROM cache WHERE oper = ?", (oper,)
+                )
+            ]
+    uids = {int(uid) for uid in uids + archive_ids(oper) if uid.isdigit()}
+    return np.array(sorted(uids), np.int64)
+
+
+def cache_contains(oper, uid):
+    """Return True if a card/deck is in the cache (without reading it)"""
+    if archive_contains(oper, uid):
+        return True
+    if CACHE_BACKEND == "files":
+        return os.path.exists(cache_file_name(oper, uid))
+    if str(uid) in cache_preloaded.get(oper, {}):
+        return True
+    with cache_lock:
+        row = (
+            cache_open()
+            .execute("SELECT 1 FROM cache WHERE oper = ? AND uid = ?", (oper, str(uid)))
+            .fetchone()
+        )
+    return row is not None
+
+
+#
+# End of cache backend functions
+#
+# Start of cache archive functions
+#
+
+
+def archive_digest(content):
+    """Return the digest used to address/check the content of the archive"""
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def cache_items(oper):
+    """Return a generator of (uid, compact JSON) of the cache, ordered by ID
+    (cards/decks of the cache archive that aren't in the cache included)"""
+    if CACHE_BACKEND == "files":
+        file_names = [
+            file_name[: -len(".json")]
+            for file_name in os.listdir(DB_PATH + oper)
+            if file_name.endswith(".json")
+        ]
+        items = ((uid, file_to_json(cache_file_name(oper, uid))) for uid in file_names)
+        items = (
+            (uid, json.dumps(content, separators=(",", ":")).encode("utf-8"))
+            for uid, content in items
+        )
+    else:
+        with cache_lock:
+            rows = (
+                cache_open()
+                .execute("SELECT uid, payload FROM cache WHERE oper = ?", (oper,))
+                .fetchall()
+            )
+        items = ((uid, zlib.decompress(payload)) for uid, payload in rows)
+    items = dict(items)
+    archive = archive_open()
+    if archive is not None:
+        for uid, number in archive["index"]["entries"].get(oper, {}).items():
+            if uid not in items:
+                items[uid] = archive_payload(archive, number)
+    # Card codes (some aren't numbers) and deck IDs in order
+    for uid in sorted(items, key=lambda uid: (len(uid), uid)):
+        yield uid, items[uid]
+
+
+def archive_export(filename):
+    """
+    Write the cache (cards and decks) to an archive.
+
+    Identical payloads are only written once (addressed by their digest) in
+    zlib frames of about ARCHIVE_FRAME_SIZE bytes. The index (frames, payloads
+    and the payload of each card/deck) is written after the frames.
+
+    Returns:
+      The number of cards/decks and of (unique) payloads written.
+    """
+    index = {"version": 1, "frames": [], "payloads": [], "entries": {}}
+    payloads = {}  # Digest -> payload number
+    frame = []
+    frame_size = 0
+    with open(filename + ".tmp", "wb") as file:
+        file.write(ARCHIVE_MAGIC)
+
+        def write_frame():
+            compressed = zlib.compress(b"".join(frame), 9)
+            index["frames"].append(
+                [file.tell(), len(compressed), archive_digest(compressed)]
+            )
+            file.write(compressed)
+
+        for oper in ["card", "decklist"]:
+            entries = index["entries"].setdefault(oper, {})
+            for uid, content in cache_items(oper):
+                digest = archive_digest(content)
+                if digest not in payloads:
+                    payloads[digest] = len(index["payloads"])
+                    index["payloads"].append(
+                        [len(index["frames"]), frame_size, len(content), digest]
+                    )
+                    frame.append(content)
+                    frame_size = frame_size + len(content)
+                    if frame_size >= ARCHIVE_FRAME_SIZE:
+                        write_frame()
+                        frame, frame_size = [], 0
+                entries[uid] = payloads[digest]
+        if frame:
+            write_frame()
+        offset = file.tell()
+        content = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        content = zlib.compress(content, 9)
+        digest = bytes.fromhex(archive_digest(content))
+        file.write(content)
+        file.write(ARCHIVE_FOOTER.pack(offset, len(content), digest, ARCHIVE_MAGIC))
+    os.replace(filename + ".tmp", filename)
+    nb_entries = sum(len(entries) for entries in index["entries"].values())
+    logger.info(
+        "%d card(s)/deck(s) written to %s (%d unique payload(s), %d frame(s))",
+        nb_entries,
+        filename,
+        len(index["payloads"]),
+        len(index["frames"]),
     )
+    return nb_entries, len(index["payloads"])
+
+
+def archive_load(filename):
+    """
+    Return an archive written by archive_export (its index is checked).
+
+    Raises:
+      ValueError: The file isn't an archive or its index is corrupted.
+    """
+    file = open(filename, "rb")
+    try:
+        if file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError(filename + " isn't a cache archive")
+        file.seek(-ARCHIVE_FOOTER.size, os.SEEK_END)
+        footer = file.read(ARCHIVE_FOOTER.size)
+        offset, length, digest, magic = ARCHIVE_FOOTER.unpack(footer)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(filename + " is truncated")
+        file.seek(offset)
+        content = file.read(length)
+        if bytes.fromhex(archive_digest(content)) != digest:
+            raise ValueError(filename + ": the index is corrupted")
+        index = json.loads(zlib.decompress(content))
+    except (OSError, ValueError, zlib.error, struct.error) as error:
+        file.close()
+        raise ValueError(str(error)) from error
+    # Decompressed frames (the most recently used last)
+    return {"filename": filename, "file": file, "index": index, "frames": {}}
+
+
+def archive_open():
+    """Return the archive of the cache (None without --cache-archive)"""
+    global cache_archive, CACHE_ARCHIVE
+    if cache_archive is None and CACHE_ARCHIVE is not None:
+        with archive_lock:
+            if cache_archive is None:
+                try:
+                    cache_archive = archive_load(CACHE_ARCHIVE)
+                except ValueError as error:
+                    # Not used, the cards/decks are fetched again
+                    logger.error("%s, the archive is ignored.", error)
+                    CACHE_ARCHIVE = None
+    return cache_archive
+
+
+def archive_frame(archive, number):
+    """Return a decompressed frame of an archive (its checksum is checked)"""
+    with archive_lock:
+        frame = archive["frames"].pop(number, None)
+        if frame is None:
+            offset, length, digest = archive["index"]["frames"][number]
+            archive["file"].seek(offset)
+            compressed = archive["file"].read(length)
+            if archive_digest(compressed) != digest:
+                raise ValueError(f"{archive['filename']}: frame {number} is corrupted")
+            frame = zlib.decompress(compressed)
+            if len(archive["frames"]) >= ARCHIVE_FRAMES_KEPT:
+                del archive["frames"][next(iter(archive["frames"]))]
+        archive["frames"][number] = frame
+    return frame
+
+
+def archive_payload(archive, number):
+    """Return a payload (compact JSON) of an archive (its digest is checked)"""
+    frame, start, length, digest = archive["index"]["payloads"][number]
+    content = archive_frame(archive, frame)[start : start + length]
+    if archive_digest(content) != digest:
+        raise ValueError(f"{archive['filename']}: payload {number} is corrupted")
+    return content
+
+
+def archive_get(oper, uid):
+    """Return a card/deck from the archive of the cache, None if it's not in it"""
+    archive = archive_open()
+    if archive is None:
+        return None
+    number = archive["index"]["entries"].get(oper, {}).get(str(uid))
+    if number is None:
+        return None
+    try:
+        content = archive_payload(archive, number)
+    except ValueError as error:
+        # Corrupted, the card/deck is fetched again
+        logger.error("%s", error)
+        metrics_count("archive_errors_total")
+        return None
+    metrics_count("bytes_read_total", len(content), source="archive")
+    return json.loads(content)
+
+
+def archive_contains(oper, uid):
+    """Return True if a card/deck is in the archive of the cache"""
+    archive = archive_open()
+    return archive is not None and str(uid) in archive["index"]["entries"].get(oper, {})
+
+
+def archive_last_id(oper):
+    """Return the highest (numerical) ID in the archive of the cache"""
+    archive = archive_open()
+    if archive is None:
+        return 0
+    uids = archive["index"]["entries"].get(oper, {})
+    return max((int(uid) for uid in uids if uid.isdigit()), default=0)
+
+
+def archive_ids(oper):
+    """Return the IDs in the archive of the cache"""
+    archive = archive_open()
+    if archive is None:
+        return []
+    return list(archive["index"]["entries"].get(oper, {}))
+
+
+def archive_import(filename):
+    """Check every frame/payload of an archive, then copy it in the cache
+    (nothing is copied if the archive is corrupted)"""
+    try:
+        archive = archive_load(filename)
+        # Each payload is checked (and each frame) before anything is copied
+        for number in range(len(archive["index"]["payloads"])):
+            archive_payload(archive, number)
+    except ValueError as error:
+        logger.error("%s, nothing imported.", error)
+        return False
+    imported = 0
+    for oper, entries in archive["index"]["entries"].items():
+        for uid, number in entries.items():
+            content = archive_payload(archive, number)
+            if CACHE_BACKEND == "files":
+                cache_put(oper, uid, json.loads(content))
+            else:
+                # One transaction for the whole archive (like cache_migrate)
+                cache_open().execute(
+                    "INSERT OR REPLACE INTO cache (oper, uid, payload) "
+                    "VALUES (?, ?, ?)",
+                    (oper, uid, zlib.compress(content)),
+                )
+            imported = imported + 1
+    if CACHE_BACKEND != "files":
+        cache_open().commit()
+    archive["file"].close()
+    logger.info("%d card(s)/deck(s) imported from %s", imported, filename)
+    return True
 
 
 #
-# Main!
+# End of cache archive functions
+#
+# Start of asynchronous fetch functions
 #
 
 
-if __name__ == "__main__":
-    #
-    # Code begins here...
-    #
-    # Start time for statistics only
-    start_time = datetime.now()
-    print("Arkham Horror Analytics")
+def fetch_connection():
+    """Return a new (keep-alive) connection to ArkhamDB"""
+    url = urllib.parse.urlsplit(ARKHAM_DB_API)
+    if url.scheme == "https":
+        return http.client.HTTPSConnection(url.netloc, timeout=FETCH_TIMEOUT)
+    return http.client.HTTPConnection(url.netloc, timeout=FETCH_TIMEOUT)
 
-    # Load duplicate cards list
-    # @todo: Dynamically build it?
-    duplicates = file_to_json(DB_PATH + "other/duplicates.json")
 
-    # @todo: The last deck shouldn't be a fixed value.
-    list_of_deck = list(range(FIRST_DECK, LAST_DECK))
+def fetch_request(connection, path):
+    """Return the HTTP status and body of a request (blocking)"""
+    connection.request("GET", path)
+    response = connection.getresponse()
+    # The body must always be read to reuse the connection
+    return response.status, response.read()
 
-    # Fill the queue with the deck list
-    fill_queue(list_of_deck)
 
-    #
-    # Create threads that will execute workers
-    # This worker builds the generic stats
-    #
-    for t in range(NB_THREAD):
-        thread = threading.Thread(target=worker)
-        thread_list.append(thread)
+async def fetch_throttle(bucket):
+    """Wait until the rate limiter (token bucket) allows a new request"""
+    while True:
+        now = time.monotonic()
+        bucket["tokens"] = min(
+            FETCH_BURST, bucket["tokens"] + (now - bucket["updated"]) * FETCH_RATE
+        )
+        bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] = bucket["tokens"] - 1
+            return
+        await asyncio.sleep((1 - bucket["tokens"]) / FETCH_RATE)
+
 
-    # Start threads
-    for thread in thread_list:
-        thread.start()
+async def fetch_json(path, pool, bucket):
+    """Send a request to ArkhamDB (retried on errors), return the HTTP
+    status and the JSON content (None if the response isn't JSON)"""
+    status = 0
+    for attempt in range(FETCH_MAX_RETRIES):
+        if attempt:
+            metrics_count("http_retries_total", client="async")
+        await fetch_throttle(bucket)
+        connection = await pool.get()
+        # Requests in flight (connections taken from the pool)
+        metrics_observe(
+            "fetch_in_flight", FETCH_CONCURRENCY - pool.qsize(), buckets=DEPTH_BUCKETS
+        )
+        start = time.perf_counter()
+        try:
+            status, body = await asyncio.to_thread(fetch_request, connection, path)
+            metrics_count("bytes_read_total", len(body), source="network")
+        except (OSError, http.client.HTTPException):
+            # The connection is reopened on the next request
+            connection.close()
+            status = 0
+        finally:
+            pool.put_nowait(connection)
+        metrics_observe(
+            "http_request_seconds", time.perf_counter() - start, client="async"
+        )
+        metrics_count("http_requests_total", client="async", status=status)
+        if status == 200:
+            if not is_json(body):
+                return status, None
+            return status, json.loads(body)
+        # Not found, there's no point retrying...
+        if status == 404:
+            break
+        if attempt < FETCH_MAX_RETRIES - 1:
+            await asyncio.sleep(backoff_delay(FETCH_BACKOFF, attempt))
+    return status, None
 
-    # Make sure all threads are done
-    for thread in thread_list:
-        thread.join()
 
-    #
-    # Based on the raw stats execute workers
-    # Per investigators stats/data.
-    #
-    for item in affinity_investigators:
-        queue_inv_aff.put(item)
+async def fetch_one(oper, uid, pool, bucket):
+    """Fetch a card/deck from ArkhamDB, return None if missing (cached by
+    fetch_all)"""
+    path = urllib.parse.urlsplit(ARKHAM_DB_API).path + oper + "/" + str(uid) + ".json"
+    status, json_content = await fetch_json(path, pool, bucket)
+    if status != 200:
+        missing_add(oper, uid, status)
+        return None
+    return json_content
 
-    for t in range(NB_THREAD):
-        thread_aff = threading.Thread(target=worker_inv_aff)
-        thread_aff_list.append(thread_aff)
 
-    # Start threads
-    for thread in thread_aff_list:
-        thread.start()
+async def fetch_all(oper, uids, pool, bucket):
+    """Fetch the cards/decks missing from the cache and cache them, return
+    the ones found"""
+    uids = [
+        uid
+        for uid in uids
+        if not cache_contains(oper, uid) and not missing_check(oper, uid)
+    ]
+    results = await asyncio.gather(
+        *[fetch_one(oper, uid, pool, bucket) for uid in uids]
+    )
+    found = [(uid, result) for uid, result in zip(uids, results) if result is not None]
+    # A single commit, outside of the event loop (requests keep going)
+    await asyncio.to_thread(cache_put_many, oper, found)
+    logger.info("%d %s(s) fetched from ArkhamDB, %d found", len(uids), oper, len(found))
+    return [result for uid, result in found]
 
-    # Make sure all threads are done
-    for thread in thread_aff_list:
-        thread.join()
 
-    #
-    # Based on the raw stats execute workers
-    # Per investigators stats/data.
-    #
-    for item in affinity_investigators_xp:
-        queue_inv_aff.put(item)
+async def fetch_missing_async():
+    """Fill the cache with the decks (and their cards) missing from it"""
+    # Pool of keep-alive connections, its size caps the requests in flight
+    pool = asyncio.Queue()
+    for _ in range(FETCH_CONCURRENCY):
+        pool.put_nowait(fetch_connection())
+    bucket = {"tokens": FETCH_BURST, "updated": time.monotonic()}
+    # Cards used by the new decks (only their codes are kept)
+    codes = set()
+    # Decks are fetched by windows until the last deck is reached
+    last_found = deck_scan["last_found"]
+    window_start = deck_scan["next"]
+    while window_start <= last_found + MAX_CONSECUTIVE_MISSES:
+        window_stop = window_start + MAX_CONSECUTIVE_MISSES
+        if LAST_DECK is not None:
+            window_stop = min(window_stop, LAST_DECK)
+        if window_start >= window_stop:
+            break
+        window = range(window_start, window_stop)
+        for deck in await fetch_all("decklist", window, pool, bucket):
+            codes.add(deck["investigator_code"])
+            codes.update(deck["slots"])
+        for deck_id in reversed(window):
+            if cache_contains("decklist", deck_id):
+                last_found = max(last_found, deck_id)
+                break
+        window_start = window_stop
+    # The cards of the bulk card list are known
+    await fetch_all("card", catalog_unknown(codes), pool, bucket)
+    while not pool.empty():
+        pool.get_nowait().close()
 
-    for t in range(NB_THREAD):
-        thread_aff_xp = threading.Thread(target=worker_inv_aff_xp)
-        thread_aff_list_xp.append(thread_aff_xp)
 
-    # Start threads
-    for thread in thread_aff_list_xp:
-        thread.start()
+async def fetch_day(day, pool, bucket):
+    """Fetch the decks published on a day ("YYYY-MM-DD") and cache them,
+    return the codes of their cards (None if the request failed)"""
+    path = (
+        urllib.parse.urlsplit(ARKHAM_DB_API).path + "decklists/by_date/" + day + ".json"
+    )
+    status, decks = await fetch_json(path, pool, bucket)
+    if status != 200 or not isinstance(decks, list):
+        return None
+    cache_put_many("decklist", [(deck["id"], deck) for deck in decks])
+    metrics_count("decks_synced_total", len(decks))
+    codes = set()
+    for deck in decks:
+        codes.add(deck["investigator_code"])
+        codes.update(deck["slots"])
+    return codes
 
-    # Make sure all threads are done
-    for thread in thread_aff_list_xp:
-        thread.join()
 
-    #
-    # Post processing...
-    #
+async def fetch_by_date_async():
+    """
+    Fill the cache with the decks published since the last sync, one request
+    per day (the last day fully synced is kept in SYNC_STATE_PATH).
 
-    json_to_file(dict_order_by_keys(affinity_investigators), JSON_PATH + "aff_inv.json")
-    json_to_file(dict_order_by_keys(affinity_cards), JSON_PATH + "aff_cards.json")
-    json_to_file(
-        dict_order_by_keys(decks_grouped_by_hash),
-        JSON_PATH + "decks_grouped_by_hash.json",
+    Returns:
+      True if every day was fetched, the deck IDs missing from the cache
+      don't need to be fetched one by one.
+    """
+    today = datetime.strptime(time.strftime("%Y-%m-%d", time.gmtime()), "%Y-%m-%d")
+    state = file_to_json(SYNC_STATE_PATH) or {}
+    if "last_synced" in state:
+        first = datetime.strptime(state["last_synced"], "%Y-%m-%d") + timedelta(days=1)
+    else:
+        first = datetime.strptime(SYNC_FIRST_DATE, "%Y-%m-%d")
+    days = [
+        (first + timedelta(days=day)).strftime("%Y-%m-%d")
+        for day in range((today - first).days + 1)
+    ]
+    pool = asyncio.Queue()
+    for _ in range(FETCH_CONCURRENCY):
+        pool.put_nowait(fetch_connection())
+    bucket = {"tokens": FETCH_BURST, "updated": time.monotonic()}
+    results = await asyncio.gather(*[fetch_day(day, pool, bucket) for day in days])
+    failed = [day for day, codes in zip(days, results) if codes is None]
+    logger.info(
+        "%d day(s) of decks fetched from ArkhamDB, %d failed", len(days), len(failed)
     )
+    # Cards used by the new decks (the ones of the bulk card list are known)
+    codes = set()
+    for day_codes in results:
+        codes.update(day_codes or [])
+    await fetch_all("card", catalog_unknown(codes), pool, bucket)
+    while not pool.empty():
+        pool.get_nowait().close()
+    # Days are synced up to the first failed day (decks of the last days
+    # may still be published)
+    settled = (today - timedelta(days=SYNC_SETTLE_DAYS)).strftime("%Y-%m-%d")
+    synced = [day for day in days if day <= settled and day < min(failed + ["9999"])]
+    if synced:
+        json_to_file({"last_synced": synced[-1]}, SYNC_STATE_PATH)
+    return not failed
+
+
+#
+# End of asynchronous fetch functions
+#
+# Start of ArkhamDB specific functions
+#
+
+
+def arkhamdb_cache(oper, uid):
+    """ "Call Arkham DB cache"""
+    start = time.perf_counter()
+    json_to_return, tier = arkhamdb_lookup(oper, uid)
+    metrics_count("cache_lookups_total", oper=oper, tier=tier)
+    metrics_observe(
+        "cache_lookup_seconds", time.perf_counter() - start, oper=oper, tier=tier
+    )
+    return json_to_return
+
+
+def arkhamdb_lookup(oper, uid):
+    """
+    Return a card/deck from the disk cache or ArkhamDB (see arkhamdb_cache).
+    Cards are only looked up once, their attributes are kept in the card
+    catalog (see catalog_card).
+
+    Returns:
+      The card/deck ({} if missing) and where it was found: preload (read in
+      one pass from the packed cache), disk, missing (known to be missing
+      from ArkhamDB) or network.
+    """
+    tier = "preload" if str(uid) in cache_preloaded.get(oper, {}) else "disk"
+    # We try to get it from the cache...
+    json_to_return = cache_get(oper, uid)
+    # If it's not working...
+    if json_to_return is None:
+        # We already know it's not on ArkhamDB...
+        if missing_check(oper, uid):
+            return {}, "missing"
+        # Every published deck is in cache after a sync by date
+        if oper == "decklist" and SYNC_BY_DATE:
+            return {}, "missing"
+        # We try to get the info from ArkhamDB
+        tier = "network"
+        try:
+            response = open_url(ARKHAM_DB_API + oper + "/" + str(uid) + ".json")
+        except urllib.error.HTTPError as error:
+            missing_add(oper, uid, error.code)
+            return {}, tier
+        if response is None:
+            missing_add(oper, uid, 0)
+            return {}, tier
+        with response:
+            extracted_response = response.read()
+            metrics_count("bytes_read_total", len(extracted_response), source="network")
+            # We validate if the response is a valid JSON
+            if is_json(extracted_response):
+                json_content = json.loads(extracted_response)
+                # We save the content for future use
+                cache_put(oper, uid, json_content)
+                json_to_return = json_content
+            else:
+                json_to_return = {}
+    return json_to_return, tier
+
+
+def catalog_grow(size):
+    """Add default rows to the card catalog until it has `size` rows"""
+    while len(card_catalog["known"]) < size:
+        card_catalog["known"].append(0)
+        card_catalog["encounter"].append(0)
+        card_catalog["xp"].append(-1)
+        card_catalog["name"].append("")
+        card_catalog["faction"].append("")
+        card_catalog["type"].append("")
+        card_catalog["pack"].append("")
+
+
+def catalog_add(card):
+    """Add a card (ArkhamDB JSON) to the card catalog, return its card ID"""
+    index = card_id(card["code"])
+    with catalog_lock:
+        catalog_grow(index + 1)
+        card_catalog["known"][index] = 1
+        card_catalog["encounter"][index] = 1 if card.get("encounter_code") else 0
+        if isinstance(card.get("xp"), int):
+            card_catalog["xp"][index] = card["xp"]
+        card_catalog["name"][index] = card.get("name", card["code"])
+        card_catalog["faction"][index] = card.get("faction_code", "")
+        card_catalog["type"][index] = card.get("type_code", "")
+        card_catalog["pack"][index] = card.get("pack_code", "")
+        if card.get("type_code") == "investigator":
+            card_catalog["back_flavor"][index] = check_var_in_dict(card, "back_flavor")
+        if card.get("duplicate_of_code"):
+            card_catalog["duplicate_of"][index] = card["duplicate_of_code"]
+    return index
+
+
+def catalog_download(path, filename, refresh=False):
+    """
+    Return a list of ArkhamDB (cards, packs...), downloaded after CARD_CATALOG_TTL.
+
+    Args:
+      path: API path of the list.
+      filename: Local copy of the list (gzip compressed JSON).
+      refresh: Download the list even if the local copy is up to date.
+
+    Returns:
+      The list, None if it can't be downloaded and there's no local copy.
+    """
+    content = None
+    try:
+        fresh = time.time() - os.path.getmtime(filename) < CARD_CATALOG_TTL
+    except OSError:
+        fresh = False
+    if refresh or not fresh:
+        try:
+            response = open_url(ARKHAM_DB_API + path)
+        except urllib.error.HTTPError:
+            response = None
+        if response is not None:
+            with response:
+                extracted_response = response.read()
+            metrics_count("bytes_read_total", len(extracted_response), source="network")
+            if is_json(extracted_response):
+                content = json.loads(extracted_response)
+                with gzip.open(filename + ".tmp", "wt", encoding="utf-8") as file:
+                    json.dump(content, file, separators=(",", ":"))
+                os.replace(filename + ".tmp", filename)
+    # We use the file (even if it's outdated) when ArkhamDB can't be reached
+    if content is None and os.path.exists(filename):
+        with gzip.open(filename, "rt", encoding="utf-8") as file:
+            content = json.load(file)
+    return content
+
+
+def catalog_load(refresh=False):
+    """Load every card of ArkhamDB in the card catalog (one request/file)"""
+    cards = catalog_download("cards/?encounter=1", CARD_CATALOG_PATH, refresh)
+    for card in cards or []:
+        catalog_add(card)
+    rules_compile(cards or [])
+    logger.info("%d cards loaded in the card catalog", len(cards or []))
+
+
+def packs_load(refresh=False):
+    """Return the release month of the packs of ArkhamDB ({pack code: "YYYY-MM"})"""
+    packs = catalog_download("packs/", PACKS_PATH, refresh)
+    return {
+        pack["code"]: pack["available"][:7]
+        for pack in packs or []
+        if pack.get("available")
+    }
+
+
+def catalog_card(code):
+    """Return the card ID of a card, with its attributes in the card catalog"""
+    index = card_id(code)
+    if index < len(card_catalog["known"]) and card_catalog["known"][index]:
+        return index
+    # The card isn't in the bulk card list (new card?), only one thread
+    # fetches it
+    with catalog_lock:
+        if index < len(card_catalog["known"]) and card_catalog["known"][index]:
+            return index
+        card = arkhamdb_cache("card", code)
+        return catalog_add(dict(card, code=code))
+
+
+def catalog_unknown(codes):
+    """Return the card codes that aren't in the card catalog (sorted)"""
+    known = card_catalog["known"]
+    return sorted(
+        code
+        for code in codes
+        if card_id(code) >= len(known) or not known[card_id(code)]
+    )
+
+
+def card_name(code):
+    """Return the name of a card"""
+    return card_catalog["name"][catalog_card(code)]
+
+
+def card_xp(code):
+    """Return the XP of a card (-1 if the card has no XP)"""
+    return card_catalog["xp"][catalog_card(code)]
+
+
+def duplicates_load():
+    """Return the duplicate cards list (reprint -> original card), read-only"""
+    return types.MappingProxyType(file_to_json(DUPLICATES_PATH) or {})
+
+
+def duplicates_resolve(duplicate_of):
+    """Return a duplicate cards list where a reprint of a reprint is replaced
+    by the first printing"""
+    resolved = {}
+    for code, original in duplicate_of.items():
+        seen = {code}
+        while original in duplicate_of and original not in seen:
+            seen.add(original)
+            original = duplicate_of[original]
+        resolved[code] = original
+    return dict_order_by_keys(resolved)
+
+
+def duplicates_build():
+    """Return the duplicate cards list built from the card catalog"""
+    return duplicates_resolve(
+        {
+            card_codes[index]: code
+            for index, code in card_catalog["duplicate_of"].items()
+        }
+    )
+
+
+def duplicates_diff(current, generated):
+    """Return the differences between two duplicate cards lists"""
+    return {
+        "added": {code: generated[code] for code in generated if code not in current},
+        "removed": {code: current[code] for code in current if code not in generated},
+        "changed": {
+            code: [current[code], generated[code]]
+            for code in generated
+            if code in current and current[code] != generated[code]
+        },
+    }
+
+
+def duplicates_update(prune=False):
+    """
+    Add the reprints of the card catalog to the duplicate cards list.
+
+    Args:
+      prune: Also remove the entries that aren't reprints in the card catalog
+        (by default, entries added by hand are kept).
+    """
+    if not card_catalog["duplicate_of"]:
+        logger.warning(
+            "No reprint found in the card catalog, duplicates.json not updated."
+        )
+        return
+    generated = duplicates_build()
+    updated = generated
+    if not prune:
+        updated = duplicates_resolve({**duplicates, **generated})
+    diff = duplicates_diff(duplicates, updated)
+    logger.info("%s", json.dumps(diff, indent=4))
+    json_to_file(updated, DUPLICATES_PATH)
+    logger.info(
+        "duplicates.json updated: %d added, %d removed, %d changed.",
+        len(diff["added"]),
+        len(diff["removed"]),
+        len(diff["changed"]),
+    )
+    kept = len(updated) - len(generated)
+    if kept:
+        logger.info(
+            "%d entries that aren't reprints in ArkhamDB kept, use "
+            "--prune-duplicates to remove them.",
+            kept,
+        )
+
+
+def deck_deduplicate(slots):
+    """Replace duplicate card ID with their original ID (and tell if any was)"""
+    dedup_dict = {}
+    replaced = False
+    for slot in slots:
+        original = duplicates.get(slot, slot)
+        if original != slot:
+            replaced = True
+        dedup_dict.update({original: slots[slot]})
+    return dedup_dict, replaced
+
+
+def deck_fingerprint(slots):
+    """Return the hash of a deck (same cards and quantities, same hash)"""
+    # Stable encoding ("code=quantity;" ordered by card code), unlike pickle
+    # which can change between Python versions
+    packed = "".join(
+        code + "=" + str(slots[code]) + ";" for code in sorted(slots)
+    ).encode("ascii")
+    # Same length as the md5 hashes used before (32 hex digits)
+    return hashlib.blake2b(packed, digest_size=16).hexdigest()
+
+
+def filter_out_cards(slots):
+    # @todo: Add cleaning/filtering of decks before processing
+    #        - remove non player cards (Partial!)
+    #        - basic random weakness card (DONE!)
+    #        - basic weakness
+    #        - scenario cards (Partial!)
+    """Filter out useless cards..."""
+    output_slots = {}
+    for slot in slots:
+        reject = False
+        if slot == "01000":  # Random basic weakness
+            reject = True
+        # Reject Encounter cards
+        if card_catalog["encounter"][catalog_card(slot)]:
+            reject = True
+        # Card wasn't rejected...
+        if not reject:
+            output_slots.update({slot: slots[slot]})
+    return output_slots
+
+
+def deck_level(slots):
+    """Return the XP spent in a deck ({card code: quantity})"""
+    total_xp = 0
+    for slot in slots:
+        xp = card_xp(slot)
+        if xp > 0:
+            total_xp = total_xp + xp * slots[slot]
+    return total_xp
+
+
+def deck_month(deck_data):
+    """Return the month of a deck ("YYYY-MM", ArkhamDB dates are UTC)"""
+    return (deck_data.get("date_creation") or MONTH_UNKNOWN)[:7]
+
+
+def deck_meta(deck_data):
+    """Return the deckbuilding choices of a deck (RULES_META_KEYS of its
+    meta, a JSON string)"""
+    meta = deck_data.get("meta") or {}
+    if isinstance(meta, str):
+        try:
+            meta = json.loads(meta)
+        except ValueError:
+            return {}
+    if not isinstance(meta, dict):
+        return {}
+    return {
+        key: meta[key]
+        for key in RULES_META_KEYS
+        if isinstance(meta.get(key), str) and meta[key]
+    }
+
+
+def next_deck_id():
+    """Return the next deck ID to parse, None once the last deck is reached"""
+    with deck_scan_lock:
+        if deck_scan["retry"]:
+            return deck_scan["retry"].pop(0)
+        deck_id = deck_scan["next"]
+        if deck_scan["stop"] is not None and deck_id >= deck_scan["stop"]:
+            return None
+        # Too many missing decks in a row, we reached the last deck
+        if deck_id > deck_scan["last_found"] + MAX_CONSECUTIVE_MISSES:
+            return None
+        deck_scan["next"] = deck_id + 1
+    return deck_id
+
+
+def deck_found(deck_id):
+    """Move the last deck found forward (used to detect the last deck)"""
+    with deck_scan_lock:
+        if deck_id > deck_scan["last_found"]:
+            deck_scan["last_found"] = deck_id
+
+
+class Deck:
+    """
+    Slim record of a deck, built by deck_record (the ArkhamDB JSON of the
+    deck isn't kept).
+
+    Cards are card IDs (see card_id), quantities and ignored (copies not
+    counted in the deck limit, None if there's none) are parallel arrays.
+    Rules is the row of its deckbuilding rules (see rules_row).
+    Representatives of groups of identical decks only keep their cards
+    (without duplicate cards, see deck_representative).
+    """
+
+    __slots__ = (
+        "id",
+        "investigator_code",
+        "month",
+        "xp_deck",
+        "cards",
+        "quantities",
+        "ignored",
+        "rules",
+    )
+
+    def __init__(
+        self,
+        deck_id,
+        investigator_code,
+        month,
+        cards,
+        quantities=None,
+        ignored=None,
+        rules=None,
+    ):
+        self.id = deck_id
+        self.investigator_code = investigator_code
+        self.month = month
+        self.xp_deck = False
+        self.cards = cards
+        self.quantities = quantities
+        self.ignored = ignored
+        self.rules = rules
+
+    def slots(self):
+        """Return the cards of the deck ({card code: quantity})"""
+        return {
+            card_codes[index]: quantity
+            for index, quantity in zip(self.cards, self.quantities)
+        }
+
+
+def deck_record(content):
+    """Return the record of a deck (ArkhamDB JSON), only with the cards kept
+    by filter_out_cards"""
+    slots = filter_out_cards(content["slots"])
+    ignored = content.get("ignoreDeckLimitSlots") or {}
+    return Deck(
+        content["id"],
+        sys.intern(content["investigator_code"]),
+        deck_month(content),
+        array("H", map(card_id, slots)),
+        array("H", slots.values()),
+        array("H", [ignored.get(code, 0) for code in slots]) if ignored else None,
+        rules_row(content["investigator_code"], deck_meta(content)),
+    )
+
+
+def deck_representative(deck, slots):
+    """Turn a deck into the representative of its group (its slots without
+    duplicate cards are enough to add/remove it from the affinities)"""
+    deck.xp_deck = deck_level(slots) != 0
+    deck.cards = array("H", map(card_id, slots))
+    deck.quantities = None
+    deck.ignored = None
+    deck.rules = None
+    return deck
+
+
+def deck_parse(deck):
+    """
+    Check and hash a deck (see deck_record).
+
+    Returns:
+      The problems of the deck (empty if it's legal, None if it can't be
+      checked), its hash and its slots without duplicate cards (None if it's
+      illegal).
+    """
+    # Illegal decks aren't counted in the affinities
+    problems = deck_problems(deck)
+    if problems:
+        logger.debug("Deck %d is illegal: %s", deck.id, "; ".join(problems))
+        return problems, None, None
+    if problems is None:
+        logger.debug("Deck %d can't be checked, it's counted", deck.id)
+    # Check if the deck contains duplicate
+    # Replace duplicated cards in deck
+    dedup_slots, replaced = deck_deduplicate(deck.slots())
+    if replaced:
+        # Display a message when cards we replaced in a deck
+        # after depulication
+        logger.debug(
+            "Cards in deck %05d were replaced by their original card ID.", deck.id
+        )
+    return problems, deck_fingerprint(dedup_slots), dedup_slots
+
+
+def deck_aggregate(aggregate, deck, problems, deck_hash, slots):
+    """Add a deck parsed by deck_parse to aggregates (see new_aggregate)"""
+    decks_grouped_by_hash = aggregate["decks_grouped_by_hash"]
+    aggregate["valid_decks"].append(deck.id)
+    if problems:
+        aggregate["invalid_decks"][deck.id] = problems
+        metrics_count("decks_total", result="invalid")
+        return
+    if problems is None:
+        aggregate["unchecked_decks"].append(deck.id)
+        metrics_count("decks_unchecked_total")
+    # The same deck exists...
+    if deck_hash in decks_grouped_by_hash:
+        metrics_count("decks_total", result="duplicate")
+        # Diplay a message with duplicated deck IDs
+        logger.debug(
+            "Deck %d is identical to: %s", deck.id, decks_grouped_by_hash[deck_hash]
+        )
+        # Group duplicated decks together
+        decks_grouped_by_hash[deck_hash] = sorted(
+            decks_grouped_by_hash[deck_hash] + [deck.id]
+        )
+        # Decks can be out of order (pipeline), the lowest ID is counted
+        if deck.id < aggregate["deck_representatives"][deck_hash].id:
+            remove_deck(aggregate["deck_representatives"][deck_hash], aggregate)
+            aggregate["deck_representatives"][deck_hash] = deck_representative(
+                deck, slots
+            )
+            with metrics_timer("affinity_seconds"):
+                process_deck(aggregate, deck)
+    else:
+        decks_grouped_by_hash[deck_hash] = [deck.id]
+        # Keep what's needed to remove this deck from the affinities
+        # if a deck with a lower ID is found by another worker
+        aggregate["deck_representatives"][deck_hash] = deck_representative(deck, slots)
+        metrics_count("decks_total", result="unique")
+        # Process starter decks and non-starter decks...
+        with metrics_timer("affinity_seconds"):
+            process_deck(aggregate, deck)
+
+
+def worker(aggregate):
+    """Main worker function (fills its own aggregates, see new_aggregate)"""
+    # We process decks until the last one is reached...
+    while True:
+        deck_id = next_deck_id()
+        if deck_id is None:
+            break
+        start = time.perf_counter()
+        # Open/clost the deck file
+        content = arkhamdb_cache("decklist", deck_id)
+        if len(content):
+            deck_found(deck_id)
+            logger.debug(
+                "Deck being parsed: %d (%s)", deck_id, content["investigator_name"]
+            )
+            deck = deck_record(content)
+            deck_aggregate(aggregate, deck, *deck_parse(deck))
+            metrics_observe("deck_seconds", time.perf_counter() - start)
+
+
+def pipeline_preload(deck_id):
+    """Read the cached decks of the windows of PIPELINE_PRELOAD deck IDs up to
+    a deck in one pass (decks are removed once read, only the windows being
+    fetched are in memory). Decks to try again are read one by one."""
+    with preload_lock:
+        while deck_id >= deck_scan["preloaded"]:
+            start = deck_scan["preloaded"]
+            stop = start + PIPELINE_PRELOAD
+            if deck_scan["stop"] is not None:
+                stop = min(stop, deck_scan["stop"])
+            cache_preload("decklist", after=start - 1, before=stop)
+            deck_scan["preloaded"] = stop
+
+
+def pipeline_failed(stage, deck_id):
+    """Log a deck a stage of the pipeline failed on (the stage goes on with the
+    next deck), it's tried again on the next run (see checkpoint_save)"""
+    logger.exception("Deck %d failed in the %s stage", deck_id, stage)
+    metrics_count("pipeline_errors_total", stage=stage)
+    missing_add("decklist", deck_id, 0)
+
+
+def pipeline_fetch(parse_queue):
+    """Fetch stage of the pipeline: read/fetch the decks until the last one"""
+    while True:
+        deck_id = next_deck_id()
+        if deck_id is None:
+            return
+        start = time.perf_counter()
+        try:
+            pipeline_preload(deck_id)
+            content = arkhamdb_cache("decklist", deck_id)
+            if not len(content):
+                continue
+            deck_found(deck_id)
+            logger.debug(
+                "Deck being parsed: %d (%s)", deck_id, content["investigator_name"]
+            )
+            deck = deck_record(content)
+        except Exception:
+            pipeline_failed("fetch", deck_id)
+            continue
+        # Only the record of the deck is queued, waits while the parsers
+        # are behind
+        parse_queue.put((start, deck))
+
+
+def pipeline_parse(parse_queue, aggregate_queue):
+    """Parse stage of the pipeline: filter, check and hash the decks"""
+    while True:
+        item = parse_queue.get()
+        if item is None:
+            return
+        # Decks waiting to be parsed (full queue: the fetchers wait)
+        metrics_observe(
+            "pipeline_queue_depth",
+            parse_queue.qsize(),
+            buckets=DEPTH_BUCKETS,
+            stage="parse",
+        )
+        start, deck = item
+        try:
+            parsed = deck_parse(deck)
+        except Exception:
+            pipeline_failed("parse", deck.id)
+            continue
+        aggregate_queue.put((start, deck, *parsed))
+
+
+def pipeline_aggregate(aggregate_queue, aggregate):
+    """Aggregate stage of the pipeline (a single thread, it owns `aggregate`)"""
+    while True:
+        item = aggregate_queue.get()
+        if item is None:
+            return
+        metrics_observe(
+            "pipeline_queue_depth",
+            aggregate_queue.qsize(),
+            buckets=DEPTH_BUCKETS,
+            stage="aggregate",
+        )
+        start, deck, problems, deck_hash, slots = item
+        try:
+            deck_aggregate(aggregate, deck, problems, deck_hash, slots)
+        except Exception:
+            pipeline_failed("aggregate", deck.id)
+            continue
+        metrics_observe("deck_seconds", time.perf_counter() - start)
+
+
+def pipeline_run(fetchers=NB_THREAD, parsers=PIPELINE_PARSERS):
+    """
+    Parse the decks not parsed yet with a pipeline of threads, return the
+    aggregates (see new_aggregate).
+
+    Fetchers read the decks from the cache (or ArkhamDB) and feed the
+    parsers, which feed a single aggregator. Queues between the stages are
+    bounded (PIPELINE_QUEUE_SIZE decks), a stage waits while the next one is
+    behind. Each stage is stopped by a None (one per thread) once the
+    previous stage is done. A deck a stage fails on is logged and skipped
+    (see pipeline_failed), the other decks are parsed.
+    """
+    parse_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+    aggregate_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+    aggregate = new_aggregate()
+    deck_scan["preloaded"] = deck_scan["next"]
+    stages = [
+        [
+            threading.Thread(target=pipeline_fetch, args=(parse_queue,))
+            for _ in range(fetchers)
+        ],
+        [
+            threading.Thread(target=pipeline_parse, args=(parse_queue, aggregate_queue))
+            for _ in range(parsers)
+        ],
+        [
+            threading.Thread(
+                target=pipeline_aggregate, args=(aggregate_queue, aggregate)
+            )
+        ],
+    ]
+    for threads in stages:
+        for thread in threads:
+            thread.start()
+    for threads, next_queue, next_threads in zip(
+        stages, [parse_queue, aggregate_queue, None], stages[1:] + [[]]
+    ):
+        for thread in threads:
+            thread.join()
+        for _ in next_threads:
+            next_queue.put(None)
+    return aggregate
+
+
+def replace_text(text, replacements):
+    """
+    Replace text based on a list of replacement pairs.
+
+    Args:
+      text: Original text.
+      replacement: List of tuples, each tuple contains a regex pattern and its replacement.
+
+    Returns:
+      The modified text.
+    """
+    for pattern, replacement in replacements:
+        text = re.sub(pattern, replacement, text)
+    return text
+
+
+@functools.lru_cache(maxsize=None)
+def report_file_name(name):
+    """Return the file name (without extension) of the reports of an investigator"""
+    return unidecode("inv_aff_" + replace_text(name, fname_txt_replacements))
+
+
+def write_if_changed(content, filename):
+    """Write content to a file (atomically) unless it already contains it"""
+    try:
+        with open(filename, encoding="utf-8") as file:
+            if file.read() == content:
+                return False
+    except IOError:
+        pass
+    write_to_file(content, filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
+    return True
+
+
+def render_investigator(inv, xp_report):
+    """
+    Render the text and HTML card affinity reports of an investigator.
+
+    Args:
+      inv: Investigator card code.
+      xp_report: False for every card, True for the XP cards only.
+
+    Returns:
+      The number of files written (reports left unchanged aren't written).
+    """
+    start = time.perf_counter()
+    if xp_report:
+        affinity = affinity_investigators_xp[inv]
+        relevance = RELEVANCE / 2
+    else:
+        affinity = affinity_investigators[inv]
+        relevance = RELEVANCE
+    reorg = sorted(dict_order_by_keys(affinity).items(), key=value_getter, reverse=True)
+    name = card_name(inv)
+    suffix = REPORT_SUFFIX[xp_report]
+    txt_output = [REPORT_TXT_HEADER.substitute(name=name, suffix=suffix["txt"])]
+    html_output = [
+        REPORT_HTML_HEADER.substitute(
+            name=name,
+            kind=suffix["html"],
+            back_flavor=card_catalog["back_flavor"].get(card_id(inv), "N/A"),
+            code=inv,
+        )
+    ]
+    max_value = 0  # We set the max value to zero
+    for code, value in reorg:
+        # Increment max value if necessary...
+        if value > max_value:
+            max_value = value
+            html_output.append(REPORT_HTML_STATS.substitute(decks=max_value))
+        if xp_report and card_xp(code) <= 0:
+            continue
+        # Only keep the cards that are used in more than 10% of the decks
+        # (5% for the XP cards)
+        if value > (max_value * relevance):
+            html_output.append(REPORT_HTML_CARD.substitute(code=code))
+            # With card ID
+            txt_output.append(
+                REPORT_TXT_CARD.substitute(
+                    name=card_name(code),
+                    code=code,
+                    value=value,
+                    percent=round(value * 100 / max_value, 1),
+                )
+            )
+    file_name = report_file_name(name) + suffix["file"]
+    written = write_if_changed("".join(txt_output), TEXT_PATH + file_name + ".txt")
+    written += write_if_changed("".join(html_output), HTML_PATH + file_name + ".html")
+    report = REPORT_SUFFIX[xp_report]["file"][1:] or "base"
+    metrics_count("reports_total", written, report=report, result="written")
+    metrics_count("reports_total", 2 - written, report=report, result="unchanged")
+    metrics_observe("render_seconds", time.perf_counter() - start, report=report)
+    return written
+
+
+def render_reports():
+    """Render the reports of every investigator (a thread pool), return the
+    number of files written"""
+    reports = [(inv, False) for inv in affinity_investigators]
+    reports += [(inv, True) for inv in affinity_investigators_xp]
+    with ThreadPoolExecutor(NB_THREAD) as executor:
+        return sum(executor.map(lambda report: render_investigator(*report), reports))
+
+
+def card_id(code):
+    """Return the (dense) integer ID of a card code, interned on first use"""
+    index = card_ids.get(code)
+    if index is None:
+        with card_ids_lock:
+            index = card_ids.get(code)
+            if index is None:
+                index = len(card_codes)
+                card_codes.append(code)
+                card_ids[code] = index
+    return index
+
+
+def new_card_matrix():
+    """Return an empty card to card affinity matrix (see affinity_cards)"""
+    return {
+        "keys": np.zeros(0, dtype=np.int64),
+        "counts": np.zeros(0, dtype=np.int64),
+        "pending": [],
+        "pending_size": 0,
+    }
+
+
+def card_pairs(ids):
+    """Return the matrix keys of every pair of different cards"""
+    ids = np.asarray(ids, dtype=np.int64)
+    keys = (ids[:, None] << 32) | ids[None, :]
+    # We exclude own...
+    return keys[~np.eye(len(ids), dtype=bool)]
+
+
+def card_matrix_add(matrix, keys, counts):
+    """Add counts to pairs of cards (by batches of CARD_MATRIX_BATCH pairs)"""
+    matrix["pending"].append((keys, counts))
+    matrix["pending_size"] = matrix["pending_size"] + len(keys)
+    if matrix["pending_size"] >= CARD_MATRIX_BATCH:
+        card_matrix_flush(matrix)
+
+
+def card_matrix_flush(matrix):
+    """Add the pending pairs of cards to the matrix"""
+    if not matrix["pending"]:
+        return
+    keys = np.concatenate([matrix["keys"]] + [k for k, c in matrix["pending"]])
+    counts = np.concatenate([matrix["counts"]] + [c for k, c in matrix["pending"]])
+    # Sum the counts of identical keys (COO to sorted/unique keys)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+    counts = counts.astype(np.int64)
+    # Counts can go back to zero when a deck is removed (see remove_deck)
+    matrix["keys"] = keys[counts != 0]
+    matrix["counts"] = counts[counts != 0]
+    matrix["pending"] = []
+    matrix["pending_size"] = 0
+
+
+def card_matrix_csr(matrix):
+    """Return the matrix in CSR format: (row pointers, column IDs, counts)"""
+    card_matrix_flush(matrix)
+    rows = matrix["keys"] >> 32
+    columns = matrix["keys"] & 0xFFFFFFFF
+    # Row X is between indptr[X] and indptr[X + 1]
+    indptr = np.searchsorted(rows, np.arange(len(card_codes) + 1))
+    return indptr, columns, matrix["counts"]
+
+
+def card_matrix_rows(matrix):
+    """Return a generator of (card code, {card code: count}) ordered by codes"""
+    indptr, columns, counts = card_matrix_csr(matrix)
+    rows = np.flatnonzero(np.diff(indptr)).tolist()
+    for row in sorted(rows, key=card_codes.__getitem__):
+        start, stop = indptr[row], indptr[row + 1]
+        yield card_codes[row], dict_order_by_keys(
+            dict(
+                zip(
+                    [card_codes[column] for column in columns[start:stop].tolist()],
+                    counts[start:stop].tolist(),
+                )
+            )
+        )
+
+
+def card_matrix_merge(matrix, source, source_codes):
+    """Add the counts of a matrix (with card IDs of another process) to another one"""
+    card_matrix_flush(source)
+    # Same process, card IDs are the same
+    if source_codes is card_codes:
+        card_matrix_add(matrix, source["keys"], source["counts"])
+        return
+    # Card IDs of the source are converted to our own card IDs
+    mapping = np.array([card_id(code) for code in source_codes], dtype=np.int64)
+    rows = mapping[source["keys"] >> 32]
+    columns = mapping[source["keys"] & 0xFFFFFFFF]
+    card_matrix_add(matrix, (rows << 32) | columns, source["counts"])
+
+
+def new_month_bucket():
+    """Return the empty aggregates of a month (or a window of months)"""
+    return {
+        "base": {},  # Inv. Base card affinity
+        "xp": {},  # Inv. XP card affinity
+        "decks": {},  # Number of base decks of each investigator
+        "decks_xp": {},  # Number of XP decks of each investigator
+    }
+
+
+def process_deck(aggregate, deck, increment=1):
+    """Process a deck representative (increment -1 removes a deck already processed)"""
+    month = deck.month
+    xp_deck = deck.xp_deck
+    slots = [card_codes[index] for index in deck.cards]
+    bucket = aggregate["affinity_months"].setdefault(month, new_month_bucket())
+    if xp_deck:
+        affinities = aggregate["affinity_investigators_xp"]
+        bucket_decks = bucket["decks_xp"]
+    else:
+        affinities = aggregate["affinity_investigators"]
+        bucket_decks = bucket["decks"]
+    inv = deck.investigator_code
+    # Increase investigator affinity value (all time and month of the deck)...
+    for affinities in [affinities, bucket["xp" if xp_deck else "base"]]:
+        inv_affinity = affinities.setdefault(inv, {})
+        for slot in slots:
+            inv_affinity[slot] = inv_affinity.get(slot, 0) + increment
+            if not inv_affinity[slot]:
+                del inv_affinity[slot]
+        if not inv_affinity:
+            del affinities[inv]
+    bucket_decks[inv] = bucket_decks.get(inv, 0) + increment
+    if not bucket_decks[inv]:
+        del bucket_decks[inv]
+    if not any(bucket.values()):
+        del aggregate["affinity_months"][month]
+    # Card to card affinity of every pair of cards of the deck
+    keys = card_pairs(deck.cards)
+    card_matrix_add(
+        aggregate["affinity_cards"], keys, np.full(len(keys), increment, np.int64)
+    )
+
+
+def checkpoint_digest():
+    """Return a digest of everything used to compute the aggregates of a deck"""
+    digest = hashlib.sha256()
+    digest.update(str(CHECKPOINT_VERSION).encode("utf-8"))
+    digest.update(json.dumps(dict_order_by_keys(duplicates)).encode("utf-8"))
+    # Any change to the deckbuilding rules (constants or card list) too
+    digest.update(
+        json.dumps(
+            [
+                sorted(RULES_OPTION_KEYS),
+                RULES_META_KEYS,
+                ALLOWANCE_OPTIONS,
+                DECK_SIZE_MARGIN,
+                deck_rules["digest"],
+            ],
+            sort_keys=True,
+        ).encode("utf-8")
+    )
+    # Any change to the filtering/processing code invalidates the checkpoint
+    for function in [
+        filter_out_cards,
+        deck_deduplicate,
+        deck_fingerprint,
+        deck_level,
+        process_deck,
+        deck_store_aggregate,
+        rules_card_attributes,
+        rules_option_mask,
+        rules_compile,
+        legality_check,
+        deck_problems,
+        deck_meta,
+        rules_variants,
+        rules_row,
+        rules_digest,
+    ]:
+        digest.update(inspect.getsource(function).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def checkpoint_save():
+    """Save the aggregates and the last deck parsed for the next run"""
+    parsed = set(valid_decks)
+    # Decks that failed for another reason than a 404 are tried again
+    retry = sorted(
+        int(uid)
+        for uid, (status, timestamp) in missing.get("decklist", {}).items()
+        if status != 404
+        and int(uid) < deck_scan["last_found"]
+        and int(uid) not in parsed
+    )
+    state = aggregate_state()
+    state.update(
+        {
+            "digest": checkpoint_digest(),
+            "last_deck": deck_scan["last_found"],
+            "retry": retry,
+        }
+    )
+    aggregate_dump(state, CHECKPOINT_PATH)
+
+
+def checkpoint_load():
+    """Restore the aggregates of the previous run (False if there's none)"""
+    if not os.path.exists(CHECKPOINT_PATH):
+        return False
+    try:
+        state = aggregate_read(CHECKPOINT_PATH)
+    except ValueError as error:
+        logger.warning("%s, all decks will be parsed.", error)
+        return False
+    merge_aggregate(state)
+    deck_scan["next"] = state["last_deck"] + 1
+    deck_scan["last_found"] = state["last_deck"]
+    deck_scan["retry"] = state["retry"]
+    logger.info(
+        "Checkpoint loaded: %d decks already parsed (last deck: %d).",
+        len(valid_decks),
+        state["last_deck"],
+    )
+    return True
+
+
+def aggregate_dump(state, filename):
+    """Write aggregates (checkpoint, partials) to a gzip pickle. Deck
+    representatives are written as tuples, the file doesn't refer to the
+    Deck class (of __main__ or arkham) and any script can read it."""
+    representatives = {
+        deck_hash: (
+            deck.id,
+            deck.investigator_code,
+            deck.month,
+            deck.xp_deck,
+            deck.cards,
+        )
+        for deck_hash, deck in state["deck_representatives"].items()
+    }
+    with gzip.open(
+        filename + ".tmp", "wb", compresslevel=CHECKPOINT_COMPRESSLEVEL
+    ) as file:
+        pickle.dump(dict(state, deck_representatives=representatives), file)
+    os.replace(filename + ".tmp", filename)
+
+
+def aggregate_read(filename):
+    """
+    Return aggregates written by aggregate_dump.
+
+    Raises:
+      ValueError: The file can't be read or was written by another version
+        of the script (or with other duplicates/rules).
+    """
+    try:
+        with gzip.open(filename, "rb") as file:
+            state = pickle.load(file)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError) as error:
+        raise ValueError(f"{filename} can't be read ({error})") from error
+    # Duplicates or filtering rules changed, every deck must be parsed again
+    if not isinstance(state, dict) or state.get("digest") != checkpoint_digest():
+        raise ValueError(filename + " is outdated")
+    representatives = {}
+    for deck_hash, values in state["deck_representatives"].items():
+        deck_id, investigator_code, month, xp_deck, cards = values
+        representatives[deck_hash] = Deck(deck_id, investigator_code, month, cards)
+        representatives[deck_hash].xp_deck = xp_deck
+    state["deck_representatives"] = representatives
+    return state
+
+
+def remove_deck(representative, aggregate=None):
+    """Remove a deck from the affinities (it was counted by another process),
+    from the aggregates of the run by default"""
+    process_deck(aggregate or aggregate_view(), representative, increment=-1)
+
+
+def new_aggregate():
+    """Return empty aggregates (each worker thread/process has its own)"""
+    return {
+        "affinity_investigators": {},
+        "affinity_investigators_xp": {},
+        "affinity_months": {},
+        "affinity_cards": new_card_matrix(),
+        "card_codes": card_codes,
+        "decks_grouped_by_hash": {},
+        "deck_representatives": {},
+        "valid_decks": [],
+        "invalid_decks": {},
+        "unchecked_decks": [],
+    }
+
+
+def aggregate_state():
+    """Return the (merged) aggregates of the run"""
+    card_matrix_flush(affinity_cards)
+    return aggregate_view()
+
+
+def aggregate_view():
+    """Return the aggregates of the run without flushing the card matrix
+    (enough to update them, see process_deck)"""
+    return {
+        "affinity_investigators": affinity_investigators,
+        "affinity_investigators_xp": affinity_investigators_xp,
+        "affinity_months": affinity_months,
+        "affinity_cards": affinity_cards,
+        # Card IDs of the matrix are only valid with this list of codes
+        "card_codes": card_codes,
+        "decks_grouped_by_hash": decks_grouped_by_hash,
+        "deck_representatives": deck_representatives,
+        "valid_decks": valid_decks,
+        "invalid_decks": invalid_decks,
+        "unchecked_decks": unchecked_decks,
+    }
+
+
+def merge_counters(target, source):
+    """Add the counts of a dict of counters to another one"""
+    for key in source:
+        counter = target.get(key, {})
+        for other_key, value in source[key].items():
+            counter[other_key] = counter.get(other_key, 0) + value
+        target[key] = counter
+
+
+def merge_month_bucket(target, source):
+    """Add the aggregates of a month to another month (see new_month_bucket)"""
+    merge_counters(target["base"], source["base"])
+    merge_counters(target["xp"], source["xp"])
+    merge_counters(target, {"decks": source["decks"], "decks_xp": source["decks_xp"]})
+
+
+def merge_aggregate(state):
+    """Merge partial aggregates (from a thread, a process or a checkpoint)"""
+    merge_counters(affinity_investigators, state["affinity_investigators"])
+    merge_counters(affinity_investigators_xp, state["affinity_investigators_xp"])
+    for month, bucket in state["affinity_months"].items():
+        merge_month_bucket(
+            affinity_months.setdefault(month, new_month_bucket()), bucket
+        )
+    card_matrix_merge(affinity_cards, state["affinity_cards"], state["card_codes"])
+    # Card IDs of the representatives are only valid with their list of codes
+    mapping = None
+    if state["card_codes"] is not card_codes:
+        mapping = [card_id(code) for code in state["card_codes"]]
+        if mapping == list(range(len(mapping))):
+            mapping = None
+    for deck_hash, deck_ids in state["decks_grouped_by_hash"].items():
+        representative = state["deck_representatives"][deck_hash]
+        if mapping is not None:
+            representative.cards = array(
+                "H", [mapping[index] for index in representative.cards]
+            )
+        if deck_hash in decks_grouped_by_hash:
+            decks_grouped_by_hash[deck_hash] = sorted(
+                decks_grouped_by_hash[deck_hash] + deck_ids
+            )
+            # Only the deck with the lowest ID of a group is counted, no
+            # matter the order in which the partial aggregates are merged
+            if representative.id < deck_representatives[deck_hash].id:
+                remove_deck(deck_representatives[deck_hash])
+                deck_representatives[deck_hash] = representative
+            else:
+                remove_deck(representative)
+        else:
+            decks_grouped_by_hash[deck_hash] = deck_ids
+            deck_representatives[deck_hash] = representative
+    valid_decks.extend(state["valid_decks"])
+    invalid_decks.update(state["invalid_decks"])
+    unchecked_decks.extend(state["unchecked_decks"])
+
+
+def process_init(config):
+    """Initialize a worker process (used by --processes)"""
+    global duplicates, cache_connection, CACHE_BACKEND, ARKHAM_DB_API
+    global cache_archive, CACHE_ARCHIVE, SYNC_BY_DATE
+    duplicates = types.MappingProxyType(config["duplicates"])
+    CACHE_BACKEND = config["cache_backend"]
+    ARKHAM_DB_API = config["api"]
+    # A SQLite connection can't be shared with a child process
+    cache_connection = None
+    cache_archive = None
+    CACHE_ARCHIVE = config["cache_archive"]
+    SYNC_BY_DATE = config["sync_by_date"]
+    cache_preloaded.clear()
+    missing.clear()
+    missing.update(config["missing"])
+    # Log records are written by the listener of the main process
+    logger.handlers = [logging.handlers.QueueHandler(config["log_queue"])]
+    logger.setLevel(config["log_level"])
+    logger.propagate = False
+    # Forked processes have the metrics of the parent process
+    for values in metrics.values():
+        values.clear()
+    # Forked processes already have the card catalog
+    if not card_catalog["known"]:
+        catalog_load()
+
+
+def process_shard(shard):
+    """Parse a range of deck IDs in a worker process, return the aggregates"""
+    start, stop = shard
+    missing_before = {oper: dict(missing[oper]) for oper in missing}
+    # Decks are in cache, the last deck detection isn't needed
+    deck_scan.update({"next": start, "stop": stop, "last_found": stop, "retry": []})
+    cache_preload("decklist", after=start - 1, before=stop)
+    state = new_aggregate()
+    worker(state)
+    card_matrix_flush(state["affinity_cards"])
+    # Metrics of the shard only (they're added to the metrics of the run)
+    state["metrics"] = {key: dict(metrics[key]) for key in ["counters", "histograms"]}
+    for values in metrics.values():
+        values.clear()
+    # Decks/cards found missing by this process
+    state["missing"] = {
+        oper: {
+            uid: value
+            for uid, value in missing[oper].items()
+            if uid not in missing_before.get(oper, {})
+        }
+        for oper in missing
+    }
+    return state
+
+
+def process_cached_decks(nb_process):
+    """Parse the decks already in cache with worker processes"""
+    last_cached = cache_last_id("decklist")
+    shards = [
+        (start, min(start + SHARD_SIZE, last_cached + 1))
+        for start in range(deck_scan["next"], last_cached + 1, SHARD_SIZE)
+    ]
+    config = {
+        "duplicates": dict(duplicates),
+        "cache_backend": CACHE_BACKEND,
+        "cache_archive": CACHE_ARCHIVE,
+        "sync_by_date": SYNC_BY_DATE,
+        "api": ARKHAM_DB_API,
+        "missing": missing,
+        "log_queue": log_queue,
+        "log_level": logger.level,
+    }
+    with ProcessPoolExecutor(
+        nb_process, initializer=process_init, initargs=(config,)
+    ) as executor:
+        # Partial aggregates are merged in the order of the shards
+        for state in executor.map(process_shard, shards):
+            for oper in state["missing"]:
+                missing.setdefault(oper, {}).update(state["missing"][oper])
+            metrics_merge(state["metrics"])
+            merge_aggregate(state)
+    # Threads parse the decks that aren't in cache yet
+    if shards:
+        deck_scan["next"] = last_cached + 1
+        deck_scan["last_found"] = max([deck_scan["last_found"]] + valid_decks)
+
+
+def deck_store_empty():
+    """Return an empty columnar deck store"""
+    store = {column: np.zeros(0, dtype) for column, dtype in DECK_STORE_COLUMNS.items()}
+    store["deck_offsets"] = np.zeros(1, DECK_STORE_COLUMNS["deck_offsets"])
+    store["codes"] = []
+    return store
+
+
+def deck_store_load():
+    """
+    Return the columnar deck store (see deck_store_update).
+
+    Columns are memory-mapped NumPy arrays, one value per deck except the
+    slots: the cards of deck N are card_idx/qty[deck_offsets[N]:deck_offsets[N + 1]].
+    Card (and investigator) indexes are positions in store["codes"], so are
+    the meta of the decks (compact JSON, see deck_meta).
+    """
+    store = {"codes": file_to_json(DECK_STORE_PATH + "codes.json") or []}
+    try:
+        for column in DECK_STORE_COLUMNS:
+            store[column] = np.load(DECK_STORE_PATH + column + ".npy", mmap_mode="r")
+    except (IOError, ValueError):
+        return deck_store_empty()
+    # An interrupted update leaves columns of different lengths
+    nb_decks = len(store["deck_id"])
+    if (
+        any(
+            len(store[column]) != nb_decks
+            for column in ["investigator", "date", "xp", "meta"]
+        )
+        or len(store["deck_offsets"]) != nb_decks + 1
+        or len(store["card_idx"]) != store["deck_offsets"][-1]
+        or len(store["qty"]) != len(store["card_idx"])
+        or len(store["ignored"]) != len(store["card_idx"])
+    ):
+        return deck_store_empty()
+    return store
+
+
+def deck_store_update():
+    """
+    Add the decks cached since the last update to the columnar deck store.
+
+    Decks are picked by ID (cached but not stored), decks cached after
+    decks with a higher ID (retried misses, gaps filled by a later run) are
+    added too. Decks of the store are ordered by ID.
+    """
+    store = deck_store_load()
+    indexes = {code: index for index, code in enumerate(store["codes"])}
+    last_stored = int(store["deck_id"][-1]) if len(store["deck_id"]) else 0
+    added = {column: [] for column in DECK_STORE_COLUMNS}
+    nb_slots = 0
+    cache_preload("decklist", after=last_stored)
+    new_ids = np.setdiff1d(cache_ids("decklist"), store["deck_id"], assume_unique=True)
+    for deck_id in new_ids.tolist():
+        content = cache_get("decklist", deck_id)
+        if not content:
+            continue
+        added["deck_id"].append(deck_id)
+        code = content["investigator_code"]
+        added["investigator"].append(indexes.setdefault(code, len(indexes)))
+        # ArkhamDB dates are UTC ("2016-10-31T19:37:54+00:00")
+        added["date"].append((content.get("date_creation") or "NaT")[:19])
+        added["xp"].append(content["xp"] if isinstance(content.get("xp"), int) else -1)
+        meta = json.dumps(deck_meta(content), sort_keys=True, separators=(",", ":"))
+        added["meta"].append(indexes.setdefault(meta, len(indexes)))
+        ignored = content.get("ignoreDeckLimitSlots") or {}
+        for code, quantity in content["slots"].items():
+            added["card_idx"].append(indexes.setdefault(code, len(indexes)))
+            added["qty"].append(quantity)
+            added["ignored"].append(ignored.get(code, 0))
+        nb_slots = nb_slots + len(content["slots"])
+        added["deck_offsets"].append(store["deck_offsets"][-1] + nb_slots)
+    if not added["deck_id"]:
+        return store
+    columns = {
+        column: np.concatenate([store[column], np.array(added[column], dtype)])
+        for column, dtype in DECK_STORE_COLUMNS.items()
+    }
+    if added["deck_id"][0] < last_stored:
+        deck_store_sort(columns)
+    store.clear()
+    os.makedirs(DECK_STORE_PATH, exist_ok=True)
+    json_to_file(list(indexes), DECK_STORE_PATH + "codes.json.tmp")
+    os.replace(DECK_STORE_PATH + "codes.json.tmp", DECK_STORE_PATH + "codes.json")
+    # Deck IDs are written last (see the checks of deck_store_load)
+    for column in sorted(columns, key=lambda column: column == "deck_id"):
+        with open(DECK_STORE_PATH + column + ".npy.tmp", "wb") as file:
+            np.save(file, columns[column])
+        os.replace(
+            DECK_STORE_PATH + column + ".npy.tmp", DECK_STORE_PATH + column + ".npy"
+        )
+    logger.info("%d deck(s) added to the deck store", len(added["deck_id"]))
+    return deck_store_load()
+
+
+def deck_store_sort(columns):
+    """Order the decks of the columns of a deck store by ID (in place)"""
+    order = np.argsort(columns["deck_id"], kind="stable")
+    offsets = columns["deck_offsets"]
+    lengths = np.diff(offsets)[order]
+    # Position of each slot of the sorted decks in the unsorted columns
+    slots = np.repeat(offsets[:-1][order] - np.cumsum(lengths) + lengths, lengths)
+    slots = slots + np.arange(len(slots))
+    for column in DECK_STORE_COLUMNS:
+        if column in ["card_idx", "qty", "ignored"]:
+            columns[column] = columns[column][slots]
+        elif column != "deck_offsets":
+            columns[column] = columns[column][order]
+    columns["deck_offsets"] = np.concatenate(
+        [offsets[:1], offsets[0] + np.cumsum(lengths)]
+    ).astype(offsets.dtype)
+
+
+def deck_pairs(ids, offsets):
+    """Return the matrix keys of every pair of different cards of several decks
+    (same as card_pairs for each deck, the cards of deck N are
+    ids[offsets[N]:offsets[N + 1]])"""
+    lengths = np.diff(offsets)
+    # Each card is paired with every card of its deck (including itself)
+    pairs_per_card = np.repeat(lengths, lengths)
+    left = np.repeat(np.arange(len(ids)), pairs_per_card)
+    first_pair = np.repeat(np.cumsum(pairs_per_card) - pairs_per_card, pairs_per_card)
+    right = np.repeat(np.repeat(offsets[:-1], lengths), pairs_per_card) + (
+        np.arange(len(left)) - first_pair
+    )
+    # We exclude own...
+    different = left != right
+    return (ids[left[different]] << 32) | ids[right[different]]
+
+
+def deck_store_aggregate(store, start=FIRST_DECK):
+    """
+    Return the aggregates (see new_aggregate) of the decks of the store.
+
+    Same result as worker(), but filter_out_cards, deck_problems,
+    deck_deduplicate, deck_level and process_deck are computed on the whole
+    store at once.
+
+    Args:
+      store: Columnar deck store (see deck_store_load).
+      start: Decks with a lower ID are skipped.
+    """
+    state = new_aggregate()
+    first = int(np.searchsorted(store["deck_id"], start))
+    deck_ids = np.asarray(store["deck_id"][first:], np.int64)
+    offsets = np.asarray(store["deck_offsets"][first:], np.int64)
+    state["valid_decks"] = deck_ids.tolist()
+    if not len(deck_ids):
+        return state
+    cards = np.asarray(store["card_idx"][offsets[0] : offsets[-1]], np.int64)
+    quantities = np.asarray(store["qty"][offsets[0] : offsets[-1]], np.int64)
+    ignored = np.asarray(store["ignored"][offsets[0] : offsets[-1]], np.int64)
+    decks = np.repeat(np.arange(len(deck_ids)), np.diff(offsets))
+    # For each card of the store: is it kept by filter_out_cards, its original
+    # card (deck_deduplicate) and the XP of the original
+    codes = store["codes"]
+    kept = np.zeros(len(codes), bool)
+    originals = np.full(len(codes), -1, np.int64)
+    card_xps = np.zeros(len(codes), np.int64)
+    for index in np.unique(cards).tolist():
+        code = codes[index]
+        if code == "01000" or card_catalog["encounter"][catalog_card(code)]:
+            continue
+        kept[index] = True
+        originals[index] = card_id(duplicates.get(code, code))
+        card_xps[index] = max(card_xp(card_codes[originals[index]]), 0)
+    kept = kept[cards]
+    cards, quantities, decks = cards[kept], quantities[kept], decks[kept]
+    # Illegal decks aren't counted (see deck_problems), the decks without
+    # rules (-1) are counted without being checked
+    investigators = [codes[index] for index in store["investigator"][first:].tolist()]
+    choices, choice_indexes = np.unique(
+        (np.asarray(store["investigator"][first:], np.int64) << 32)
+        | np.asarray(store["meta"][first:], np.int64),
+        return_inverse=True,
+    )
+    rows = [
+        rules_row(codes[choice >> 32], json.loads(codes[choice & 0xFFFFFFFF]))
+        for choice in choices.tolist()
+    ]
+    rows = np.array([-1 if row is None else row for row in rows], np.int64)
+    rows = rows[choice_indexes]
+    state["unchecked_decks"] = deck_ids[rows < 0].tolist()
+    problems = legality_check(rows, decks, originals[cards], quantities, ignored[kept])
+    # A reprint and its original in the same deck are a single card (first
+    # position, last quantity like the dict of deck_deduplicate)
+    keys = (decks << 32) | originals[cards]
+    unique_keys, first_slots = np.unique(keys, return_index=True)
+    if len(unique_keys) < len(keys):
+        last_slots = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+        order = np.argsort(first_slots)
+        quantities = quantities[last_slots[order]]
+        cards, decks = cards[first_slots[order]], decks[first_slots[order]]
+    slot_offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(decks, minlength=len(deck_ids)))]
+    )
+    # XP spent in each deck (deck_level)
+    xp_decks = np.bincount(decks, card_xps[cards] * quantities, len(deck_ids)) != 0
+    # Only the first deck (lowest ID) of each group of identical decks is counted
+    representatives = np.zeros(len(deck_ids), bool)
+    slot_ids = originals[cards].tolist()
+    slot_codes = [card_codes[original] for original in slot_ids]
+    slot_quantities = quantities.tolist()
+    # Month of each deck (deck_month)
+    months, month_indexes = np.unique(
+        np.asarray(store["date"][first:]).astype("datetime64[M]"), return_inverse=True
+    )
+    months = [
+        MONTH_UNKNOWN if month == "NaT" else month
+        for month in np.datetime_as_string(months).tolist()
+    ]
+    for deck, deck_id in enumerate(state["valid_decks"]):
+        if deck in problems:
+            state["invalid_decks"][deck_id] = problems[deck]
+            continue
+        start, stop = slot_offsets[deck], slot_offsets[deck + 1]
+        slots = dict(zip(slot_codes[start:stop], slot_quantities[start:stop]))
+        deck_hash = deck_fingerprint(slots)
+        if deck_hash in state["decks_grouped_by_hash"]:
+            state["decks_grouped_by_hash"][deck_hash].append(deck_id)
+            continue
+        state["decks_grouped_by_hash"][deck_hash] = [deck_id]
+        representative = Deck(
+            deck_id,
+            sys.intern(investigators[deck]),
+            months[month_indexes[deck]],
+            array("H", slot_ids[start:stop]),
+        )
+        representative.xp_deck = bool(xp_decks[deck])
+        state["deck_representatives"][deck_hash] = representative
+        representatives[deck] = True
+    # Investigator affinities: number of decks of the investigator with each card
+    counted = representatives[decks]
+    investigator_ids = np.array([card_id(code) for code in investigators], np.int64)
+    # Month buckets: (month, investigator) pairs are numbered like card IDs
+    nb_codes = len(card_codes)
+    month_investigators = month_indexes * nb_codes + investigator_ids
+    for xp_deck, affinities, kind, decks_kind in [
+        (False, state["affinity_investigators"], "base", "decks"),
+        (True, state["affinity_investigators_xp"], "xp", "decks_xp"),
+    ]:
+        selected = counted & (xp_decks[decks] == xp_deck)
+        keys = (investigator_ids[decks[selected]] << 32) | originals[cards[selected]]
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            inv_affinity = affinities.setdefault(card_codes[key >> 32], {})
+            inv_affinity[card_codes[key & 0xFFFFFFFF]] = count
+        keys = (month_investigators[decks[selected]] << 32) | originals[cards[selected]]
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            month, inv = divmod(key >> 32, nb_codes)
+            bucket = state["affinity_months"].setdefault(
+                months[month], new_month_bucket()
+            )
+            inv_affinity = bucket[kind].setdefault(card_codes[inv], {})
+            inv_affinity[card_codes[key & 0xFFFFFFFF]] = count
+        selected = representatives & (xp_decks == xp_deck)
+        keys, counts = np.unique(month_investigators[selected], return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            month, inv = divmod(key, nb_codes)
+            bucket = state["affinity_months"].setdefault(
+                months[month], new_month_bucket()
+            )
+            bucket[decks_kind][card_codes[inv]] = count
+    # Card to card affinity, by batches of about CARD_MATRIX_BATCH pairs
+    ids = originals[cards[counted]]
+    lengths = np.bincount(decks[counted], minlength=len(deck_ids))[representatives]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    batches = np.searchsorted(
+        np.cumsum(lengths * lengths),
+        np.arange(CARD_MATRIX_BATCH, int(np.sum(lengths * lengths)), CARD_MATRIX_BATCH),
+    )
+    for begin, end in zip([0] + batches.tolist(), batches.tolist() + [len(lengths)]):
+        keys = deck_pairs(
+            ids[offsets[begin] : offsets[end]],
+            offsets[begin : end + 1] - offsets[begin],
+        )
+        card_matrix_add(state["affinity_cards"], keys, np.ones(len(keys), np.int64))
+    card_matrix_flush(state["affinity_cards"])
+    return state
+
+
+def process_deck_store(store):
+    """Compute the aggregates of the decks in the columnar store (--columnar)"""
+    start = deck_scan["next"]
+    state = deck_store_aggregate(store, start)
+    merge_aggregate(state)
+    if not state["valid_decks"]:
+        return
+    last_stored = state["valid_decks"][-1]
+    stored = set(state["valid_decks"])
+    # Threads check the deck IDs that aren't in the store (not in cache)
+    deck_scan["retry"].extend(
+        deck_id
+        for deck_id in range(start, last_stored)
+        if deck_id not in stored and not missing_check("decklist", deck_id)
+    )
+    deck_scan["next"] = last_stored + 1
+    deck_scan["last_found"] = max(deck_scan["last_found"], last_stored)
+
+
+def migrate_deck_hashes():
+    """Convert the keys of decks_grouped_by_hash.json to deck_fingerprint()"""
+    groups = file_to_json(JSON_PATH + "decks_grouped_by_hash.json")
+    if not groups:
+        logger.info("Nothing to migrate.")
+        return
+    new_groups = {}
+    migration = {}  # Old hash -> new hash
+    for old_hash, deck_ids in groups.items():
+        # Decks of a group are identical, the first one gives the new hash
+        content = arkhamdb_cache("decklist", deck_ids[0])
+        if not content:
+            logger.warning("Deck %s not found, group skipped.", deck_ids[0])
+            continue
+        slots, replaced = deck_deduplicate(filter_out_cards(content["slots"]))
+        new_hash = deck_fingerprint(slots)
+        migration[old_hash] = new_hash
+        new_groups[new_hash] = sorted(new_groups.get(new_hash, []) + deck_ids)
+    json_to_file(
+        dict_order_by_keys(new_groups), JSON_PATH + "decks_grouped_by_hash.json"
+    )
+    json_to_file(dict_order_by_keys(migration), JSON_PATH + "deck_hash_migration.json")
+    logger.info("%d hash(es) migrated, see deck_hash_migration.json", len(migration))
+
+
+#
+# End of ArkhamDB specific functions
+#
+# Start of card similarity functions
+#
+
+
+def card_frequencies():
+    """Return the number of decks of every card (indexed by card ID)"""
+    ids, counts = [], []
+    for affinities in [affinity_investigators, affinity_investigators_xp]:
+        for inv_affinity in affinities.values():
+            ids.extend(map(card_id, inv_affinity))
+            counts.extend(inv_affinity.values())
+    frequencies = np.bincount(
+        np.array(ids, dtype=np.int64), weights=counts, minlength=len(card_codes)
+    )
+    return frequencies.astype(np.int64)
+
+
+def similarity_scores(rows, columns, counts, frequencies, decks):
+    """
+    Return the association scores of pairs of cards (vectorized).
+
+    Args:
+      rows, columns: Card IDs of the pairs.
+      counts: Number of decks with both cards.
+      frequencies: Number of decks of every card (see card_frequencies).
+      decks: Number of decks.
+
+    Returns:
+      {metric: scores}, one score per pair for every SIMILARITY_METRICS.
+    """
+    counts = counts.astype(np.float64)
+    row_decks = frequencies[rows].astype(np.float64)
+    column_decks = frequencies[columns].astype(np.float64)
+    # P(A and B) / (P(A) * P(B)): above 1 when cards are played together more
+    # than their popularity alone explains
+    lift = counts * decks / (row_decks * column_decks)
+    return {
+        "lift": lift,
+        "pmi": np.log2(lift),
+        "jaccard": counts / (row_decks + column_decks - counts),
+        "cosine": counts / np.sqrt(row_decks * column_decks),
+    }
+
+
+def similarity_build(matrix, top_k=SIMILARITY_TOP_K, min_decks=SIMILARITY_MIN_DECKS):
+    """
+    Build the similarity index of the cards from the card to card affinity.
+
+    Args:
+      matrix: Card to card affinity (see new_card_matrix).
+      top_k: Most similar cards kept for each card (for each metric).
+      min_decks: Pairs of cards in less decks are ignored.
+
+    Returns:
+      Arrays of the index (see similarity_save), cards are ordered by code.
+    """
+    indptr, columns, counts = card_matrix_csr(matrix)
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    frequencies = card_frequencies()
+    decks = len(deck_representatives)
+    # Cards are stored ordered by code (card IDs change between runs)
+    codes = np.array(sorted(card_codes), dtype=str)
+    position = np.empty(len(card_codes), dtype=np.int64)
+    position[np.argsort(np.array(card_codes, dtype=str), kind="stable")] = np.arange(
+        len(card_codes)
+    )
+    kept = (counts >= min_decks) & (frequencies[rows] > 0) & (frequencies[columns] > 0)
+    rows, columns, counts = position[rows[kept]], position[columns[kept]], counts[kept]
+    # Pairs ordered by card codes (CSR, like the matrix)
+    order = np.argsort((rows << 32) | columns)
+    rows, columns, counts = rows[order], columns[order], counts[order]
+    indptr = np.searchsorted(rows, np.arange(len(codes) + 1))
+    # Cards with more than K pairs: only their K best scores have to be sorted
+    large_rows = np.flatnonzero(np.diff(indptr) > top_k).tolist()
+    index = {
+        "codes": codes,
+        "decks": np.array(decks, dtype=np.int64),
+        "frequencies": frequencies[np.argsort(position)].astype(np.int32),
+    }
+    scores = similarity_scores(
+        rows, columns, counts, index["frequencies"].astype(np.int64), decks
+    )
+    for metric in SIMILARITY_METRICS:
+        threshold = np.full(len(codes), -np.inf)
+        for row in large_rows:
+            row_scores = scores[metric][indptr[row] : indptr[row + 1]]
+            threshold[row] = np.partition(row_scores, len(row_scores) - top_k)[
+                len(row_scores) - top_k
+            ]
+        # Ordered by card, best score first (then by code), top K of each card
+        order = np.flatnonzero(scores[metric] >= threshold[rows])
+        order = order[np.lexsort((columns[order], -scores[metric][order], rows[order]))]
+        card_rows = rows[order]
+        card_starts = np.searchsorted(card_rows, card_rows)
+        order = order[np.arange(len(order)) - card_starts < top_k]
+        index[metric + "_indptr"] = np.searchsorted(
+            rows[order], np.arange(len(codes) + 1)
+        ).astype(np.int64)
+        index[metric + "_cards"] = columns[order].astype(np.int32)
+        index[metric + "_scores"] = scores[metric][order].astype(np.float32)
+        index[metric + "_decks"] = counts[order].astype(np.int32)
+    return index
+
+
+def similarity_save(index, filename=SIMILARITY_PATH):
+    """Write the similarity index (compressed NumPy arrays, .npz)"""
+    with open(filename + ".tmp", "wb") as file:
+        np.savez_compressed(file, **index)
+    os.replace(filename + ".tmp", filename)
+
+
+def similarity_load(filename=SIMILARITY_PATH):
+    """Load the similarity index written by similarity_save (None if missing)"""
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as arrays:
+        index = {name: arrays[name] for name in arrays.files}
+    index["positions"] = {code: i for i, code in enumerate(index["codes"].tolist())}
+    return index
+
+
+def similar_cards(index, code, metric="lift", limit=None):
+    """
+    Return the cards the most similar to a card.
+
+    Args:
+      index: Index returned by similarity_load.
+      code: Card code.
+      metric: One of SIMILARITY_METRICS.
+      limit: Maximum number of cards (None: every card of the index).
+
+    Returns:
+      [(card code, score, decks with both cards)], best score first.
+    """
+    position = index["positions"].get(code)
+    if position is None:
+        return []
+    start, stop = index[metric + "_indptr"][position : position + 2].tolist()
+    if limit is not None:
+        stop = min(stop, start + limit)
+    return list(
+        zip(
+            index["codes"][index[metric + "_cards"][start:stop]].tolist(),
+            index[metric + "_scores"][start:stop].tolist(),
+            index[metric + "_decks"][start:stop].tolist(),
+        )
+    )
+
+
+#
+# End of card similarity functions
+#
+# Start of time window functions
+#
+
+
+def pack_release_month(pack, releases):
+    """
+    Return the release month of a pack (None if the pack is unknown).
+
+    Args:
+      pack: Pack code.
+      releases: Release months of the packs (see packs_load).
+    """
+    if pack in releases:
+        return releases[pack]
+    # Not in the pack list (ArkhamDB can't be reached): first month a card
+    # of the pack was played
+    codes = {
+        card_codes[index]
+        for index, code in enumerate(card_catalog["pack"])
+        if code == pack
+    }
+    for month in sorted(affinity_months):
+        for kind in ["base", "xp"]:
+            for inv_affinity in affinity_months[month][kind].values():
+                if not codes.isdisjoint(inv_affinity):
+                    return month
+    return None
+
+
+def window_start(window, releases):
+    """
+    Return the first month of a rolling window (None if the pack is unknown).
+
+    Args:
+      window: Number of months (the current month included) or a pack code
+        (since the release of the pack).
+      releases: Release months of the packs (see packs_load).
+    """
+    if window.isdigit():
+        today = datetime.now()
+        month = today.year * 12 + today.month - int(window)
+        return f"{month // 12:04d}-{month % 12 + 1:02d}"
+    return pack_release_month(window, releases)
+
+
+def window_aggregate(start, stop=None):
+    """Return the sum of the months from start to stop (included), no deck is
+    parsed again (see new_month_bucket)"""
+    window = new_month_bucket()
+    for month, bucket in affinity_months.items():
+        if (
+            month != MONTH_UNKNOWN
+            and start <= month
+            and (stop is None or month <= stop)
+        ):
+            merge_month_bucket(window, bucket)
+    return window
+
+
+def month_bucket_sorted(bucket):
+    """Return a month (or window) with investigators and cards ordered by codes"""
+    ordered = {
+        kind: {
+            inv: dict_order_by_keys(bucket[kind][inv]) for inv in sorted(bucket[kind])
+        }
+        for kind in ["base", "xp"]
+    }
+    ordered["decks"] = dict_order_by_keys(bucket["decks"])
+    ordered["decks_xp"] = dict_order_by_keys(bucket["decks_xp"])
+    return ordered
+
+
+#
+# End of time window functions
+#
+# Start of deck legality functions
+#
+
+
+def rules_card_attributes(cards):
+    """
+    Return the attributes of the cards used by the deckbuilding options.
+
+    Args:
+      cards: ArkhamDB card list.
+
+    Returns:
+      {"ids": card ID of each card of the list, "xp": XP by card ID (-1: none),
+      attribute: {value: positions in the card list}} for faction, trait,
+      type, slot and tag.
+    """
+    attributes = {
+        "ids": np.array([card_id(card["code"]) for card in cards], np.int64),
+        "xp": np.full(len(card_codes), -1, np.int64),
+    }
+    for name in ["faction", "trait", "type", "slot", "tag"]:
+        attributes[name] = {}
+    for position, card in enumerate(cards):
+        if isinstance(card.get("xp"), int):
+            attributes["xp"][attributes["ids"][position]] = card["xp"]
+        values = {
+            "faction": [
+                card.get(key)
+                for key in ["faction_code", "faction2_code", "faction3_code"]
+            ],
+            "trait": (card.get("traits") or "").split("."),
+            "type": [card.get("type_code")],
+            # "Hand x2. Arcane"
+            "slot": [
+                slot.split(" x")[0] for slot in (card.get("slot") or "").split(".")
+            ],
+            "tag": (card.get("tags") or "").split("."),
+        }
+        for name, card_values in values.items():
+            for value in card_values:
+                if value and value.strip():
+                    attributes[name].setdefault(value.strip().lower(), []).append(
+                        position
+                    )
+    return attributes
+
+
+def rules_option_mask(option, cards, attributes):
+    """
+    Return the cards allowed by a deckbuilding option (boolean array by card ID).
+
+    Options choosing between several factions or options (faction_select,
+    option_select) allow every choice. Returns None for the options that
+    don't allow any card themselves (deck_size_select, atleast...).
+    """
+    ids = attributes["ids"]
+    mask = np.ones(len(card_codes), bool)
+    matched = False
+
+    def positions_mask(positions):
+        selected = np.zeros(len(card_codes), bool)
+        selected[ids[positions]] = True
+        return selected
+
+    for name in ["faction", "faction_select", "trait", "type", "slot", "tag"]:
+        if option.get(name):
+            values = attributes[name.replace("_select", "")]
+            positions = [
+                position
+                for value in option[name]
+                for position in values.get(value.lower(), [])
+            ]
+            mask = mask & positions_mask(positions)
+            matched = True
+    if option.get("level"):
+        level = option["level"]
+        xp = attributes["xp"]
+        mask = (
+            mask & (xp >= level.get("min", 0)) & (xp <= level.get("max", 5)) & (xp >= 0)
+        )
+        matched = True
+    for name, pattern in [("uses", r"Uses \(\d+ {}"), ("text", "{}")]:
+        if option.get(name):
+            regexes = [re.compile(pattern.format(value)) for value in option[name]]
+            positions = [
+                position
+                for position, card in enumerate(cards)
+                if any(regex.search(card.get("text") or "") for regex in regexes)
+            ]
+            mask = mask & positions_mask(positions)
+            matched = True
+    if "permanent" in option:
+        positions = [
+            position
+            for position, card in enumerate(cards)
+            if bool(card.get("permanent")) == bool(option["permanent"])
+        ]
+        mask = mask & positions_mask(positions)
+        matched = True
+    if option.get("option_select"):
+        choices = [
+            rules_option_mask(choice, cards, attributes)
+            for choice in option["option_select"]
+        ]
+        choices = [choice for choice in choices if choice is not None]
+        if choices:
+            mask = mask & np.logical_or.reduce(choices)
+            matched = True
+    return mask if matched else None
+
+
+def rules_modeled(options):
+    """Return True if every deckbuilding option (and choice of option_select)
+    only uses RULES_OPTION_KEYS"""
+    return all(
+        set(option) <= RULES_OPTION_KEYS
+        and rules_modeled(option.get("option_select") or [])
+        for option in options
+    )
+
+
+def rules_variants(investigator):
+    """
+    Return the deckbuilding options of an investigator for each choice of its
+    faction_select/option_select options.
+
+    Returns:
+      The meta keys of the choices (see deck_meta) and {(choice, ...):
+      options}. A None choice allows every choice (deck without meta).
+    """
+    selects = [
+        number
+        for number, option in enumerate(investigator["deck_options"])
+        if option.get("faction_select") or option.get("option_select")
+    ]
+    keys, values = [], []
+    for number in selects:
+        option = investigator["deck_options"][number]
+        if option.get("faction_select"):
+            keys.append(option.get("id") or "faction_selected")
+            values.append([None] + list(option["faction_select"]))
+        else:
+            keys.append(option.get("id") or "option_selected")
+            values.append(
+                [None] + [choice.get("id") for choice in option["option_select"]]
+            )
+    variants = {}
+    for choices in itertools.product(*values):
+        options = list(investigator["deck_options"])
+        for number, choice in zip(selects, choices):
+            if choice is None:
+                continue
+            option = dict(options[number])
+            if option.get("faction_select"):
+                option["faction_select"] = [choice]
+            else:
+                option["option_select"] = [
+                    select
+                    for select in option["option_select"]
+                    if select.get("id") == choice
+                ]
+            options[number] = option
+        variants[choices] = options
+    return keys, variants
+
+
+def rules_compile(cards):
+    """
+    Compile the deckbuilding rules of the investigators of the card list
+    (deck_options and deck_requirements) into tables over card IDs.
+
+    Each investigator has a row of the option table for each choice of its
+    faction_select/option_select options (see rules_variants): the first
+    option that allows each card (the index of the option, to count its
+    limit), or CARD_NOT_ALLOWED, CARD_FREE, CARD_RESTRICTED or CARD_EXCLUDED.
+    Investigators with options that aren't modeled (see RULES_OPTION_KEYS)
+    have no rows, their decks aren't checked.
+    """
+    investigators = [card for card in cards if card.get("deck_options")]
+    unmodeled = [
+        inv["code"] for inv in investigators if not rules_modeled(inv["deck_options"])
+    ]
+    if unmodeled:
+        logger.info(
+            "Deckbuilding options not modeled, decks not checked: %s",
+            ", ".join(unmodeled),
+        )
+    investigators = [inv for inv in investigators if inv["code"] not in unmodeled]
+    # Allowance cards may not be in the card list, their IDs come first
+    allowance_ids = [card_id(duplicates.get(code, code)) for code in ALLOWANCE_OPTIONS]
+    attributes = rules_card_attributes(cards)
+    ids = attributes["ids"]
+    nb_cards = len(card_codes)
+    weakness = np.zeros(nb_cards, bool)
+    counted = np.zeros(nb_cards, bool)
+    deck_limit = np.full(nb_cards, np.iinfo(np.int64).max, np.int64)
+    restrictions = {}  # Card ID -> investigators allowed to use the card
+    listed = np.zeros(nb_cards, bool)
+    listed[ids] = True
+    for position, card in enumerate(cards):
+        index = ids[position]
+        weakness[index] = card.get("subtype_code") in ["weakness", "basicweakness"]
+        counted[index] = (
+            not weakness[index]
+            and not card.get("permanent")
+            and card.get("type_code") != "investigator"
+        )
+        if isinstance(card.get("deck_limit"), int):
+            deck_limit[index] = card["deck_limit"]
+        restricted = (card.get("restrictions") or {}).get("investigator")
+        if restricted:
+            restrictions[index] = set(restricted)
+    # A row for each choice of each investigator
+    selections = {}
+    variants = []
+    for inv in investigators:
+        selections[inv["code"]], inv_variants = rules_variants(inv)
+        variants.extend(
+            (inv, choices, options) for choices, options in inv_variants.items()
+        )
+    allowances = [
+        {
+            "card": index,
+            "code": code,
+            "allowed": rules_option_mask(option, cards, attributes),
+            "limit": option.get("limit") or 0,
+        }
+        for index, (code, option) in zip(allowance_ids, ALLOWANCE_OPTIONS.items())
+    ]
+    nb_options = max([len(inv["deck_options"]) for inv in investigators] + [0])
+    options = np.full((len(variants), nb_cards), CARD_NOT_ALLOWED, np.int8)
+    limits = np.zeros((len(variants), nb_options + len(allowances)), np.int64)
+    size = np.zeros(len(variants), np.int64)
+    required = np.full((len(variants), nb_cards), -1, np.int16)
+    required_codes = []
+    for row, (inv, choices, inv_options) in enumerate(variants):
+        assigned = np.zeros(nb_cards, bool)
+        for number, option in enumerate(inv_options):
+            mask = rules_option_mask(option, cards, attributes)
+            if option.get("deck_size_select"):
+                size[row] = -1
+            if mask is None:
+                continue
+            # The first option allowing a card is the one used
+            mask = mask & ~assigned
+            assigned = assigned | mask
+            options[row, mask] = CARD_EXCLUDED if option.get("not") else number
+            limits[row, number] = option.get("limit") or 0
+        for number, allowance in enumerate(allowances):
+            limits[row, nb_options + number] = allowance["limit"]
+        requirements = inv.get("deck_requirements") or {}
+        if size[row] == 0:
+            size[row] = requirements.get("size") or 0
+        size[row] = max(size[row], 0)
+        # Each required card (or one of its alternatives) must be in the deck
+        groups = []
+        for code, alternatives in (requirements.get("card") or {}).items():
+            for alternative in [code] + list(alternatives or {}):
+                required[row, card_id(duplicates.get(alternative, alternative))] = len(
+                    groups
+                )
+            groups.append(code)
+        required_codes.append(groups)
+        # Cards that aren't in the card list aren't checked
+        options[row, ~listed] = CARD_FREE
+        options[row, weakness] = CARD_FREE
+        options[row, required[row] >= 0] = CARD_FREE
+        # Signature cards of an investigator are allowed for its parallel
+        # version (alternate back)
+        codes = {inv["code"], inv.get("alternate_of_code")}
+        for index, allowed in restrictions.items():
+            options[row, index] = CARD_FREE if codes & allowed else CARD_RESTRICTED
+    deck_rules.update(
+        {
+            "investigators": {
+                (inv["code"],) + choices: row
+                for row, (inv, choices, inv_options) in enumerate(variants)
+            },
+            "selections": selections,
+            "options": options,
+            "limits": limits,
+            "nb_options": nb_options,
+            "allowances": allowances,
+            "size": size,
+            "required": required,
+            "required_codes": required_codes,
+            # Same tables as lists/dicts for deck_problems
+            "rows": {},
+            "required_cards": [
+                dict(zip(np.flatnonzero(row >= 0).tolist(), row[row >= 0].tolist()))
+                for row in required
+            ],
+            "counted": counted,
+            "deck_limit": deck_limit,
+            "digest": rules_digest(cards),
+        }
+    )
+
+
+def rules_digest(cards):
+    """Return a digest of the deckbuilding rules of a card list (options and
+    requirements of the investigators, restrictions of the cards)"""
+    digest = hashlib.sha256()
+    for card in sorted(cards, key=lambda card: card["code"]):
+        rules = {
+            key: card[key]
+            for key in [
+                "alternate_of_code",
+                "deck_options",
+                "deck_requirements",
+                "restrictions",
+            ]
+            if card.get(key)
+        }
+        if rules:
+            digest.update(
+                json.dumps([card["code"], rules], sort_keys=True).encode("utf-8")
+            )
+    return digest.hexdigest()
+
+
+def rules_row(investigator_code, meta):
+    """
+    Return the row of the rules tables of a deck (see rules_compile).
+
+    Args:
+      investigator_code: Investigator of the deck.
+      meta: Deckbuilding choices of the deck (see deck_meta), the rules of a
+        parallel investigator are the ones of its back.
+
+    Returns:
+      The row, None if the deck can't be checked: investigator without
+      rules (or with options not modeled) or unknown choice.
+    """
+    code = meta.get("alternate_back", investigator_code)
+    keys = deck_rules["selections"].get(code)
+    if keys is None:
+        return None
+    return deck_rules["investigators"].get(
+        (code,) + tuple(meta.get(key) for key in keys)
+    )
+
+
+def legality_check(rows, decks, ids, quantities, ignored):
+    """
+    Return why decks are illegal (checked with the tables of rules_compile).
+
+    Args:
+      rows: Row of the rules of each deck (see rules_row, -1: not checked).
+      decks: Deck (position in rows) of each slot.
+      ids: Card ID of each slot (original card, see deck_deduplicate).
+      quantities: Quantity of each slot.
+      ignored: Quantity of each slot that ignores the deck limit.
+
+    Returns:
+      {deck position: [problems]}, legal decks aren't in it.
+    """
+    if not deck_rules["investigators"]:
+        return {}
+    nb_cards = deck_rules["options"].shape[1]
+    # Decks without rules and cards not in the card list aren't checked
+    checked = (rows[decks] >= 0) & (ids < nb_cards)
+    # Reprints of a card are the same card (the deck limit is for both)
+    keys, inverse = np.unique(
+        (decks[checked] << 32) | ids[checked], return_inverse=True
+    )
+    quantities = np.bincount(inverse, quantities[checked], len(keys)).astype(np.int64)
+    limited = quantities - np.bincount(inverse, ignored[checked], len(keys)).astype(
+        np.int64
+    )
+    decks, ids = keys >> 32, keys & 0xFFFFFFFF
+    slot_rows = rows[decks]
+    options = deck_rules["options"][slot_rows, ids].astype(np.int64)
+    # Cards not allowed by the investigator can be allowed by an allowance
+    # card of the deck (as an option after the investigator's)
+    nb_options = deck_rules["nb_options"]
+    for number, allowance in enumerate(deck_rules["allowances"]):
+        has_card = np.zeros(len(rows), bool)
+        has_card[decks[ids == allowance["card"]]] = True
+        allowed = (
+            (options == CARD_NOT_ALLOWED) & has_card[decks] & allowance["allowed"][ids]
+        )
+        options[allowed] = nb_options + number
+    problems = {}
+    not_allowed = (options == CARD_NOT_ALLOWED) | (options == CARD_EXCLUDED)
+    for index in np.flatnonzero(not_allowed).tolist():
+        problems.setdefault(int(decks[index]), []).append(
+            card_codes[ids[index]] + " is not allowed"
+        )
+    for index in np.flatnonzero(options == CARD_RESTRICTED).tolist():
+        problems.setdefault(int(decks[index]), []).append(
+            card_codes[ids[index]] + " is restricted to another investigator"
+        )
+    deck_limits = deck_rules["deck_limit"][ids]
+    for index in np.flatnonzero(limited > deck_limits).tolist():
+        problems.setdefault(int(decks[index]), []).append(
+            f"{card_codes[ids[index]]}: {limited[index]} copies "
+            f"(deck limit {deck_limits[index]})"
+        )
+    # Copies of the cards allowed by an option with a limit
+    width = max(deck_rules["limits"].shape[1], 1)
+    selected = options >= 0
+    keys, inverse = np.unique(
+        decks[selected] * width + options[selected], return_inverse=True
+    )
+    totals = np.bincount(inverse, quantities[selected], len(keys)).astype(np.int64)
+    option_limits = deck_rules["limits"][rows[keys // width], keys % width]
+    for index in np.flatnonzero(
+        (option_limits > 0) & (totals > option_limits)
+    ).tolist():
+        option = keys[index] % width
+        if option >= nb_options:
+            problem = (
+                f"{totals[index]} cards allowed by "
+                f"{deck_rules['allowances'][option - nb_options]['code']} "
+                f"(limit {option_limits[index]})"
+            )
+        else:
+            problem = (
+                f"{totals[index]} cards of deckbuilding option {option + 1} "
+                f"(limit {option_limits[index]})"
+            )
+        problems.setdefault(int(keys[index] // width), []).append(problem)
+    # Deck size (cards ignoring the deck limit don't count)
+    nb_decks = len(rows)
+    counted = deck_rules["counted"][ids] & (options != CARD_FREE)
+    deck_sizes = np.bincount(decks[counted], limited[counted], nb_decks).astype(
+        np.int64
+    )
+    sizes = np.where(rows >= 0, deck_rules["size"][rows], 0)
+    for deck in np.flatnonzero(
+        (sizes > 0) & (deck_sizes < sizes - DECK_SIZE_MARGIN)
+    ).tolist():
+        problems.setdefault(deck, []).append(
+            f"{deck_sizes[deck]} cards (deck size {sizes[deck]})"
+        )
+    # Required cards (one card of each group)
+    groups = deck_rules["required"][slot_rows, ids].astype(np.int64)
+    found = set(zip(decks[groups >= 0].tolist(), groups[groups >= 0].tolist()))
+    for deck, row in enumerate(rows.tolist()):
+        if row < 0:
+            continue
+        for group, code in enumerate(deck_rules["required_codes"][row]):
+            if (deck, group) not in found:
+                problems.setdefault(deck, []).append("Required card missing: " + code)
+    # Same order no matter the card IDs
+    return {deck: sorted(deck_problems) for deck, deck_problems in problems.items()}
+
+
+def deck_problems(deck):
+    """Return why a deck (see deck_record) is illegal (empty list if it's legal,
+    None if it can't be checked), same checks as legality_check for a single
+    deck (faster without NumPy for a few cards)"""
+    row = deck.rules
+    if row is None:
+        return None
+    options = deck_rules["rows"].get(row)
+    if options is None:
+        options = deck_rules["rows"][row] = deck_rules["options"][row].tolist()
+    required = deck_rules["required_cards"][row]
+    ignored = deck.ignored or itertools.repeat(0)
+    quantities, limited = {}, {}
+    for index, quantity, ignore in zip(deck.cards, deck.quantities, ignored):
+        code = card_codes[index]
+        index = card_id(duplicates.get(code, code))
+        if index < len(options):
+            quantities[index] = quantities.get(index, 0) + quantity
+            limited[index] = limited.get(index, 0) + quantity - ignore
+    nb_options = deck_rules["nb_options"]
+    allowances = [
+        (nb_options + number, allowance["allowed"])
+        for number, allowance in enumerate(deck_rules["allowances"])
+        if allowance["card"] in quantities
+    ]
+    problems = []
+    option_totals = {}
+    deck_size = 0
+    groups = set()
+    for index, quantity in quantities.items():
+        option = options[index]
+        if option == CARD_NOT_ALLOWED:
+            for number, allowed in allowances:
+                if allowed[index]:
+                    option = number
+                    break
+        if option in (CARD_NOT_ALLOWED, CARD_EXCLUDED):
+            problems.append(card_codes[index] + " is not allowed")
+        elif option == CARD_RESTRICTED:
+            problems.append(
+                card_codes[index] + " is restricted to another investigator"
+            )
+        elif option >= 0:
+            option_totals[option] = option_totals.get(option, 0) + quantity
+        if limited[index] > deck_rules["deck_limit"][index]:
+            problems.append(
+                f"{card_codes[index]}: {limited[index]} copies "
+                f"(deck limit {deck_rules['deck_limit'][index]})"
+            )
+        if option != CARD_FREE and deck_rules["counted"][index]:
+            deck_size = deck_size + limited[index]
+        if index in required:
+            groups.add(required[index])
+    for option, total in option_totals.items():
+        limit = deck_rules["limits"][row, option]
+        if not limit or total <= limit:
+            continue
+        if option >= nb_options:
+            code = deck_rules["allowances"][option - nb_options]["code"]
+            problems.append(f"{total} cards allowed by {code} (limit {limit})")
+        else:
+            problems.append(
+                f"{total} cards of deckbuilding option {option + 1} (limit {limit})"
+            )
+    size = deck_rules["size"][row]
+    if size and deck_size < size - DECK_SIZE_MARGIN:
+        problems.append(f"{deck_size} cards (deck size {size})")
+    for group, code in enumerate(deck_rules["required_codes"][row]):
+        if group not in groups:
+            problems.append("Required card missing: " + code)
+    return sorted(problems)
+
+
+#
+# End of deck legality functions
+#
+# Start of shard functions
+#
+
+
+def shard_range(text):
+    """Return the deck IDs of a shard ("START:STOP", STOP excluded) as (start, stop)"""
+    try:
+        start, stop = [int(value) for value in text.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected START:STOP, got " + text)
+    if start < 1 or stop <= start:
+        raise argparse.ArgumentTypeError("empty shard: " + text)
+    return start, stop
+
+
+def shard_parse(start, stop, parsers=PIPELINE_PARSERS):
+    """Parse the decks of a shard (deck IDs from start to stop - 1), return
+    its partial aggregates (see partials_merge)"""
+    # Every deck ID of the shard is checked, the last deck isn't looked for
+    deck_scan.update({"next": start, "stop": stop, "last_found": stop, "retry": []})
+    state = pipeline_run(NB_THREAD, parsers)
+    card_matrix_flush(state["affinity_cards"])
+    state.update({"digest": checkpoint_digest(), "shards": [[start, stop]]})
+    return state
+
+
+def partial_save(state, filename):
+    """Write partial aggregates (same format as the checkpoint)"""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    aggregate_dump(state, filename)
+    logger.info(
+        "%d deck(s) of shard(s) %s written to %s",
+        len(state["valid_decks"]),
+        ", ".join("%d:%d" % (start, stop) for start, stop in state["shards"]),
+        filename,
+    )
+
+
+def partials_merge(filenames):
+    """
+    Merge partial aggregates (see shard_parse) in the aggregates of the run.
+
+    The result doesn't depend on the order of the partials and a partial can
+    be a merge of partials (--merge with --partial). A partial whose shards
+    were already merged (shard retried, or in a merged partial) is skipped.
+
+    Returns:
+      The shards merged ([start, stop] sorted), None if a partial can't be
+      used (unreadable, outdated or overlapping another partial).
+    """
+    partials = []
+    for filename in filenames:
+        try:
+            partials.append((filename, aggregate_read(filename)))
+        except ValueError as error:
+            logger.error("%s, the shard must be parsed again.", error)
+            return None
+    # Largest partials first, their shards are skipped if merged on their own
+    partials.sort(
+        key=lambda item: -sum(stop - start for start, stop in item[1]["shards"])
+    )
+    merged = []
+    for filename, state in partials:
+        covered = [
+            any(start >= first and stop <= last for first, last in merged)
+            for start, stop in state["shards"]
+        ]
+        if all(covered):
+            logger.info("%s already merged, skipped.", filename)
+            continue
+        if any(
+            start < last and first < stop
+            for start, stop in state["shards"]
+            for first, last in merged
+        ):
+            logger.error("%s overlaps shards already merged.", filename)
+            return None
+        merge_aggregate(state)
+        merged.extend(state["shards"])
+    merged.sort()
+    for (first, last), (start, stop) in zip(merged, merged[1:]):
+        if last < start:
+            logger.warning("Deck IDs %d to %d aren't in any shard.", last, start - 1)
+    return merged
+
+
+#
+# End of shard functions
+#
+# Main!
+#
+
+
+if __name__ == "__main__":
+    #
+    # Code begins here...
+    #
+    # Start time for statistics only
+    start_time = datetime.now()
+
+    parser = argparse.ArgumentParser(description="Arkham Horror Analytics")
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default=LOG_LEVEL,
+        help="DEBUG logs every deck/request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-json",
+        metavar="FILE",
+        help="Also write the log in FILE as JSON lines",
+    )
+    parser.add_argument(
+        "--cache-backend",
+        choices=["sqlite", "files"],
+        default=CACHE_BACKEND,
+        help="Where ArkhamDB cards/decks are cached (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--api",
+        default=ARKHAM_DB_API,
+        help="ArkhamDB API URL (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--async-fetch",
+        action="store_true",
+        help="Fetch the decks/cards missing from the cache asynchronously first",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=FETCH_CONCURRENCY,
+        help="Requests in flight with --async-fetch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=FETCH_RATE,
+        help="Requests per second with --async-fetch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sync-by-date",
+        action="store_true",
+        help="Fetch the decks published since the last sync (one request per day) "
+        "instead of fetching the decks by ID",
+    )
+    parser.add_argument(
+        "--fetchers",
+        type=int,
+        default=NB_THREAD,
+        help="Threads reading/fetching the decks not parsed yet (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--parsers",
+        type=int,
+        default=PIPELINE_PARSERS,
+        help="Threads filtering/checking the decks read by the fetchers "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_range,
+        metavar="START:STOP",
+        help="Only parse the deck IDs from START to STOP - 1 and write their "
+        "partial aggregates (see --partial), then exit",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="FILE",
+        help="Write the reports and outputs of partial aggregates (--shard) "
+        "instead of parsing the decks",
+    )
+    parser.add_argument(
+        "--partial",
+        metavar="FILE",
+        help=f"Partial aggregates written by --shard (default: {PARTIALS_PATH}"
+        "shard_START_STOP.pickle.gz), or by --merge instead of the outputs",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Parse the decks in cache with that many processes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Compute the aggregates of the decks in cache from the columnar "
+        "deck store",
+    )
+    parser.add_argument(
+        "--refresh-cards",
+        action="store_true",
+        help="Download the card list from ArkhamDB even if it's up to date",
+    )
+    parser.add_argument(
+        "--build-duplicates",
+        action="store_true",
+        help="Add the reprints of the ArkhamDB card list to duplicates.json and exit",
+    )
+    parser.add_argument(
+        "--prune-duplicates",
+        action="store_true",
+        help="With --build-duplicates, also remove the entries of duplicates.json "
+        "that aren't reprints in the ArkhamDB card list",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the checkpoint of the previous run and parse every deck",
+    )
+    parser.add_argument(
+        "--relevance",
+        type=float,
+        default=RELEVANCE,
+        help="Share of the decks of an investigator a card must be in to be "
+        "in its report, half for XP cards (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--window",
+        metavar="MONTHS|PACK",
+        help="Also write the affinities of the last MONTHS months, or since the "
+        "release of a pack, to aff_inv_window.json",
+    )
+    parser.add_argument(
+        "--json-compact",
+        action="store_true",
+        help="Write the JSON outputs without indentation",
+    )
+    parser.add_argument(
+        "--json-gzip",
+        action="store_true",
+        help="Write the JSON outputs gzip compressed (.json.gz)",
+    )
+    parser.add_argument(
+        "--metrics-prometheus",
+        metavar="FILE",
+        help="Also write the metrics of the run in Prometheus text format",
+    )
+    parser.add_argument(
+        "--migrate-hashes",
+        action="store_true",
+        help="Convert the hashes of decks_grouped_by_hash.json to the new deck "
+        "hash and exit",
+    )
+    parser.add_argument(
+        "--cache-archive",
+        metavar="FILE",
+        help="Read the cards/decks missing from the cache in an archive "
+        "(see --archive-export)",
+    )
+    parser.add_argument(
+        "--archive-export",
+        metavar="FILE",
+        help="Write the cache (cards and decks) to a compressed archive and exit",
+    )
+    parser.add_argument(
+        "--archive-import",
+        metavar="FILE",
+        help="Check an archive and copy its cards/decks in the cache, then exit",
+    )
+    parser.add_argument(
+        "--migrate-cache",
+        action="store_true",
+        help="Copy the per-file cache (db/card, db/decklist) in the packed "
+        "cache and exit",
+    )
+    args = parser.parse_args()
+    log_queue = logging_setup(args.log_level, args.log_json)
+    logger.info("Arkham Horror Analytics")
+    CACHE_BACKEND = args.cache_backend
+    CACHE_ARCHIVE = args.cache_archive
+    ARKHAM_DB_API = args.api
+    FETCH_CONCURRENCY = args.concurrency
+    FETCH_RATE = args.rate
+    RELEVANCE = args.relevance
+    NB_THREAD = args.fetchers
+
+    if args.migrate_cache:
+        cache_migrate()
+        raise SystemExit(0)
+
+    if args.archive_export:
+        archive_export(args.archive_export)
+        raise SystemExit(0)
+
+    if args.archive_import:
+        raise SystemExit(0 if archive_import(args.archive_import) else 1)
+
+    # Load duplicate cards list
+    duplicates = duplicates_load()
+
+    # Load the list of decks/cards known to be missing from ArkhamDB
+    missing_load()
+
+    # Load every card at once
+    with metrics_stage("catalog"):
+        catalog_load(args.refresh_cards)
+
+    # Restore the aggregates of the previous run, only new decks are parsed
+    # (the checkpoint depends on the deckbuilding rules of the card list)
+    if not args.full and not args.shard and not args.merge:
+        with metrics_stage("checkpoint"):
+            checkpoint_load()
+
+    if args.build_duplicates:
+        duplicates_update(args.prune_duplicates)
+        raise SystemExit(0)
+    # The duplicate cards list must be updated when new reprints are released
+    if card_catalog["duplicate_of"]:
+        diff = duplicates_diff(duplicates, duplicates_build())
+        if diff["added"] or diff["changed"]:
+            logger.warning(
+                "Warning: duplicates.json is missing %d reprint(s) found in "
+                "ArkhamDB, run with --build-duplicates.",
+                len(diff["added"]) + len(diff["changed"]),
+            )
+
+    if args.migrate_hashes:
+        migrate_deck_hashes()
+        raise SystemExit(0)
+
+    # Progress of the fetch/parsing is logged periodically (not every deck)
+    progress_stop = threading.Event()
+    threading.Thread(target=progress_report, args=(progress_stop,), daemon=True).start()
+
+    # Only parse a shard of deck IDs, its partial aggregates are merged by
+    # another run (--merge)
+    if args.shard:
+        with metrics_stage("parse"):
+            partial_save(
+                shard_parse(*args.shard, args.parsers),
+                args.partial or PARTIALS_PATH + "shard_%d_%d.pickle.gz" % args.shard,
+            )
+        progress_stop.set()
+        raise SystemExit(0)
+
+    # Aggregates of the shards parsed by other runs (--shard)
+    if args.merge:
+        with metrics_stage("merge"):
+            merged_shards = partials_merge(args.merge)
+        if merged_shards is None:
+            raise SystemExit(1)
+        deck_scan["last_found"] = max(valid_decks, default=0)
+        # Partial of the merged partials (to be merged with others)
+        if args.partial:
+            state = aggregate_state()
+            state.update({"digest": checkpoint_digest(), "shards": merged_shards})
+            partial_save(state, args.partial)
+            raise SystemExit(0)
+    else:
+        # Fill the cache with the decks published since the last sync
+        if args.sync_by_date:
+            with metrics_stage("sync"):
+                SYNC_BY_DATE = asyncio.run(fetch_by_date_async())
+            if SYNC_BY_DATE:
+                # Decks in cache are all the published decks, there's no need
+                # to look for the last deck
+                deck_scan["last_found"] = max(
+                    deck_scan["last_found"], cache_last_id("decklist")
+                )
+            else:
+                logger.warning(
+                    "Some days couldn't be fetched, the decks missing from the "
+                    "cache are fetched by ID."
+                )
+
+        # Fill the cache first, so workers only parse cached decks
+        if args.async_fetch and not SYNC_BY_DATE:
+            with metrics_stage("fetch"):
+                asyncio.run(fetch_missing_async())
+
+        # Aggregates of the decks in cache computed from the columnar deck store
+        if args.columnar:
+            with metrics_stage("columnar"):
+                process_deck_store(deck_store_update())
+
+        # Parse the decks in cache with worker processes
+        if args.processes > 1:
+            with metrics_stage("processes"):
+                process_cached_decks(args.processes)
+
+        #
+        # Fetch, parse and aggregate the other decks with a pipeline of threads
+        # (its aggregates are merged once all decks are done)
+        #
+        with metrics_stage("parse"):
+            merge_aggregate(pipeline_run(NB_THREAD, args.parsers))
+
+    progress_stop.set()
+
+    #
+    # Based on the raw stats render the reports
+    # Per investigators stats/data.
+    #
+    with metrics_stage("render"):
+        reports_written = render_reports()
+
+    #
+    # Post processing...
+    #
+
+    # Shards may not cover every deck, the next run starts from scratch
+    if not args.merge:
+        with metrics_stage("save"):
+            missing_save(deck_scan["last_found"])
+            checkpoint_save()
+
+    # Cards are only ordered when the output is written (one key at a time)
+    with metrics_stage("json_output"):
+        json_extension = ".json.gz" if args.json_gzip else ".json"
+        json_stream_to_file(
+            (
+                (inv, dict_order_by_keys(affinity_investigators[inv]))
+                for inv in sorted(affinity_investigators)
+            ),
+            JSON_PATH + "aff_inv" + json_extension,
+            args.json_compact,
+        )
+        json_stream_to_file(
+            (
+                (inv, dict_order_by_keys(affinity_investigators_xp[inv]))
+                for inv in sorted(affinity_investigators_xp)
+            ),
+            JSON_PATH + "aff_inv_xp" + json_extension,
+            args.json_compact,
+        )
+        json_stream_to_file(
+            card_matrix_rows(affinity_cards),
+            JSON_PATH + "aff_cards" + json_extension,
+            args.json_compact,
+        )
+        json_stream_to_file(
+            (
+                (key, decks_grouped_by_hash[key])
+                for key in sorted(decks_grouped_by_hash)
+            ),
+            JSON_PATH + "decks_grouped_by_hash" + json_extension,
+            args.json_compact,
+        )
+        json_stream_to_file(
+            (
+                (str(deck_id), invalid_decks[deck_id])
+                for deck_id in sorted(invalid_decks)
+            ),
+            JSON_PATH + "invalid_decks" + json_extension,
+            args.json_compact,
+        )
+        json_stream_to_file(
+            (
+                (month, month_bucket_sorted(affinity_months[month]))
+                for month in sorted(affinity_months)
+            ),
+            JSON_PATH + "aff_inv_months" + json_extension,
+            args.json_compact,
+        )
+
+    # Rolling window: sum of the months of the window
+    if args.window:
+        with metrics_stage("window"):
+            window_first = window_start(
+                args.window, {} if args.window.isdigit() else packs_load()
+            )
+            if window_first is None:
+                logger.warning("Unknown pack: %s, window not written.", args.window)
+            else:
+                json_stream_to_file(
+                    [("since", window_first)]
+                    + list(month_bucket_sorted(window_aggregate(window_first)).items()),
+                    JSON_PATH + "aff_inv_window" + json_extension,
+                    args.json_compact,
+                )
+
+    # Normalized card affinity (the raw counts favor the most played cards)
+    with metrics_stage("similarity"):
+        similarity_save(similarity_build(affinity_cards))
 
-    print("\n\n")
-    print("Unique decks :    " + str(len(decks_grouped_by_hash)))
-    print("Duplicated decks: " + str(len(valid_decks) - len(decks_grouped_by_hash)))
-    print("Total decks:      " + str(len(valid_decks)))
+    summary = {
+        "start": start_time.isoformat(timespec="seconds"),
+        "runtime_seconds": round((datetime.now() - start_time).total_seconds(), 3),
+        "threads": NB_THREAD,
+        "processes": args.processes,
+        "unique_decks": len(decks_grouped_by_hash),
+        "duplicated_decks": len(valid_decks)
+        - len(decks_grouped_by_hash)
+        - len(invalid_decks),
+        "invalid_decks": len(invalid_decks),
+        "unchecked_decks": len(unchecked_decks),
+        "total_decks": len(valid_decks),
+        "last_deck_found": deck_scan["last_found"],
+        "reports_written": reports_written,
+    }
+    summary_lines = [
+        "\n\n",
+        "Unique decks :    " + str(summary["unique_decks"]),
+        "Duplicated decks: " + str(summary["duplicated_decks"]),
+        "Invalid decks:    " + str(summary["invalid_decks"]),
+        "Unchecked decks:  " + str(summary["unchecked_decks"]),
+        "Total decks:      " + str(summary["total_decks"]),
+        "Last deck found:  " + str(summary["last_deck_found"]),
+        "Reports written:  " + str(summary["reports_written"]),
+        f"\nNumber of thread(s) used: {NB_THREAD}",
+        f"Runtime {format(datetime.now() - start_time)}.",
+    ]
+    logger.info("%s", "\n".join(summary_lines), extra={"fields": summary})
 
-    print(f"\nNumber of thread(s) used: {NB_THREAD}")
-    print(f"Runtime {format(datetime.now() - start_time)}.")
+    # Run report (and metrics in Prometheus text format)
+    json_to_file(metrics_report(summary), RUN_REPORT_PATH)
+    if args.metrics_prometheus:
+        write_to_file(metrics_prometheus(), args.metrics_prometheus)
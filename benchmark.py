@@ -0,0 +1,651 @@
+#!/usr/bin/python3
+
+"""Benchmarks of arkham.py on a synthetic deck corpus (no ArkhamDB access)"""
+
+import argparse
+import asyncio
+import contextlib
+from datetime import datetime, timedelta
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+import numpy as np
+import arkham
+
+# Synthetic corpus (same seed, same cards and decks)
+BENCH_SEED = 1
+NB_INVESTIGATORS = 60
+NB_PLAYER_CARDS = 1500
+NB_ENCOUNTER_CARDS = 300
+NB_REPRINTS = 100
+DECK_CARDS = (15, 30)  # Number of different cards in a deck (min, max)
+MISSING_RATE = 0.03  # Deleted decks (HTTP 404)
+DUPLICATE_RATE = 0.05  # Copies of another deck
+ILLEGAL_RATE = 0.05  # Decks with cards of any class (not counted)
+SELECT_RATE = 0.1  # Investigators choosing their secondary class (meta)
+FIRST_DATE = datetime(2016, 10, 1)
+# Decks are generated/parsed by chunks (memory doesn't grow with the scale)
+BENCH_CHUNK = 10000
+# Local stand-in of the ArkhamDB API
+STAND_IN_LATENCY = 0.0  # Seconds added to each response
+STAND_IN_ERROR_RATE = 0.0  # Share of responses replaced by a HTTP 503
+STAGES = [
+    "fetch",
+    "parse",
+    "filter_out_cards",
+    "dedup_hashing",
+    "affinity",
+    "rendering",
+    "json_output",
+]
+RESULTS_PATH = "./benchmark.json"
+
+#
+# FUNCTION DEFINITIONS STARTS HERE
+#
+# Synthetic corpus functions starts here
+#
+
+
+def synthetic_cards(seed=BENCH_SEED):
+    """Return the card list of the corpus (same fields as ArkhamDB /cards/)"""
+    rng = random.Random(seed)
+    factions = ["guardian", "seeker", "rogue", "mystic", "survivor", "neutral"]
+    cards = [
+        {
+            "code": "01000",
+            "name": "Random Basic Weakness",
+            "type_code": "treachery",
+            "subtype_code": "basicweakness",
+            "faction_code": "neutral",
+            "pack_code": "core",
+            "xp": None,
+        }
+    ]
+    signatures = []
+    for index in range(NB_INVESTIGATORS):
+        code = "90" + str(index + 1).zfill(3)
+        faction = factions[index % 5]
+        # Deckbuilding options of ArkhamDB: its class, a secondary class up to
+        # level 2 (chosen in the deck meta by some investigators)
+        secondary = {"level": {"min": 0, "max": 2}}
+        if index % round(1 / SELECT_RATE) == round(1 / SELECT_RATE) - 1:
+            secondary.update(
+                {
+                    "id": "faction_selected",
+                    "name": "Secondary Class",
+                    "faction_select": [
+                        other for other in factions[:5] if other != faction
+                    ],
+                }
+            )
+        else:
+            secondary["faction"] = [factions[(index + 1) % 5]]
+        signature, weakness = "94" + code[2:], "95" + code[2:]
+        cards.append(
+            {
+                "code": code,
+                "name": "Investigator " + code,
+                "type_code": "investigator",
+                "faction_code": faction,
+                "pack_code": "bench",
+                "xp": None,
+                "back_flavor": "Back flavor of " + code,
+                "deck_options": [
+                    {"faction": [faction, "neutral"], "level": {"min": 0, "max": 5}},
+                    secondary,
+                ],
+                "deck_requirements": {
+                    "size": 30,
+                    "card": {
+                        signature: {signature: signature},
+                        weakness: {weakness: weakness},
+                    },
+                    "random": [{"target": "subtype", "value": "basicweakness"}],
+                },
+            }
+        )
+        signatures.append(
+            {
+                "code": signature,
+                "name": "Signature " + code,
+                "type_code": "asset",
+                "faction_code": faction,
+                "pack_code": "bench",
+                "xp": 0,
+                "deck_limit": 1,
+                "restrictions": {"investigator": {code: code}},
+            }
+        )
+        signatures.append(
+            {
+                "code": weakness,
+                "name": "Weakness " + code,
+                "type_code": "treachery",
+                "subtype_code": "weakness",
+                "faction_code": "neutral",
+                "pack_code": "bench",
+                "xp": None,
+                "deck_limit": 1,
+                "restrictions": {"investigator": {code: code}},
+            }
+        )
+    for index in range(NB_PLAYER_CARDS):
+        code = "91" + str(index + 1).zfill(3)
+        card = {
+            "code": code,
+            "name": "Card " + code,
+            "type_code": rng.choice(["asset", "event", "skill"]),
+            "faction_code": rng.choice(factions),
+            "pack_code": "bench",
+            "xp": rng.choice([0, 0, 0, 0, 1, 2, 3, 4, 5, None]),
+        }
+        # Player cards without XP are weaknesses (allowed in every deck)
+        if card["xp"] is None:
+            card["subtype_code"] = "weakness"
+        cards.append(card)
+    for index in range(NB_ENCOUNTER_CARDS):
+        code = "92" + str(index + 1).zfill(3)
+        cards.append(
+            {
+                "code": code,
+                "name": "Encounter " + code,
+                "type_code": "treachery",
+                "subtype_code": "weakness",
+                "faction_code": "mythos",
+                "pack_code": "bench",
+                "encounter_code": "bench_" + str(index % 20),
+                "xp": None,
+            }
+        )
+    for index in range(NB_REPRINTS):
+        original = cards[1 + NB_INVESTIGATORS + index]
+        cards.append(
+            dict(
+                original,
+                code="93" + str(index + 1).zfill(3),
+                duplicate_of_code=original["code"],
+            )
+        )
+    return cards + signatures
+
+
+def synthetic_allowed(investigator, choice, card):
+    """Return True if the deckbuilding options of an investigator (with the
+    choice of its secondary class) allow a player card"""
+    for option in investigator["deck_options"]:
+        factions = option.get("faction") or [choice]
+        level = option["level"]
+        if (
+            card["faction_code"] in factions
+            and level["min"] <= card["xp"] <= level["max"]
+        ):
+            return True
+    return False
+
+
+def synthetic_slots(rng, player_codes, encounter_codes, reprint_codes):
+    """Return random deck slots (popular cards are picked more often)"""
+    nb_cards = rng.randint(*DECK_CARDS)
+    slots = {}
+    while len(slots) < nb_cards:
+        # Half of the cards follow a Zipf-like popularity (card N is picked
+        # ~1/N as often as the first one), the other half are picked at random
+        if rng.random() < 0.5:
+            index = min(int(rng.paretovariate(1.0)) - 1, len(player_codes) - 1)
+        else:
+            index = rng.randrange(len(player_codes))
+        code = player_codes[index]
+        # Some decks use the reprint of a card
+        if rng.random() < 0.05:
+            code = reprint_codes.get(code, code)
+        slots[code] = rng.choice([1, 2, 2])
+    slots["01000"] = 1
+    # Signature weakness/story cards are encounter cards
+    if rng.random() < 0.2:
+        slots[rng.choice(encounter_codes)] = 1
+    return slots
+
+
+def synthetic_deck(deck_id, corpus):
+    """Return a deck of the corpus (the same for a deck ID), None if deleted"""
+    rng = random.Random(f"{corpus['seed']}:{deck_id}")
+    if rng.random() < MISSING_RATE:
+        return None
+    # Investigator and slots have their own generator, a copy of a deck
+    # published just before uses the generator of that deck
+    slots_id = deck_id
+    if deck_id > 50 and rng.random() < DUPLICATE_RATE:
+        slots_id = deck_id - rng.randint(1, 50)
+    slots_rng = random.Random(f"{corpus['seed']}:{slots_id}:slots")
+    investigator = corpus["investigators"][
+        min(int(slots_rng.expovariate(0.1)), len(corpus["investigators"]) - 1)
+    ]
+    meta = {}
+    choices = [
+        option["faction_select"]
+        for option in investigator["deck_options"]
+        if option.get("faction_select")
+    ]
+    if choices:
+        meta["faction_selected"] = slots_rng.choice(choices[0])
+    player_codes = corpus["player_codes"][
+        (investigator["code"], meta.get("faction_selected"))
+    ]
+    if slots_rng.random() < ILLEGAL_RATE:
+        player_codes = corpus["player_codes"][None]
+    slots = synthetic_slots(
+        slots_rng, player_codes, corpus["encounter_codes"], corpus["reprint_codes"]
+    )
+    # Signature cards and weaknesses of the investigator
+    for code in investigator["deck_requirements"]["card"]:
+        slots[code] = 1
+    date = FIRST_DATE + timedelta(minutes=deck_id * 5)
+    return {
+        "id": deck_id,
+        "name": "Deck " + str(deck_id),
+        "date_creation": date.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+        "investigator_code": investigator["code"],
+        "investigator_name": investigator["name"],
+        "xp": rng.choice([None, None, 0, 5, 12, 30]),
+        "meta": json.dumps(meta) if meta else "",
+        "slots": slots,
+    }
+
+
+def synthetic_corpus(seed=BENCH_SEED):
+    """Return the cards of the corpus and what's needed to generate its decks"""
+    cards = synthetic_cards(seed)
+    investigators = [card for card in cards if card["type_code"] == "investigator"]
+    player_cards = [
+        card
+        for card in cards
+        if card["code"].startswith("91") and not card.get("subtype_code")
+    ]
+    # Cards allowed for each investigator and choice (None: any card)
+    player_codes = {None: [card["code"] for card in player_cards]}
+    for investigator in investigators:
+        choices = [None]
+        for option in investigator["deck_options"]:
+            choices = option.get("faction_select") or choices
+        for choice in choices:
+            player_codes[(investigator["code"], choice)] = [
+                card["code"]
+                for card in player_cards
+                if synthetic_allowed(investigator, choice, card)
+            ]
+    return {
+        "seed": seed,
+        "cards": cards,
+        "cards_by_code": {card["code"]: card for card in cards},
+        "investigators": investigators,
+        "player_codes": player_codes,
+        "encounter_codes": [
+            card["code"] for card in cards if card.get("encounter_code")
+        ],
+        "reprint_codes": {
+            card["duplicate_of_code"]: card["code"]
+            for card in cards
+            if card.get("duplicate_of_code")
+        },
+    }
+
+
+#
+# End of synthetic corpus functions
+#
+# Start of ArkhamDB stand-in functions
+#
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """ArkhamDB API stand-in: /cards/, /card/<code>.json, /decklist/<id>.json"""
+
+    protocol_version = "HTTP/1.1"  # Keep-alive connections
+    # Headers and body are sent separately, Nagle would delay the body
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """Answer a request (with the latency/errors of the server config)"""
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            failed = server.rng.random() < server.error_rate
+        path = self.path.split("?")[0]
+        if failed:
+            self.send_body(503, b"Service Unavailable")
+        elif path.endswith("/cards/"):
+            self.send_body(200, server.bulk_cards)
+        elif "/card/" in path:
+            card = server.corpus["cards_by_code"].get(
+                path.rsplit("/", 1)[1][: -len(".json")]
+            )
+            self.send_json(card)
+        elif "/decklist/" in path:
+            deck_id = path.rsplit("/", 1)[1][: -len(".json")]
+            deck = None
+            if deck_id.isdigit() and 0 < int(deck_id) <= server.nb_decks:
+                deck = synthetic_deck(int(deck_id), server.corpus)
+            self.send_json(deck)
+        else:
+            self.send_body(404, b"Not Found")
+
+    def send_json(self, content):
+        """Send a JSON document (HTTP 404 if there's no content)"""
+        if content is None:
+            self.send_body(404, b"Not Found")
+        else:
+            self.send_body(200, json.dumps(content).encode("utf-8"))
+
+    def send_body(self, status, body):
+        """Send a response with its length (needed by keep-alive connections)"""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """No log for each request"""
+
+
+def start_stand_in(corpus, nb_decks, port=0, latency=0.0, error_rate=0.0):
+    """Start the ArkhamDB API stand-in in a thread, return the server"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.corpus = corpus
+    server.bulk_cards = json.dumps(corpus["cards"]).encode("utf-8")
+    server.nb_decks = nb_decks
+    server.latency = latency
+    server.error_rate = error_rate
+    server.rng = random.Random(corpus["seed"])
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stand_in_url(server):
+    """Return the API URL of the stand-in (to use as ARKHAM_DB_API)"""
+    return f"http://127.0.0.1:{server.server_address[1]}/api/public/"
+
+
+#
+# End of ArkhamDB stand-in functions
+#
+# Start of benchmark functions
+#
+
+
+@contextlib.contextmanager
+def stage_timer(results, scale, stage, items, decks=None):
+    """Time a stage and add it to the results (of a scale, run on `decks`
+    deck IDs, the scale by default)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+    for result in results:
+        if result["scale"] == scale and result["stage"] == stage:
+            break
+    else:
+        result = {
+            "scale": scale,
+            "decks": scale if decks is None else decks,
+            "stage": stage,
+            "items": 0,
+            "seconds": 0.0,
+        }
+        results.append(result)
+    result["items"] = result["items"] + items
+    result["seconds"] = result["seconds"] + seconds
+
+
+def reset_aggregates():
+    """Empty the aggregates of arkham.py (between two scales)"""
+    arkham.affinity_investigators.clear()
+    arkham.affinity_investigators_xp.clear()
+    arkham.affinity_months.clear()
+    arkham.affinity_cards = arkham.new_card_matrix()
+    arkham.decks_grouped_by_hash.clear()
+    arkham.deck_representatives.clear()
+    arkham.valid_decks.clear()
+    arkham.invalid_decks.clear()
+    arkham.unchecked_decks.clear()
+
+
+def bench_fetch(results, corpus, scale, nb_decks, args):
+    """Fetch decks (and their cards) from the stand-in with --async-fetch (only
+    `nb_decks` deck IDs of the scale)"""
+    server = start_stand_in(corpus, nb_decks, 0, args.latency, args.error_rate)
+    with tempfile.TemporaryDirectory() as path:
+        arkham.ARKHAM_DB_API = stand_in_url(server)
+        arkham.CACHE_BACKEND = "sqlite"
+        arkham.CACHE_DB = os.path.join(path, "cache.sqlite")
+        arkham.cache_connection = None
+        arkham.FETCH_CONCURRENCY = args.concurrency
+        arkham.FETCH_RATE = args.rate
+        arkham.FETCH_BURST = args.concurrency
+        arkham.LAST_DECK = nb_decks + 1
+        arkham.missing.clear()
+        arkham.deck_scan.update({"next": 1, "stop": None, "last_found": 0, "retry": []})
+        with stage_timer(results, scale, "fetch", nb_decks, nb_decks):
+            asyncio.run(arkham.fetch_missing_async())
+        arkham.cache_connection.close()
+        arkham.cache_connection = None
+    server.shutdown()
+    server.server_close()
+
+
+def bench_chunk(results, scale, corpus, deck_ids, aggregate):
+    """Parse, check, hash and count a chunk of decks (like worker())"""
+    # Decks are timed from their cached (compressed JSON) form
+    payloads = [
+        arkham.cache_encode(deck)
+        for deck in (synthetic_deck(deck_id, corpus) for deck_id in deck_ids)
+        if deck is not None
+    ]
+    with stage_timer(results, scale, "parse", len(payloads)):
+        decks = [arkham.cache_decode(payload) for payload in payloads]
+    with stage_timer(results, scale, "filter_out_cards", len(decks)):
+        decks = [arkham.deck_record(deck) for deck in decks]
+    # Legality check, deduplication and hash
+    with stage_timer(results, scale, "dedup_hashing", len(decks)):
+        parsed = [arkham.deck_parse(deck) for deck in decks]
+    with stage_timer(results, scale, "affinity", len(decks)):
+        for deck, deck_parsed in zip(decks, parsed):
+            arkham.deck_aggregate(aggregate, deck, *deck_parsed)
+
+
+def bench_scale(results, corpus, scale, args):
+    """Run the benchmarks of every stage at a scale (number of deck IDs)"""
+    if "fetch" in args.stages:
+        bench_fetch(results, corpus, scale, min(scale, args.fetch_decks), args)
+    reset_aggregates()
+    aggregate = arkham.new_aggregate()
+    for start in range(1, scale + 1, BENCH_CHUNK):
+        deck_ids = range(start, min(start + BENCH_CHUNK, scale + 1))
+        bench_chunk(results, scale, corpus, deck_ids, aggregate)
+    with stage_timer(results, scale, "affinity", 0):
+        arkham.card_matrix_flush(aggregate["affinity_cards"])
+        arkham.merge_aggregate(aggregate)
+    with tempfile.TemporaryDirectory() as path:
+        arkham.TEXT_PATH = os.path.join(path, "")
+        arkham.HTML_PATH = os.path.join(path, "")
+        nb_reports = len(arkham.affinity_investigators) + len(
+            arkham.affinity_investigators_xp
+        )
+        with stage_timer(results, scale, "rendering", nb_reports):
+            arkham.render_reports()
+        # Same reports again, nothing is written
+        with stage_timer(results, scale, "rendering_unchanged", nb_reports):
+            arkham.render_reports()
+        with stage_timer(results, scale, "json_output", len(arkham.valid_decks)):
+            arkham.json_stream_to_file(
+                (
+                    (inv, arkham.dict_order_by_keys(arkham.affinity_investigators[inv]))
+                    for inv in sorted(arkham.affinity_investigators)
+                ),
+                os.path.join(path, "aff_inv.json"),
+            )
+            arkham.json_stream_to_file(
+                arkham.card_matrix_rows(arkham.affinity_cards),
+                os.path.join(path, "aff_cards.json"),
+            )
+            arkham.json_stream_to_file(
+                (
+                    (key, arkham.decks_grouped_by_hash[key])
+                    for key in sorted(arkham.decks_grouped_by_hash)
+                ),
+                os.path.join(path, "decks_grouped_by_hash.json"),
+            )
+    # Stages not selected are still run (the next ones need them), not reported
+    results[:] = [
+        result
+        for result in results
+        if result["scale"] != scale
+        or result["stage"] in args.stages
+        or (result["stage"] == "rendering_unchanged" and "rendering" in args.stages)
+    ]
+
+
+def results_summary(results):
+    """Return the results as a text table"""
+    lines = [
+        f"{'Scale':>9} {'Decks':>9} {'Stage':<20} {'Items':>9} {'Seconds':>9} "
+        f"{'Items/s':>11}"
+    ]
+    for result in results:
+        lines.append(
+            f"{result['scale']:>9} {result['decks']:>9} {result['stage']:<20} "
+            f"{result['items']:>9} {result['seconds']:>9.3f} "
+            f"{result['per_second']:>11.0f}"
+        )
+    return "\n".join(lines)
+
+
+#
+# End of benchmark functions
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Arkham Horror Analytics benchmarks")
+    parser.add_argument(
+        "--decks",
+        type=int,
+        nargs="+",
+        default=[10000],
+        help="Scales: number of deck IDs of the corpus (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        help="Stages to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--fetch-decks",
+        type=int,
+        default=2000,
+        help="Maximum number of decks fetched from the stand-in (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=arkham.FETCH_CONCURRENCY,
+        help="Requests in flight for the fetch stage (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1000000,
+        help="Requests per second for the fetch stage (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=STAND_IN_LATENCY,
+        help="Seconds added to each stand-in response (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=STAND_IN_ERROR_RATE,
+        help="Share of stand-in responses that are a HTTP 503 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=BENCH_SEED,
+        help="Seed of the synthetic corpus (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output",
+        default=RESULTS_PATH,
+        help="JSON results file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        metavar="PORT",
+        help="Only run the ArkhamDB stand-in on that port (use with arkham.py --api)",
+    )
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.seed)
+
+    if args.serve is not None:
+        server = start_stand_in(
+            corpus, max(args.decks), args.serve, args.latency, args.error_rate
+        )
+        print(f"ArkhamDB stand-in: {stand_in_url(server)} (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        sys.exit()
+
+    # Cards of the corpus are the card catalog (nothing is read from ./db/)
+    for card in corpus["cards"]:
+        arkham.catalog_add(card)
+    arkham.duplicates = types.MappingProxyType(arkham.duplicates_build())
+    arkham.rules_compile(corpus["cards"])
+
+    results = []
+    for scale in args.decks:
+        print(f"Benchmarking {scale} deck IDs...")
+        bench_scale(results, corpus, scale, args)
+    for result in results:
+        result["per_second"] = (
+            result["items"] / result["seconds"] if result["seconds"] else 0
+        )
+
+    arkham.json_to_file(
+        {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {
+                "seed": args.seed,
+                "fetch_decks": args.fetch_decks,
+                "concurrency": args.concurrency,
+                "rate": args.rate,
+                "latency": args.latency,
+                "error_rate": args.error_rate,
+            },
+            "results": results,
+        },
+        args.output,
+    )
+    print(results_summary(results))
+    print(f"Results saved in {args.output}")
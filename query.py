@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+
+"""Queries over the card affinities computed by arkham.py (library and HTTP API)"""
+
+import argparse
+import bisect
+import gzip
+import http.server
+import json
+import os
+import urllib.parse
+import arkham
+
+# Co-occurring cards kept for each card (most frequent first)
+CARD_TOP_K = 200
+# Default number of cards returned by a query
+QUERY_LIMIT = 20
+
+#
+# FUNCTION DEFINITIONS STARTS HERE
+#
+# Index functions starts here
+#
+
+
+def sorted_counts(counts, top_k=None, keep=None):
+    """
+    Return the cards ordered by count (highest first).
+
+    Args:
+      counts: {card code: count}.
+      top_k: Number of cards kept (None: every card).
+      keep: Function telling if a card is kept (None: every card).
+
+    Returns:
+      {"decks", "codes", "counts", "negated"}, decks is the highest count
+      (before `keep`), like "Stats based on" in the reports.
+    """
+    items = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    decks = items[0][1] if items else 0
+    if keep is not None:
+        items = [item for item in items if keep(item[0])]
+    items = items[:top_k]
+    return {
+        "decks": decks,
+        "codes": [code for code, count in items],
+        "counts": [count for code, count in items],
+        # Ascending, to find the cards above a count with bisect
+        "negated": [-count for code, count in items],
+    }
+
+
+def json_items(path):
+    """Return the (key, value) pairs of a JSON output (.json or .json.gz)"""
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        path = path + ".gz"
+    if not os.path.exists(path):
+        return iter([])
+    return arkham.json_stream_from_file(path)
+
+
+def index_load(json_path=arkham.JSON_PATH, catalog_path=arkham.CARD_CATALOG_PATH):
+    """
+    Load the affinities written by arkham.py and sort them once.
+
+    Args:
+      json_path: Folder of aff_inv.json, aff_inv_xp.json, aff_cards.json and
+        card_similarity.npz.
+      catalog_path: Card list (names and XP of the cards), optional.
+
+    Returns:
+      The index used by the queries.
+    """
+    index = {"investigators": {}, "cards": {}, "names": {}, "xp": {}}
+    if os.path.exists(catalog_path):
+        with gzip.open(catalog_path, "rt", encoding="utf-8") as file:
+            for card in json.load(file):
+                index["names"][card["code"]] = card.get("name", card["code"])
+                if isinstance(card.get("xp"), int):
+                    index["xp"][card["code"]] = card["xp"]
+    # Like the XP reports, only cards with XP are kept for the XP decks
+    # (when the card list is known)
+    keep_xp = None
+    if index["xp"]:
+        keep_xp = lambda code: index["xp"].get(code, 0) > 0
+    for kind, file_name, keep in [
+        ("base", "aff_inv.json", None),
+        ("xp", "aff_inv_xp.json", keep_xp),
+    ]:
+        index["investigators"][kind] = {
+            inv: sorted_counts(counts, keep=keep)
+            for inv, counts in json_items(os.path.join(json_path, file_name))
+        }
+    # Rows are read one at a time, only the top K of each row is kept
+    for code, counts in json_items(os.path.join(json_path, "aff_cards.json")):
+        index["cards"][code] = sorted_counts(counts, CARD_TOP_K)
+    # Already sorted by arkham.py
+    index["similarity"] = arkham.similarity_load(
+        os.path.join(json_path, os.path.basename(arkham.SIMILARITY_PATH))
+    )
+    return index
+
+
+#
+# End of index functions
+#
+# Start of query functions
+#
+
+
+def card_info(index, code, count=None, decks=None):
+    """Return a card of a query result"""
+    info = {"code": code, "name": index["names"].get(code, code)}
+    if count is not None:
+        info["count"] = count
+    if decks:
+        info["percent"] = round(count * 100 / decks, 1)
+    return info
+
+
+def top_investigator_cards(index, inv, limit=QUERY_LIMIT, relevance=None, xp=False):
+    """
+    Return the cards the most used in the decks of an investigator.
+
+    Args:
+      index: Index returned by index_load.
+      inv: Investigator card code.
+      limit: Maximum number of cards (None: no limit).
+      relevance: Share of the decks a card must be in (RELEVANCE by default,
+        half for XP decks like the reports).
+      xp: True for the XP decks (only cards with XP, see index_load).
+
+    Returns:
+      None if the investigator is unknown, else the number of decks and the cards.
+    """
+    ranking = index["investigators"]["xp" if xp else "base"].get(inv)
+    if ranking is None:
+        return None
+    if relevance is None:
+        relevance = arkham.RELEVANCE / 2 if xp else arkham.RELEVANCE
+    decks = ranking["decks"]
+    # Cards used in more than `relevance` of the decks
+    stop = bisect.bisect_left(ranking["negated"], -decks * relevance)
+    if limit is not None:
+        stop = min(stop, limit)
+    return {
+        "investigator": card_info(index, inv),
+        "decks": decks,
+        "cards": [
+            card_info(index, code, count, decks)
+            for code, count in zip(ranking["codes"][:stop], ranking["counts"][:stop])
+        ],
+    }
+
+
+def top_cooccurring_cards(index, code, limit=QUERY_LIMIT):
+    """Return the cards the most often in the same decks as a card (None if unknown)"""
+    ranking = index["cards"].get(code)
+    if ranking is None:
+        return None
+    return {
+        "card": card_info(index, code),
+        "cards": [
+            card_info(index, other, count)
+            for other, count in zip(ranking["codes"][:limit], ranking["counts"][:limit])
+        ],
+    }
+
+
+def similar_cards(index, code, metric="lift", limit=QUERY_LIMIT):
+    """
+    Return the cards the most similar to a card (None if unknown).
+
+    Args:
+      index: Index returned by index_load.
+      code: Card code.
+      metric: lift, pmi, jaccard or cosine (see arkham.similarity_scores).
+      limit: Maximum number of cards (None: no limit).
+    """
+    similarity = index["similarity"]
+    if similarity is None or code not in similarity["positions"]:
+        return None
+    return {
+        "card": card_info(index, code),
+        "metric": metric,
+        "cards": [
+            dict(card_info(index, other, count), score=round(score, 4))
+            for other, score, count in arkham.similar_cards(
+                similarity, code, metric, limit
+            )
+        ],
+    }
+
+
+def investigators(index):
+    """Return the investigators with their number of decks (base and XP)"""
+    codes = set(index["investigators"]["base"]) | set(index["investigators"]["xp"])
+    result = []
+    for inv in sorted(codes):
+        info = {"code": inv, "name": index["names"].get(inv, inv)}
+        for kind in ["base", "xp"]:
+            ranking = index["investigators"][kind].get(inv)
+            info[kind + "_decks"] = ranking["decks"] if ranking else 0
+        result.append(info)
+    return result
+
+
+#
+# End of query functions
+#
+# Start of HTTP API functions
+#
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP API over the index (JSON responses):
+      /investigators
+      /investigator/<code>?limit=20&relevance=0.1&xp=1
+      /card/<code>?limit=20
+      /similar/<code>?limit=20&metric=lift
+    """
+
+    def do_GET(self):
+        """Answer a query"""
+        url = urllib.parse.urlsplit(self.path)
+        parameters = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/")
+        try:
+            limit = int(parameters.get("limit", QUERY_LIMIT))
+            relevance = parameters.get("relevance")
+            relevance = None if relevance is None else float(relevance)
+        except ValueError:
+            self.send_json(400, {"error": "Invalid limit or relevance"})
+            return
+        xp = parameters.get("xp", "0").lower() in ["1", "true", "yes"]
+        metric = parameters.get("metric", "lift")
+        if metric not in arkham.SIMILARITY_METRICS:
+            self.send_json(400, {"error": "Invalid metric"})
+            return
+        result = None
+        if parts == ["investigators"]:
+            result = investigators(self.server.index)
+        elif len(parts) == 2 and parts[0] == "investigator":
+            result = top_investigator_cards(
+                self.server.index, parts[1], limit, relevance, xp
+            )
+        elif len(parts) == 2 and parts[0] == "card":
+            result = top_cooccurring_cards(self.server.index, parts[1], limit)
+        elif len(parts) == 2 and parts[0] == "similar":
+            result = similar_cards(self.server.index, parts[1], metric, limit)
+        if result is None:
+            self.send_json(404, {"error": "Not found"})
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status, content):
+        """Send a JSON response"""
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(index, port, host="127.0.0.1"):
+    """Answer queries over HTTP until interrupted"""
+    server = http.server.ThreadingHTTPServer((host, port), QueryHandler)
+    server.index = index
+    print(f"Query API: http://{host}:{port}/investigators (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+#
+# End of HTTP API functions
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Arkham Horror Analytics queries")
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument(
+        "--investigator", metavar="CODE", help="Top cards of an investigator"
+    )
+    query.add_argument("--card", metavar="CODE", help="Cards the most used with a card")
+    query.add_argument(
+        "--similar", metavar="CODE", help="Cards the most similar to a card"
+    )
+    query.add_argument("--serve", type=int, metavar="PORT", help="Run the HTTP API")
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=QUERY_LIMIT,
+        help="Number of cards (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--relevance",
+        type=float,
+        help=f"Share of the decks a card must be in (default: {arkham.RELEVANCE}, "
+        "half with --xp)",
+    )
+    parser.add_argument(
+        "--xp", action="store_true", help="XP decks/cards of the investigator"
+    )
+    parser.add_argument(
+        "--metric",
+        choices=arkham.SIMILARITY_METRICS,
+        default="lift",
+        help="Similarity score of --similar (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--json-path",
+        default=arkham.JSON_PATH,
+        help="Folder of the JSON outputs (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    affinity_index = index_load(args.json_path)
+    if args.serve is not None:
+        serve(affinity_index, args.serve)
+    else:
+        if args.investigator:
+            answer = top_investigator_cards(
+                affinity_index, args.investigator, args.limit, args.relevance, args.xp
+            )
+        elif args.card:
+            answer = top_cooccurring_cards(affinity_index, args.card, args.limit)
+        else:
+            answer = similar_cards(
+                affinity_index, args.similar, args.metric, args.limit
+            )
+        if answer is None:
+            raise SystemExit(
+                "Not found: " + (args.investigator or args.card or args.similar)
+            )
+        print(json.dumps(answer, indent=4))
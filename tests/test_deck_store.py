@@ -0,0 +1,81 @@
+"""
+Columnar deck store (deck_store_update): decks cached after decks with a
+higher ID (retried misses, gaps filled later) are added, in deck ID order.
+
+Run with: python -m unittest discover tests (or python -m pytest tests)
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import arkham
+
+
+def deck(deck_id):
+    """Return a deck of the cache (its cards depend on its ID)"""
+    return {
+        "id": deck_id,
+        "investigator_code": "01001",
+        "date_creation": "2021-01-%02dT00:00:00+00:00" % deck_id,
+        "xp": deck_id,
+        "slots": {"01%03d" % (100 + number): 2 for number in range(deck_id)},
+    }
+
+
+class DeckStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "")
+        os.makedirs(self.path + "decklist")
+        for patcher in [
+            mock.patch.object(arkham, "CACHE_BACKEND", "files"),
+            mock.patch.object(arkham, "DB_PATH", self.path),
+            mock.patch.object(arkham, "DECK_STORE_PATH", self.path + "decks/"),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def cache(self, *deck_ids):
+        for deck_id in deck_ids:
+            with open(self.path + "decklist/%d.json" % deck_id, "w") as file:
+                json.dump(deck(deck_id), file)
+
+    def assertStored(self, store, deck_ids):
+        self.assertEqual(store["deck_id"].tolist(), deck_ids)
+        codes = store["codes"]
+        offsets = store["deck_offsets"]
+        for position, deck_id in enumerate(deck_ids):
+            first, last = offsets[position], offsets[position + 1]
+            self.assertEqual(
+                {
+                    codes[index]: int(quantity)
+                    for index, quantity in zip(
+                        store["card_idx"][first:last], store["qty"][first:last]
+                    )
+                },
+                deck(deck_id)["slots"],
+            )
+            self.assertEqual(store["xp"][position], deck_id)
+
+    def test_new_decks(self):
+        self.cache(1, 2, 4)
+        self.assertStored(arkham.deck_store_update(), [1, 2, 4])
+        self.cache(5, 7)
+        self.assertStored(arkham.deck_store_update(), [1, 2, 4, 5, 7])
+
+    def test_back_filled_gap(self):
+        self.cache(1, 2, 5, 6)
+        self.assertStored(arkham.deck_store_update(), [1, 2, 5, 6])
+        # Decks 3 and 4 are cached by a later run (retried misses)
+        self.cache(3, 4, 8)
+        self.assertStored(arkham.deck_store_update(), [1, 2, 3, 4, 5, 6, 8])
+        # Nothing new
+        self.assertStored(arkham.deck_store_update(), [1, 2, 3, 4, 5, 6, 8])
+
+
+if __name__ == "__main__":
+    unittest.main()
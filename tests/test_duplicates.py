@@ -0,0 +1,55 @@
+"""
+Duplicate cards list (duplicates_update): reprints of the card catalog are
+added, the entries added by hand are kept unless they're pruned.
+
+Run with: python -m unittest discover tests (or python -m pytest tests)
+"""
+
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import arkham
+
+
+class DuplicatesUpdateTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "duplicates.json")
+        for patcher in [
+            mock.patch.object(arkham, "DUPLICATES_PATH", self.filename),
+            # Added by hand: not a reprint in ArkhamDB, and a reprint of the
+            # reprint 07502 (replaced by the first printing)
+            mock.patch.object(
+                arkham,
+                "duplicates",
+                types.MappingProxyType({"07500": "01500", "07503": "07502"}),
+                create=True,
+            ),
+            mock.patch.dict(arkham.card_catalog["duplicate_of"], clear=True),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        arkham.catalog_add({"code": "01501", "name": "First printing"})
+        arkham.catalog_add({"code": "07501", "duplicate_of_code": "01501"})
+        arkham.catalog_add({"code": "07502", "duplicate_of_code": "07501"})
+
+    def test_entries_kept(self):
+        arkham.duplicates_update()
+        self.assertEqual(
+            arkham.file_to_json(self.filename),
+            {"07500": "01500", "07501": "01501", "07502": "01501", "07503": "01501"},
+        )
+
+    def test_entries_pruned(self):
+        arkham.duplicates_update(prune=True)
+        self.assertEqual(
+            arkham.file_to_json(self.filename), {"07501": "01501", "07502": "01501"}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,305 @@
+"""
+Deck legality (rules_compile, deck_problems and legality_check) with the
+shapes of the ArkhamDB card list (deck_options, deck_requirements,
+restrictions) and deck meta.
+
+Run with: python -m unittest discover tests (or python -m pytest tests)
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import arkham
+
+ROLAND = {
+    "code": "01001",
+    "name": "Roland Banks",
+    "type_code": "investigator",
+    "faction_code": "guardian",
+    "deck_options": [
+        {"faction": ["guardian", "neutral"], "level": {"min": 0, "max": 5}},
+        {"faction": ["seeker"], "level": {"min": 0, "max": 2}},
+    ],
+    "deck_requirements": {
+        "size": 30,
+        "card": {"01006": {"01006": "01006"}, "01007": {"01007": "01007"}},
+        "random": [{"target": "subtype", "value": "basicweakness"}],
+    },
+}
+# Parallel Roland: the deck keeps investigator_code 01001, the back is in meta
+PARALLEL_ROLAND = dict(
+    ROLAND,
+    code="90024",
+    alternate_of_code="01001",
+    deck_options=[
+        {"faction": ["guardian", "neutral"], "level": {"min": 0, "max": 5}},
+        {"faction": ["rogue"], "level": {"min": 0, "max": 2}},
+    ],
+)
+SECONDARY_CLASS = {
+    "code": "05001",
+    "name": "Faction select",
+    "type_code": "investigator",
+    "faction_code": "survivor",
+    "deck_options": [
+        {"faction": ["survivor", "neutral"], "level": {"min": 0, "max": 5}},
+        {
+            "name": "Secondary Class",
+            "id": "faction_selected",
+            "faction_select": ["guardian", "seeker", "rogue"],
+            "level": {"min": 0, "max": 2},
+            "limit": 10,
+        },
+    ],
+    "deck_requirements": {"size": 30, "card": {}},
+}
+AT_LEAST = {
+    "code": "03006",
+    "name": "At least",
+    "type_code": "investigator",
+    "faction_code": "neutral",
+    "deck_options": [
+        {"faction": ["neutral"], "level": {"min": 0, "max": 5}},
+        {
+            "faction": ["guardian", "seeker", "rogue", "mystic", "survivor"],
+            "level": {"min": 0, "max": 5},
+            "atleast": {"factions": 3, "min": 7},
+        },
+    ],
+    "deck_requirements": {"size": 30, "card": {}},
+}
+
+
+def card(code, faction, xp, **attributes):
+    """Return a player card of the card list"""
+    return dict(
+        {
+            "code": code,
+            "name": "Card " + code,
+            "type_code": "asset",
+            "faction_code": faction,
+            "xp": xp,
+            "deck_limit": 2,
+        },
+        **attributes,
+    )
+
+
+CARDS = [
+    ROLAND,
+    PARALLEL_ROLAND,
+    SECONDARY_CLASS,
+    AT_LEAST,
+    card(
+        "01006",
+        "guardian",
+        None,
+        deck_limit=1,
+        restrictions={"investigator": {"01001": "01001"}},
+    ),
+    card(
+        "01007",
+        "neutral",
+        None,
+        type_code="treachery",
+        subtype_code="weakness",
+        deck_limit=1,
+        restrictions={"investigator": {"01001": "01001"}},
+    ),
+    card("06167", "neutral", 0, permanent=True, deck_limit=1),  # Versatile
+    card("01050", "rogue", 0),
+    card("01051", "rogue", 0),
+    card("01052", "rogue", 0),
+    card("01053", "rogue", 0),
+    card("01030", "seeker", 0),
+    card("01031", "seeker", 3),
+    card("01060", "mystic", 0),
+]
+# Neutral level 0 cards (2 copies each) to fill the decks
+FILLERS = [card("01%03d" % number, "neutral", 0) for number in range(100, 115)]
+
+
+class LegalityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        arkham.duplicates = {}
+        for content in CARDS + FILLERS:
+            arkham.catalog_add(content)
+        arkham.rules_compile(CARDS + FILLERS)
+
+    def deck(self, slots, investigator="01001", meta=None, deck_id=1):
+        """Return the record of a 30 card deck (fillers) with more slots"""
+        content = {
+            "id": deck_id,
+            "investigator_code": investigator,
+            "date_creation": "2021-01-01T00:00:00+00:00",
+            "slots": dict({filler["code"]: 2 for filler in FILLERS}, **slots),
+        }
+        if meta is not None:
+            content["meta"] = json.dumps(meta)
+        return arkham.deck_record(content)
+
+    def roland(self, slots=None, meta=None):
+        return self.deck(dict({"01006": 1, "01007": 1}, **(slots or {})), meta=meta)
+
+    def test_rules_compile(self):
+        row = arkham.deck_rules["investigators"][("01001",)]
+        options = arkham.deck_rules["options"][row]
+        self.assertEqual(options[arkham.card_id("01100")], 0)
+        self.assertEqual(options[arkham.card_id("01030")], 1)
+        self.assertEqual(options[arkham.card_id("01031")], arkham.CARD_NOT_ALLOWED)
+        self.assertEqual(options[arkham.card_id("01050")], arkham.CARD_NOT_ALLOWED)
+        # Required cards and weaknesses don't count
+        self.assertEqual(options[arkham.card_id("01006")], arkham.CARD_FREE)
+        self.assertEqual(options[arkham.card_id("01007")], arkham.CARD_FREE)
+        self.assertEqual(arkham.deck_rules["size"][row], 30)
+        self.assertEqual(arkham.deck_rules["required_codes"][row], ["01006", "01007"])
+        # Signature of another investigator
+        row = arkham.deck_rules["investigators"][("05001", None)]
+        self.assertEqual(
+            arkham.deck_rules["options"][row][arkham.card_id("01006")],
+            arkham.CARD_RESTRICTED,
+        )
+
+    def test_rules_compile_choices(self):
+        selections = arkham.deck_rules["selections"]
+        self.assertEqual(selections["05001"], ["faction_selected"])
+        self.assertEqual(selections["01001"], [])
+        investigators = arkham.deck_rules["investigators"]
+        for choice in [None, "guardian", "seeker", "rogue"]:
+            self.assertIn(("05001", choice), investigators)
+        # Options not modeled: no rules
+        self.assertNotIn("03006", selections)
+
+    def test_legal_deck(self):
+        self.assertEqual(arkham.deck_problems(self.roland()), [])
+        self.assertEqual(arkham.deck_problems(self.roland({"01030": 2})), [])
+
+    def test_illegal_deck(self):
+        deck = self.deck({"01031": 1, "01050": 1})
+        self.assertEqual(
+            arkham.deck_problems(deck),
+            [
+                "01031 is not allowed",
+                "01050 is not allowed",
+                "Required card missing: 01006",
+                "Required card missing: 01007",
+            ],
+        )
+
+    def test_versatile(self):
+        self.assertEqual(
+            arkham.deck_problems(self.roland({"01050": 1, "01051": 1})),
+            ["01050 is not allowed", "01051 is not allowed"],
+        )
+        deck = self.roland({"06167": 1, "01050": 1, "01051": 1})
+        self.assertEqual(arkham.deck_problems(deck), [])
+        # Level 0 only, 5 cards at most
+        deck = self.roland({"06167": 1, "01031": 1})
+        self.assertEqual(arkham.deck_problems(deck), ["01031 is not allowed"])
+        deck = self.roland({"06167": 1, "01050": 2, "01051": 2, "01052": 2})
+        self.assertEqual(
+            arkham.deck_problems(deck), ["6 cards allowed by 06167 (limit 5)"]
+        )
+
+    def test_alternate_back(self):
+        meta = {"alternate_front": "90024", "alternate_back": "90024"}
+        deck = self.roland({"01050": 2}, meta)
+        self.assertEqual(arkham.deck_problems(deck), [])
+        deck = self.roland({"01030": 2}, meta)
+        self.assertEqual(arkham.deck_problems(deck), ["01030 is not allowed"])
+        # Unknown back
+        deck = self.roland({}, {"alternate_back": "99999"})
+        self.assertIsNone(arkham.deck_problems(deck))
+
+    def test_faction_selected(self):
+        slots = {"01030": 2}
+        self.assertEqual(arkham.deck_problems(self.deck(slots, "05001")), [])
+        deck = self.deck(slots, "05001", {"faction_selected": "seeker"})
+        self.assertEqual(arkham.deck_problems(deck), [])
+        deck = self.deck(slots, "05001", {"faction_selected": "rogue"})
+        self.assertEqual(arkham.deck_problems(deck), ["01030 is not allowed"])
+        deck = self.deck(slots, "05001", {"faction_selected": "druid"})
+        self.assertIsNone(arkham.deck_problems(deck))
+
+    def test_unchecked(self):
+        self.assertIsNone(arkham.deck_problems(self.deck({"01050": 1}, "03006")))
+        self.assertIsNone(arkham.deck_problems(self.deck({}, "09999")))
+
+    def test_legality_check(self):
+        """Same problems as deck_problems (used by the columnar deck store)"""
+        decks = [
+            self.roland(),
+            self.deck({"01031": 1, "01050": 1}),
+            self.roland({"01050": 1, "01051": 1}),
+            self.roland({"06167": 1, "01050": 1, "01051": 1}),
+            self.roland({"06167": 1, "01050": 2, "01051": 2, "01052": 2}),
+            self.roland({"01050": 2}, {"alternate_back": "90024"}),
+            self.deck({"01030": 2}, "05001", {"faction_selected": "rogue"}),
+            self.deck({"01050": 1}, "03006"),
+        ]
+        rows = np.array([-1 if deck.rules is None else deck.rules for deck in decks])
+        positions = np.repeat(
+            np.arange(len(decks)), [len(deck.cards) for deck in decks]
+        )
+        ids = np.concatenate([np.asarray(deck.cards, np.int64) for deck in decks])
+        quantities = np.concatenate(
+            [np.asarray(deck.quantities, np.int64) for deck in decks]
+        )
+        problems = arkham.legality_check(
+            rows, positions, ids, quantities, np.zeros(len(ids), np.int64)
+        )
+        for position, deck in enumerate(decks):
+            self.assertEqual(problems.get(position), arkham.deck_problems(deck) or None)
+
+
+class CheckpointRulesTest(unittest.TestCase):
+    """The checkpoint is outdated when the deckbuilding rules change"""
+
+    def setUp(self):
+        arkham.duplicates = {}
+        for content in CARDS + FILLERS:
+            arkham.catalog_add(content)
+        arkham.rules_compile(CARDS + FILLERS)
+        self.addCleanup(arkham.rules_compile, CARDS + FILLERS)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "checkpoint.pickle.gz")
+        state = arkham.new_aggregate()
+        state["digest"] = arkham.checkpoint_digest()
+        arkham.aggregate_dump(state, self.filename)
+
+    def test_same_rules(self):
+        arkham.rules_compile(CARDS + FILLERS)
+        self.assertEqual(arkham.aggregate_read(self.filename)["valid_decks"], [])
+
+    def test_investigator_rules_changed(self):
+        # ArkhamDB allows level 0-3 seeker cards to Roland
+        options = [dict(ROLAND["deck_options"][0]), dict(ROLAND["deck_options"][1])]
+        options[1]["level"] = {"min": 0, "max": 3}
+        arkham.rules_compile(
+            [dict(CARDS[0], deck_options=options)] + CARDS[1:] + FILLERS
+        )
+        with self.assertRaisesRegex(ValueError, "is outdated"):
+            arkham.aggregate_read(self.filename)
+
+    def test_restriction_changed(self):
+        signature = dict(CARDS[4], restrictions={"investigator": {"90024": "90024"}})
+        arkham.rules_compile(CARDS[:4] + [signature] + CARDS[5:] + FILLERS)
+        with self.assertRaisesRegex(ValueError, "is outdated"):
+            arkham.aggregate_read(self.filename)
+
+    def test_constant_changed(self):
+        margin = arkham.DECK_SIZE_MARGIN
+        self.addCleanup(setattr, arkham, "DECK_SIZE_MARGIN", margin)
+        arkham.DECK_SIZE_MARGIN = margin + 1
+        with self.assertRaisesRegex(ValueError, "is outdated"):
+            arkham.aggregate_read(self.filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Pipeline of threads (pipeline_run): a deck a stage fails on is skipped, the
+other decks are parsed and the run doesn't hang.
+
+Run with: python -m unittest discover tests (or python -m pytest tests)
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import arkham
+
+NB_DECKS = 40
+
+
+def card_code(deck_id):
+    """Return the card code of the only card of a deck"""
+    return "08%03d" % deck_id
+
+
+def cached_deck(oper, deck_id):
+    """Return a deck of the cache (arkhamdb_cache)"""
+    if deck_id == 3:
+        raise ValueError("corrupted deck")
+    return {
+        "id": deck_id,
+        "investigator_code": "01001",
+        "investigator_name": "Roland Banks",
+        "date_creation": "2021-01-01T00:00:00+00:00",
+        "slots": {card_code(deck_id): 2},
+    }
+
+
+class PipelineErrorTest(unittest.TestCase):
+    def setUp(self):
+        arkham.duplicates = {}
+        for deck_id in range(1, NB_DECKS + 1):
+            arkham.catalog_add(
+                {
+                    "code": card_code(deck_id),
+                    "type_code": "asset",
+                    "faction_code": "neutral",
+                }
+            )
+        deck_parse = arkham.deck_parse
+        deck_aggregate = arkham.deck_aggregate
+
+        def failing_parse(deck):
+            if deck.id == 7:
+                raise ValueError("can't parse")
+            return deck_parse(deck)
+
+        def failing_aggregate(aggregate, deck, *parsed):
+            if deck.id == 9:
+                raise KeyError("can't aggregate")
+            return deck_aggregate(aggregate, deck, *parsed)
+
+        for patcher in [
+            mock.patch.object(arkham, "arkhamdb_cache", cached_deck),
+            mock.patch.object(arkham, "pipeline_preload", lambda deck_id: None),
+            mock.patch.object(arkham, "deck_parse", failing_parse),
+            mock.patch.object(arkham, "deck_aggregate", failing_aggregate),
+            # Queues are full most of the time
+            mock.patch.object(arkham, "PIPELINE_QUEUE_SIZE", 2),
+            mock.patch.dict(arkham.missing, clear=True),
+            mock.patch.dict(
+                arkham.deck_scan,
+                {"next": 1, "stop": NB_DECKS + 1, "last_found": 0, "retry": []},
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_failed_decks(self):
+        result = {}
+
+        def run():
+            result["aggregate"] = arkham.pipeline_run(fetchers=3, parsers=2)
+
+        with self.assertLogs("arkham", "ERROR") as logs:
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(30)
+        self.assertFalse(thread.is_alive(), "pipeline_run doesn't return")
+        failed = {3, 7, 9}
+        self.assertEqual(
+            sorted(result["aggregate"]["valid_decks"]),
+            [deck_id for deck_id in range(1, NB_DECKS + 1) if deck_id not in failed],
+        )
+        self.assertEqual(len(logs.records), len(failed))
+        # Failed decks are tried again on the next run
+        self.assertEqual(
+            sorted(int(uid) for uid in arkham.missing["decklist"]), sorted(failed)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()